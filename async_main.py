@@ -0,0 +1,557 @@
+import asyncio
+import signal
+from collections import deque
+from functools import wraps
+import telebot
+from aiohttp import web
+from telebot import apihelper, asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+from config import (TOKEN, ADMIN_ID, DEFAULT_NEGATIVE_PROMPT, MAX_QUEUE_SIZE, MAX_JOBS_PER_USER, BROADCAST_RATE, BROADCAST_WORKERS,
+                    TELEGRAM_API_URL, DALLE_BACKENDS, BACKEND_MAX_CONCURRENCY, BACKEND_PROBE_INTERVAL, WEBHOOK_URL, WEBHOOK_HOST,
+                    WEBHOOK_PORT, WEBHOOK_SECRET, ASYNC_GENERATION_WORKERS, GENERATION_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+                    GENERATION_DEADLINE, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT, METRICS_HOST, METRICS_PORT, BATCH_SIZE,
+                    MAX_BATCH_SIZE, COST_HISTORY, SHARD_INDEX, SHARD_COUNT)
+from db import initialize_database, get_stats, get_recent_latencies
+from users import user_store
+from conversations import conversations
+from utils import generate_random_prompt
+from logger import logger
+from jobs import AsyncJobQueue, QueueFull, UserQueueFull, JobCancelled
+from delivery import deliver_images_async, deliver_generation_async
+from broadcast import BroadcastEngine
+from backends import AsyncBackendRouter, parse_backends
+from resilience import RetryPolicy
+from singleflight import AsyncSingleFlight
+from cluster import shard_for, update_user_id
+from metrics import STAGE_SECONDS, HANDLER_CALLS, RESENDS, command_label, callback_label, register_runtime_gauges, start_metrics_server
+from ui import (MAIN_MENU_KEYBOARD, SETTINGS_KEYBOARD, RANDOM_PROMPT_KEYBOARD, NEGATIVE_PROMPT_KEYBOARD, NEGATIVE_PROMPT_RANDOM_KEYBOARD,
+                RETRY_KEYBOARD, CANCEL_KEYBOARD)
+from flows import MESSAGE_CONTENT_TYPES, COMMANDS, cost_model, postprocessor, result_cache
+import flows
+import ui
+
+# Webhook mode: the same bot on asyncio. Updates arrive over HTTP and each
+# generation is a coroutine awaiting the backend, so waiting users cost
+# tasks instead of threads. What the bot does is in flows.py, shared with
+# main.py; its blocking parts (SQLite, the result cache on disk) run in to_thread.
+
+WEBHOOK_PATH = "/telegram/webhook"
+
+if TELEGRAM_API_URL:
+    asyncio_helper.API_URL = apihelper.API_URL = TELEGRAM_API_URL.rstrip('/') + "/bot{0}/{1}"
+
+bot = AsyncTeleBot(TOKEN)
+backend_router = AsyncBackendRouter(parse_backends(DALLE_BACKENDS, BACKEND_MAX_CONCURRENCY), BACKEND_PROBE_INTERVAL,
+                                    RetryPolicy(GENERATION_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY, GENERATION_DEADLINE),
+                                    BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+job_queue = AsyncJobQueue(workers=ASYNC_GENERATION_WORKERS, max_size=MAX_QUEUE_SIZE, max_per_user=MAX_JOBS_PER_USER,
+                          parallelism=min(ASYNC_GENERATION_WORKERS, sum(backend.limit for backend in backend_router.backends)))
+generation_flight = AsyncSingleFlight()
+# Broadcasts are long, rate limited background runs; they keep their thread
+# pool and a blocking client of their own
+broadcast_engine = BroadcastEngine(telebot.TeleBot(TOKEN), rate=BROADCAST_RATE, workers=BROADCAST_WORKERS)
+# Cancel events of queued and running jobs, by (chat id, status message id)
+cancellations = {}
+
+background_tasks = set()
+# Updates not yet handled, by user: each user's are handled one at a time, in
+# the order they arrived, so a button press and the answer typed right after
+# it cannot overtake each other
+pending_updates = {}
+
+
+def check_user(func):
+    @wraps(func)
+    async def wrapper(message, *args, **kwargs):
+        user = await asyncio.to_thread(user_store.get, message.from_user.id)
+        if not user:
+            await asyncio.to_thread(user_store.create, message.from_user.id, message.from_user.username)
+        return await func(message, *args, **kwargs)
+    return wrapper
+
+
+# Registered first so a pending answer wins over commands, like a next step
+# handler. handle_update has loaded the chat's state, so the filter reads memory.
+@bot.message_handler(func=lambda message: conversations.get(message.chat.id) is not None, content_types=MESSAGE_CONTENT_TYPES)
+async def handle_pending_input(message):
+    state = conversations.get(message.chat.id)
+    if flows.needs_text(message, state):
+        # The state stays set, so the next message is still taken as the answer
+        await bot.reply_to(message, ui.text_only_text(state))
+        return
+    handler = INPUT_HANDLERS.get(await asyncio.to_thread(conversations.pop, message.chat.id))
+    if handler:
+        await handler(message)
+
+async def send_welcome_instructions(message):
+    await bot.send_message(message.chat.id, ui.WELCOME_TEXT, reply_markup=MAIN_MENU_KEYBOARD)
+
+@bot.message_handler(commands=list(COMMANDS))
+@check_user
+async def handle_commands(message):
+    HANDLER_CALLS.inc('command', command_label(message.text))
+    handler = COMMAND_HANDLERS.get(flows.command_name(message.text))
+    if handler:
+        await handler(message)
+    else:
+        await bot.reply_to(message, ui.UNKNOWN_COMMAND_TEXT)
+
+async def send_welcome(message):
+    user_id = message.from_user.id
+    user = await asyncio.to_thread(user_store.get, user_id)
+    if user and user.prompt:
+        await bot.reply_to(message, ui.welcome_back_text(message.from_user.first_name), reply_markup=MAIN_MENU_KEYBOARD)
+    else:
+        await send_welcome_instructions(message)
+    logger.info("User %s (%s) started the bot", user_id, message.from_user.username, extra={'event': 'user_started', 'user_id': user_id})
+
+async def send_help(message):
+    await bot.reply_to(message, ui.HELP_TEXT)
+
+async def send_random_prompt(message):
+    prompt = generate_random_prompt()
+    await bot.reply_to(message, ui.random_prompt_text(prompt), parse_mode='HTML', reply_markup=RANDOM_PROMPT_KEYBOARD)
+
+async def generate_command(message):
+    user = await asyncio.to_thread(user_store.get, message.from_user.id)
+    try:
+        count = ui.parse_batch_size(message.text, MAX_BATCH_SIZE)
+    except ValueError:
+        await bot.reply_to(message, ui.batch_size_error_text(MAX_BATCH_SIZE))
+        return
+    if user and user.prompt:
+        await generate_image(message, count)
+    else:
+        await bot.reply_to(message, ui.NO_PROMPT_TEXT)
+
+async def send_stats(message):
+    if message.from_user.id == ADMIN_ID:
+        await asyncio.to_thread(user_store.flush)
+        stats = await asyncio.to_thread(get_stats)
+        await bot.reply_to(message, ui.stats_text(stats, result_cache.stats(), backend_router.stats(), generation_flight.stats()))
+    else:
+        await bot.reply_to(message, ui.ADMIN_ONLY_STATS_TEXT)
+
+async def start_broadcast(message):
+    if message.from_user.id == ADMIN_ID:
+        await asyncio.to_thread(conversations.set, message.chat.id, 'broadcast')
+        await bot.reply_to(message, ui.BROADCAST_PROMPT_TEXT)
+    else:
+        await bot.reply_to(message, ui.ADMIN_ONLY_BROADCAST_TEXT)
+
+@bot.message_handler(func=lambda message: True)
+@check_user
+async def handle_message(message):
+    if message.text.startswith('/'):
+        await handle_commands(message)
+    else:
+        HANDLER_CALLS.inc('message', 'prompt')
+        user_store.update(message.from_user.id, prompt=message.text)
+        await bot.reply_to(message, ui.NEGATIVE_PROMPT_CHOICE_TEXT, reply_markup=NEGATIVE_PROMPT_KEYBOARD)
+
+@bot.callback_query_handler(func=lambda call: True)
+async def callback_query(call):
+    user_id = call.from_user.id
+    logger.info("User %s clicked button: %s", user_id, call.data, extra={'event': 'button_click', 'user_id': user_id, 'data': call.data})
+    HANDLER_CALLS.inc('callback', callback_label(call.data))
+    handler = CALLBACK_HANDLERS.get(call.data)
+    # A handler returns True when it answered the callback itself
+    if not (handler and await handler(call)):
+        await bot.answer_callback_query(call.id)
+
+async def show_main_menu(call):
+    await bot.edit_message_text(ui.MAIN_MENU_TEXT, call.message.chat.id, call.message.message_id, reply_markup=MAIN_MENU_KEYBOARD)
+
+async def set_style(call):
+    style = call.data.split("_", 1)[1]
+    user_store.update(call.from_user.id, style=style)
+    await bot.answer_callback_query(call.id, ui.style_set_text(style))
+    await bot.edit_message_text(ui.STYLE_SET_TEXT, call.message.chat.id, call.message.message_id, reply_markup=SETTINGS_KEYBOARD)
+    return True
+
+async def use_default_negative(call):
+    user_store.update(call.from_user.id, negative_prompt=DEFAULT_NEGATIVE_PROMPT)
+    await generate_image(call.message)
+
+async def generate_button(call):
+    await generate_image(call.message)
+
+async def generate_batch_button(call):
+    await generate_image(call.message, BATCH_SIZE)
+
+async def settings_button(call):
+    await show_user_settings(call.message)
+
+async def help_button(call):
+    await send_help(call.message)
+
+async def add_custom_negative(call):
+    await asyncio.to_thread(conversations.set, call.message.chat.id, 'negative_prompt')
+    await bot.edit_message_text(ui.CUSTOM_NEGATIVE_TEXT, call.message.chat.id, call.message.message_id)
+
+async def show_random_prompt(call):
+    prompt = generate_random_prompt()
+    user_store.update(call.from_user.id, prompt=prompt)
+    await bot.edit_message_text(ui.random_prompt_text(prompt, refresh=True), call.message.chat.id, call.message.message_id, parse_mode='HTML',
+                                reply_markup=RANDOM_PROMPT_KEYBOARD)
+
+async def generate_random(call):
+    if await asyncio.to_thread(user_store.get, call.from_user.id):
+        await bot.edit_message_text(ui.NEGATIVE_PROMPT_CHOICE_RANDOM_TEXT, call.message.chat.id, call.message.message_id,
+                                    reply_markup=NEGATIVE_PROMPT_RANDOM_KEYBOARD)
+        return False
+    await bot.answer_callback_query(call.id, ui.START_OVER_TEXT)
+    return True
+
+async def process_custom_negative(message):
+    if message.text and message.text.startswith('/'):
+        await handle_commands(message)
+    else:
+        HANDLER_CALLS.inc('input', 'negative_prompt')
+        user_store.update(message.from_user.id, negative_prompt=flows.custom_negative_prompt(message.text))
+        await generate_image(message)
+
+async def handle_setting(call):
+    prompt = flows.SETTING_PROMPTS.get(call.data.split("_")[1])
+    if prompt:
+        state, text, keyboard = prompt
+        if state:
+            await asyncio.to_thread(conversations.set, call.message.chat.id, state)
+        await bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=keyboard)
+
+async def process_settings_input(message, parse, error_text):
+    if message.text and message.text.startswith('/'):
+        await handle_commands(message)
+        return
+    HANDLER_CALLS.inc('input', 'settings')
+    try:
+        fields, response = parse(message.text or '')
+    except ValueError:
+        await bot.reply_to(message, error_text, reply_markup=SETTINGS_KEYBOARD)
+        return
+    user_store.update(message.from_user.id, **fields)
+    await bot.reply_to(message, response, reply_markup=SETTINGS_KEYBOARD)
+
+async def process_size_input(message):
+    await process_settings_input(message, ui.parse_size, ui.SIZE_ERROR_TEXT)
+
+async def process_guidance_input(message):
+    await process_settings_input(message, ui.parse_guidance, ui.GUIDANCE_ERROR_TEXT)
+
+async def process_seed_input(message):
+    await process_settings_input(message, ui.parse_seed, ui.SEED_ERROR_TEXT)
+
+async def show_user_settings(message):
+    user = await asyncio.to_thread(user_store.get, message.chat.id)
+    if user:
+        await bot.send_message(message.chat.id, ui.settings_text(user), reply_markup=SETTINGS_KEYBOARD)
+    else:
+        await bot.reply_to(message, ui.NO_USER_TEXT)
+
+async def generate_image(message, count=1):
+    chat_id = message.chat.id
+    user = await asyncio.to_thread(user_store.get, chat_id)
+    if not user:
+        return
+    if flows.missing_settings(user):
+        await bot.reply_to(message, ui.MISSING_SETTINGS_TEXT)
+        return
+
+    cached = await asyncio.to_thread(flows.cached_generation, user, count)
+    if cached:
+        processing_msg = await bot.reply_to(message, ui.PROCESSING_TEXT)
+        await run_generation(message, processing_msg, user, cached)
+        return
+
+    plan = flows.plan_job(job_queue, user, count)
+    processing_msg = await bot.reply_to(message, ui.with_eta(plan.status_text, plan.wait + plan.duration), reply_markup=CANCEL_KEYBOARD)
+
+    async def on_start():
+        if queued_notice:
+            await bot.edit_message_text(ui.with_eta(plan.status_text, plan.duration), chat_id=chat_id, message_id=processing_msg.message_id,
+                                        reply_markup=CANCEL_KEYBOARD)
+
+    async def show_position(position):
+        queued_notice.append(position)
+        eta = job_queue.estimated_wait(job) + plan.duration
+        await bot.edit_message_text(ui.queue_position_text(position, eta), chat_id=chat_id, message_id=processing_msg.message_id,
+                                    reply_markup=CANCEL_KEYBOARD)
+
+    queued_notice = []
+    cancel_key = (chat_id, processing_msg.message_id)
+    cancel = cancellations[cancel_key] = asyncio.Event()
+    try:
+        if count > 1:
+            job = await job_queue.submit(chat_id, run_batch, message, processing_msg, plan.user, ui.batch_seeds(user.seed, count),
+                                         on_start=on_start, cost=plan.cost, cancel=cancel)
+        else:
+            job = await job_queue.submit(chat_id, run_generation, message, processing_msg, plan.user, on_start=on_start, cost=plan.cost,
+                                         cancel=cancel)
+    except (UserQueueFull, QueueFull) as e:
+        cancellations.pop(cancel_key, None)
+        text, keyboard = flows.rejection(e, chat_id)
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=processing_msg.message_id, reply_markup=keyboard)
+        return
+
+    if job_queue.stats()['running'] >= job_queue.workers:
+        await job.when_queued(show_position, job_queue.position(job))
+
+async def show_outcome(message, processing_msg, outcome):
+    # outcome: (text, keyboard, whether it replaces the status message) from flows
+    text, keyboard, replaces = outcome
+    if replaces:
+        await bot.edit_message_text(text, chat_id=message.chat.id, message_id=processing_msg.message_id, reply_markup=keyboard)
+    else:
+        await bot.send_message(message.chat.id, text, reply_markup=keyboard)
+
+async def run_generation(message, processing_msg, user, cached=None, cancel=None):
+    async def on_ready():
+        await bot.edit_message_text(ui.READY_TEXT, chat_id=message.chat.id, message_id=processing_msg.message_id)
+
+    async def show_progress(status):
+        text = throttle.text(status)
+        if text:
+            await bot.edit_message_text(text, chat_id=message.chat.id, message_id=processing_msg.message_id, reply_markup=CANCEL_KEYBOARD)
+
+    throttle = flows.ProgressThrottle(user)
+    error = None
+    try:
+        await create_image(message.chat.id, user, cached, on_ready, show_progress if cancel else None, cancel)
+    except Exception as e:
+        error = e
+    finally:
+        cancellations.pop((message.chat.id, processing_msg.message_id), None)
+    await show_outcome(message, processing_msg, flows.outcome(error))
+
+async def run_batch(message, processing_msg, user, seeds, cancel=None):
+    # Seed variants run BATCH_CONCURRENCY at a time, each delivered as soon as it is done
+    batch = flows.Batch(user, seeds, cancel)
+
+    async def variant(seed):
+        variant_user, cached = await asyncio.to_thread(batch.variant, seed)
+        await create_image(message.chat.id, variant_user, cached, cancel=cancel)
+
+    running = {asyncio.create_task(variant(seed)) for seed in batch.first_seeds()}
+    try:
+        while running:
+            finished, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                seed = batch.next_seed()
+                if seed is not None:
+                    running.add(asyncio.create_task(variant(seed)))
+                progress = batch.finished(task.exception())
+                if progress:
+                    text, keyboard = progress
+                    await bot.edit_message_text(text, chat_id=message.chat.id, message_id=processing_msg.message_id, reply_markup=keyboard)
+    finally:
+        for task in running:
+            task.cancel()
+        cancellations.pop((message.chat.id, processing_msg.message_id), None)
+    await show_outcome(message, processing_msg, batch.outcome())
+
+async def create_image(chat_id, user, cached=None, on_ready=None, progress=None, cancel=None):
+    # Generates one image set (or takes it from the cache) and delivers it;
+    # flows.Generation records it. A failure is re-raised for the caller to
+    # report; a cancelled generation raises JobCancelled.
+    generation = flows.Generation(user, cached)
+    try:
+        if cached:
+            images = await asyncio.to_thread(generation.read_cached)
+        else:
+            async def report(status):
+                # A shared run goes on after this job left it; its message is no longer the run's to edit
+                if cancel is None or not cancel.is_set():
+                    await progress(status)
+
+            async def generate(run_cancel):
+                images, seed = await backend_router.generate(progress=report if progress else None, cancel=run_cancel, **generation.request())
+                if generation.cache_key:
+                    await asyncio.to_thread(generation.store, images, seed)
+                return images, seed
+
+            if generation.cache_key:
+                # Cancelling leaves a shared run, which stops once every job has left
+                (images, seed), leader = await generation_flight.do(generation.cache_key, generate, cancel)
+            else:
+                (images, seed), leader = await generate(cancel), True
+            generation.generated(seed, leader)
+            # A shared run does not watch this job's cancel event
+            if cancel is not None and cancel.is_set():
+                raise JobCancelled()
+
+        if on_ready:
+            await on_ready()
+        file_ids = await deliver_generation_async(bot, chat_id, images, generation.caption, generation.seed, postprocessor, generation.parameters)
+        await asyncio.to_thread(generation.delivered, file_ids)
+    except JobCancelled:
+        generation.cancelled()
+        raise
+    except Exception as e:
+        await asyncio.to_thread(generation.failed, e)
+        raise
+
+async def cancel_generation(call):
+    # The Cancel button on the status message of a queued or running job
+    dropped = flows.cancel_job(cancellations, job_queue, (call.message.chat.id, call.message.message_id))
+    if dropped is None:
+        await bot.answer_callback_query(call.id, ui.NOTHING_TO_CANCEL_TEXT)
+        return True
+    if dropped:
+        # It never started, so nothing else will edit the message
+        await bot.edit_message_text(ui.CANCELLED_TEXT, call.message.chat.id, call.message.message_id, reply_markup=RETRY_KEYBOARD)
+    await bot.answer_callback_query(call.id, ui.CANCELLING_TEXT)
+    return True
+
+async def send_history(message):
+    text, keyboard = await asyncio.to_thread(flows.history_page, message.from_user.id)
+    await bot.send_message(message.chat.id, text, reply_markup=keyboard)
+
+async def show_history_page(call):
+    # "history" is the newest page, "history_<id>" the page below that generation
+    before_id = flows.history_before(call.data)
+    if before_id is None:
+        await bot.answer_callback_query(call.id, ui.HISTORY_STALE_TEXT)
+        return True
+    text, keyboard = await asyncio.to_thread(flows.history_page, call.from_user.id, before_id)
+    await bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=keyboard)
+
+async def resend_generation(call):
+    # Telegram keeps uploaded files, so this costs no GPU time and no upload
+    entry = await asyncio.to_thread(flows.history_entry, call.from_user.id, call.data)
+    if entry is None:
+        await bot.answer_callback_query(call.id, ui.HISTORY_GONE_TEXT)
+        return True
+    await bot.answer_callback_query(call.id, ui.RESENDING_TEXT)
+    try:
+        with STAGE_SECONDS.time('resend'):
+            await deliver_images_async(bot, call.message.chat.id, entry.file_ids, ui.generation_caption(entry, entry.seed), entry.seed)
+    except Exception as e:
+        logger.warning("Could not resend generation %s to user %s: %s", entry.id, call.from_user.id, e)
+        RESENDS.inc('failed')
+        await bot.send_message(call.message.chat.id, ui.RESEND_FAILED_TEXT)
+        return True
+    RESENDS.inc('ok')
+    return True
+
+async def remix_generation(call):
+    entry = await asyncio.to_thread(flows.history_entry, call.from_user.id, call.data)
+    if entry is None:
+        await bot.answer_callback_query(call.id, ui.HISTORY_GONE_TEXT)
+        return True
+    flows.remix(call.from_user.id, entry)
+    await bot.answer_callback_query(call.id, ui.REMIXED_TEXT)
+    await show_user_settings(call.message)
+    return True
+
+async def do_broadcast(message):
+    HANDLER_CALLS.inc('input', 'broadcast')
+    content = flows.broadcast_content(message)
+    if message.from_user.id != ADMIN_ID:
+        await bot.reply_to(message, ui.ADMIN_ONLY_BROADCAST_TEXT)
+    elif content:
+        kind, fields = content
+        await asyncio.to_thread(broadcast_engine.start, message.chat.id, kind, **fields)
+    else:
+        await bot.reply_to(message, ui.BROADCAST_UNSUPPORTED_TEXT)
+
+# What each command, button and pending answer leads to, from the table in
+# flows.py; handlers are coroutine functions
+COMMAND_HANDLERS, CALLBACK_HANDLERS, INPUT_HANDLERS = flows.bind(globals())
+
+
+async def handle_update(request):
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    data = await request.json()
+    user_id = update_user_id(data)
+    # Answer Telegram at once; a slow handler must not hold up redelivery timers
+    pending = pending_updates.get(user_id)
+    if pending is not None:
+        pending.append(types.Update.de_json(data))
+        return web.Response()
+    pending_updates[user_id] = deque([types.Update.de_json(data)])
+    task = asyncio.create_task(process_user_updates(user_id))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return web.Response()
+
+
+async def process_user_updates(user_id):
+    pending = pending_updates[user_id]
+    try:
+        while pending:
+            update = pending.popleft()
+            try:
+                await process_update(update)
+            except Exception as e:
+                logger.error("Failed to handle update %s of user %s: %s", update.update_id, user_id, e)
+    finally:
+        del pending_updates[user_id]
+
+
+async def process_update(update):
+    # Handler filters run on the event loop, so a chat whose conversation
+    # state is not in memory gets it loaded off the loop first
+    if update.message and not conversations.cached(update.message.chat.id):
+        await asyncio.to_thread(conversations.get, update.message.chat.id)
+    await bot.process_new_updates([update])
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    return app
+
+
+async def serve():
+    # Forks its workers, so it goes before the other threads start (it
+    # stops the log listener thread for the fork itself)
+    postprocessor.start()
+    await asyncio.to_thread(initialize_database)
+    cost_model.load(await asyncio.to_thread(get_recent_latencies, COST_HISTORY))
+    user_store.start()
+    conversations.start()
+    job_queue.start()
+    backend_router.start()
+    # Broadcasts are the admin's, so only the admin's worker resumes them
+    if shard_for(ADMIN_ID, SHARD_COUNT) == SHARD_INDEX:
+        broadcast_engine.resume_unfinished()
+    metrics_server = None
+    if METRICS_PORT:
+        register_runtime_gauges(job_queue, backend_router, generation_flight)
+        metrics_server = start_metrics_server(METRICS_HOST, METRICS_PORT)
+
+    runner = web.AppRunner(create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    logger.info("Listening for webhook updates on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await job_queue.stop()
+        if background_tasks:
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+        await backend_router.stop()
+        await bot.close_session()
+        await asyncio.to_thread(user_store.stop)
+        await asyncio.to_thread(conversations.stop)
+        if metrics_server:
+            metrics_server.shutdown()
+        postprocessor.stop()
+
+
+def run_webhook():
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    run_webhook()
@@ -0,0 +1,440 @@
+import asyncio
+import threading
+import time
+import httpx
+from delivery import read_images
+from gradio_async import AsyncGradioClient, JobStatus, space_url
+from jobs import JobCancelled
+from resilience import CircuitBreaker, RetryPolicy, BackendUnavailable, DeadlineExceeded, is_transient
+from metrics import STAGE_SECONDS
+from logger import logger
+
+LATENCY_SMOOTHING = 0.2
+PROBE_TIMEOUT = 10
+STATUS_POLL_INTERVAL = 0.5  # how often the thread runtime looks at a running job
+RUNNING_STATES = ('PROCESSING', 'PROGRESS', 'ITERATING')  # gradio_client Status values
+
+
+def parse_backends(spec, default_limit=1):
+    # "owner/Space,http://10.0.0.5:7860=4" -> [Backend, Backend]; "=N" sets its concurrency
+    backends = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        src, _, limit = entry.rpartition('=')
+        if src and limit.isdigit():
+            backends.append(Backend(src, int(limit)))
+        else:
+            backends.append(Backend(entry, default_limit))
+    return backends
+
+
+class Backend:
+    """One gradio endpoint and what the router has learned about it."""
+
+    def __init__(self, src, limit=1):
+        self.src = src
+        self.limit = limit
+        self.client = None
+        self.client_lock = threading.Lock()
+        self.breaker = CircuitBreaker(src)
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.latency = None  # smoothed seconds per successful generation
+
+    @property
+    def healthy(self):
+        return self.breaker.state != CircuitBreaker.OPEN
+
+    def stats(self):
+        return {
+            'src': self.src,
+            'state': self.breaker.state,
+            'in_flight': self.in_flight,
+            'limit': self.limit,
+            'requests': self.requests,
+            'errors': self.errors,
+            'trips': self.breaker.trips,
+            'latency_ms': int(self.latency * 1000) if self.latency is not None else None,
+        }
+
+
+class BackendPool:
+    """Least-loaded selection over a set of backends.
+
+    A backend's cost is (in_flight + 1) * its smoothed latency, so a fast
+    Space takes more work than a slow one until its queue catches up.
+    Backends whose circuit is open get nothing. Not synchronized; callers
+    hold their own lock.
+    """
+
+    def __init__(self, backends, failure_threshold=3, reset_timeout=60.0):
+        if not backends:
+            raise ValueError("At least one generation backend is required")
+        self.backends = backends
+        for backend in backends:
+            backend.breaker = CircuitBreaker(backend.src, failure_threshold, reset_timeout)
+        self.retries = 0
+        self.fast_failed = 0
+        self.deadline_exceeded = 0
+
+    def pick(self, avoid=()):
+        # Returns a backend with a free slot (and counts it as busy), or None to
+        # wait. Backends in `avoid` just failed this job and are a last resort.
+        usable = [b for b in self.backends if b.in_flight < b.limit and b.breaker.available()]
+        if not usable:
+            return None
+        candidates = [b for b in usable if b not in avoid] or usable
+        known = [b.latency for b in self.backends if b.latency is not None]
+        default_latency = sum(known) / len(known) if known else 1.0
+        backend = min(candidates, key=lambda b: (b.in_flight + 1) * (b.latency if b.latency is not None else default_latency))
+        backend.in_flight += 1
+        backend.requests += 1
+        backend.breaker.dispatched()
+        return backend
+
+    def retry_in(self):
+        # 0 while some circuit takes work (a job only has to wait for a slot),
+        # otherwise seconds until the first open circuit allows a trial
+        if any(backend.healthy for backend in self.backends):
+            return 0.0
+        return min(backend.breaker.retry_in() for backend in self.backends)
+
+    def release(self, backend, elapsed=None, error=None, cancelled=False):
+        backend.in_flight -= 1
+        if cancelled:
+            # Says nothing about the backend; just free a half-open trial
+            backend.breaker.abandon()
+            return
+        if error is None:
+            if elapsed is not None:
+                if backend.latency is None:
+                    backend.latency = elapsed
+                else:
+                    backend.latency += LATENCY_SMOOTHING * (elapsed - backend.latency)
+            backend.breaker.success()
+            return
+        backend.errors += 1
+        if is_transient(error):
+            backend.breaker.failure(error)
+        else:
+            # The Space answered, it just did not like this job
+            backend.breaker.success()
+
+    def retry_delay(self, policy, backend, error, attempt, deadline):
+        # Re-raises unless the error is worth another attempt within the deadline
+        if not is_transient(error) or attempt >= policy.attempts:
+            raise error
+        delay = policy.delay(attempt)
+        if time.monotonic() + delay >= deadline:
+            self.deadline_exceeded += 1
+            raise DeadlineExceeded(f"No result within {policy.deadline:.0f}s: {error}") from error
+        self.retries += 1
+        logger.warning("Backend %s failed, retrying in %.1fs: %s", backend.src, delay, error)
+        return delay
+
+    def stats(self):
+        return {
+            'backends': [backend.stats() for backend in self.backends],
+            'retries': self.retries,
+            'fast_failed': self.fast_failed,
+            'deadline_exceeded': self.deadline_exceeded,
+        }
+
+
+class BackendRouter:
+    """Spreads generations over several gradio backends and rides out their failures.
+
+    Each backend has its own client, concurrency limit and circuit breaker;
+    a generation waits for a free slot rather than piling onto a busy Space.
+    Transient errors are retried with jittered exponential backoff on the
+    least-loaded backend, preferring one that has not just failed, until the
+    job's deadline. When every circuit is open, jobs wait for the first
+    trial if it comes before their deadline and fail fast otherwise. A
+    background thread probes every backend's /info; failed probes count
+    toward its circuit's failure threshold like failed jobs, so one that
+    went down is skipped before many users hit it, and one that came back
+    is tried again.
+    """
+
+    def __init__(self, backends, probe_interval=30, retry=None, failure_threshold=3, reset_timeout=60.0):
+        self.probe_interval = probe_interval
+        self.retry = retry or RetryPolicy()
+        self._pool = BackendPool(backends, failure_threshold, reset_timeout)
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def backends(self):
+        return self._pool.backends
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._probe_loop, name="backend-probe", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def generate(self, progress=None, cancel=None, **params):
+        # Returns (images as bytes, seed). `progress` is called with a JobStatus
+        # as the Space reports one; setting the `cancel` event abandons the
+        # job, remotely too, and raises JobCancelled.
+        cancel = cancel or threading.Event()
+        deadline = time.monotonic() + self.retry.deadline
+        avoid = ()
+        attempt = 0
+        while True:
+            with STAGE_SECONDS.time('backend_wait'):
+                backend = self._acquire(avoid, deadline, cancel)
+            started = time.monotonic()
+            try:
+                with STAGE_SECONDS.time('backend'):
+                    result = self._predict(backend, params, deadline - started, progress, cancel)
+                    images = read_images(item['image'] for item in result[0])
+            except JobCancelled:
+                with self._cond:
+                    self._pool.release(backend, cancelled=True)
+                    self._cond.notify_all()
+                raise
+            except Exception as e:
+                with self._cond:
+                    self._pool.release(backend, error=e)
+                    self._cond.notify_all()
+                    delay = self._pool.retry_delay(self.retry, backend, e, attempt, deadline)
+                attempt += 1
+                avoid = (backend,)
+                if cancel.wait(delay):
+                    raise JobCancelled()
+                continue
+            with self._cond:
+                self._pool.release(backend, time.monotonic() - started)
+                self._cond.notify_all()
+            return images, result[1]
+
+    def stats(self):
+        with self._cond:
+            return self._pool.stats()
+
+    def _acquire(self, avoid, deadline, cancel):
+        with self._cond:
+            while True:
+                if cancel.is_set():
+                    raise JobCancelled()
+                backend = self._pool.pick(avoid)
+                if backend:
+                    return backend
+                remaining = deadline - time.monotonic()
+                retry_in = self._pool.retry_in()
+                if retry_in > remaining:
+                    self._pool.fast_failed += 1
+                    raise BackendUnavailable(f"All backends are down, next retry in {retry_in:.0f}s")
+                if remaining <= 0:
+                    self._pool.deadline_exceeded += 1
+                    raise DeadlineExceeded(f"No backend became free within {self.retry.deadline:.0f}s")
+                # A released slot wakes this up; a cancel only sets its event
+                self._cond.wait(min(retry_in or remaining, STATUS_POLL_INTERVAL))
+
+    def _connect(self, backend):
+        with backend.client_lock:
+            # Connecting fetches the app config; the probe thread does it
+            # ahead of the first job. gradio_client is slow to import and
+            # only this runtime needs it, so it is imported here.
+            if backend.client is None:
+                from gradio_client import Client
+                backend.client = Client(backend.src)
+        return backend.client
+
+    def _predict(self, backend, params, timeout, progress, cancel):
+        job = self._connect(backend).submit(**params, api_name="/run")
+        deadline = time.monotonic() + timeout
+        reported = None
+        while not job.done():
+            if cancel.wait(STATUS_POLL_INTERVAL):
+                # Leaves the Space's queue, or stops a job that already runs
+                job.cancel()
+                raise JobCancelled()
+            if time.monotonic() > deadline:
+                job.cancel()
+                raise TimeoutError(f"No result from {backend.src} within {timeout:.0f}s")
+            status = job_status(job.status())
+            if progress and status and status != reported:
+                reported = status
+                try:
+                    progress(status)
+                except Exception as e:
+                    logger.warning("Progress report failed: %s", e)
+        return job.result()
+
+    def _probe(self, backend):
+        try:
+            httpx.get(space_url(backend.src) + "info", timeout=PROBE_TIMEOUT).raise_for_status()
+        except Exception as e:
+            return e
+        return None
+
+    def _probe_loop(self):
+        for backend in self.backends:
+            if self._stop.is_set():
+                return
+            try:
+                self._connect(backend)
+            except Exception as e:
+                logger.warning("Could not connect to %s ahead of time: %s", backend.src, e)
+        while not self._stop.wait(self.probe_interval):
+            for backend in self.backends:
+                error = self._probe(backend)
+                with self._cond:
+                    backend.breaker.probe(error is None, error)
+                    self._cond.notify_all()
+
+
+class AsyncBackendRouter:
+    """BackendRouter for the asyncio runtime, on AsyncGradioClient."""
+
+    def __init__(self, backends, probe_interval=30, retry=None, failure_threshold=3, reset_timeout=60.0):
+        self.probe_interval = probe_interval
+        self.retry = retry or RetryPolicy()
+        self._pool = BackendPool(backends, failure_threshold, reset_timeout)
+        self._cond = None
+        self._task = None
+        for backend in backends:
+            backend.client = AsyncGradioClient(backend.src)
+
+    @property
+    def backends(self):
+        return self._pool.backends
+
+    def start(self):
+        if self._task:
+            return
+        self._cond = asyncio.Condition()
+        self._task = asyncio.create_task(self._probe_loop(), name="backend-probe")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for backend in self.backends:
+            await backend.client.close()
+
+    async def generate(self, progress=None, cancel=None, **params):
+        # `progress` is a coroutine function here and `cancel` an asyncio.Event
+        cancel = cancel or asyncio.Event()
+        deadline = time.monotonic() + self.retry.deadline
+        avoid = ()
+        attempt = 0
+        while True:
+            with STAGE_SECONDS.time('backend_wait'):
+                backend = await self._until_cancelled(self._acquire(avoid, deadline), cancel)
+            started = time.monotonic()
+            try:
+                with STAGE_SECONDS.time('backend'):
+                    images, seed = await self._until_cancelled(
+                        asyncio.wait_for(self._predict(backend, params, progress), deadline - started), cancel)
+            except (asyncio.CancelledError, JobCancelled):
+                await asyncio.shield(self._release(backend, cancelled=True))
+                raise
+            except Exception as e:
+                await self._release(backend, error=e)
+                delay = self._pool.retry_delay(self.retry, backend, e, attempt, deadline)
+                attempt += 1
+                avoid = (backend,)
+                await self._until_cancelled(asyncio.sleep(delay), cancel)
+                continue
+            await self._release(backend, time.monotonic() - started)
+            return images, seed
+
+    def stats(self):
+        return self._pool.stats()
+
+    async def _predict(self, backend, params, progress):
+        async def report(status):
+            try:
+                await progress(status)
+            except Exception as e:
+                logger.warning("Progress report failed: %s", e)
+
+        gallery, seed = await backend.client.submit("/run", report if progress else None, **params)
+        images = await asyncio.gather(*(backend.client.download(item['image']) for item in gallery))
+        return list(images), seed
+
+    async def _until_cancelled(self, awaitable, cancel):
+        # The result of `awaitable`, unless `cancel` is set first: then it is
+        # cancelled (which cancels a submitted job upstream) and JobCancelled raised
+        task = asyncio.ensure_future(awaitable)
+        cancelled = asyncio.ensure_future(cancel.wait())
+        try:
+            done, _ = await asyncio.wait((task, cancelled), return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            cancelled.cancel()
+        if task in done:
+            return task.result()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        raise JobCancelled()
+
+    async def _acquire(self, avoid, deadline):
+        async with self._cond:
+            while True:
+                backend = self._pool.pick(avoid)
+                if backend:
+                    return backend
+                remaining = deadline - time.monotonic()
+                retry_in = self._pool.retry_in()
+                if retry_in > remaining:
+                    self._pool.fast_failed += 1
+                    raise BackendUnavailable(f"All backends are down, next retry in {retry_in:.0f}s")
+                if remaining <= 0:
+                    self._pool.deadline_exceeded += 1
+                    raise DeadlineExceeded(f"No backend became free within {self.retry.deadline:.0f}s")
+                try:
+                    await asyncio.wait_for(self._cond.wait(), retry_in or remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _release(self, backend, elapsed=None, error=None, cancelled=False):
+        async with self._cond:
+            self._pool.release(backend, elapsed, error, cancelled)
+            self._cond.notify_all()
+
+    async def _probe_loop(self):
+        # Fetch each Space's endpoint description before the first job needs it
+        results = await asyncio.gather(*(backend.client.connect("/run") for backend in self.backends), return_exceptions=True)
+        for backend, result in zip(self.backends, results):
+            if isinstance(result, Exception):
+                logger.warning("Could not connect to %s ahead of time: %s", backend.src, result)
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            results = await asyncio.gather(*(backend.client.ping(PROBE_TIMEOUT) for backend in self.backends), return_exceptions=True)
+            async with self._cond:
+                for backend, result in zip(self.backends, results):
+                    error = result if isinstance(result, BaseException) else None
+                    backend.breaker.probe(error is None, error)
+                self._cond.notify_all()
+
+
+def job_status(update):
+    # gradio_client's StatusUpdate as a JobStatus, or None for stages users need not see
+    if update.code.value == 'IN_QUEUE':
+        return JobStatus('queued', (update.rank or 0) + 1, update.eta)
+    if update.code.value in RUNNING_STATES:
+        unit = update.progress_data[0] if update.progress_data else None
+        if unit is None:
+            return JobStatus('running')
+        if unit.progress is not None:
+            return JobStatus('running', progress=unit.progress)
+        return JobStatus('running', progress=unit.index / unit.length if unit.index is not None and unit.length else None)
+    return None
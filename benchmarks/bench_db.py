@@ -0,0 +1,107 @@
+"""Compare the pooled db.py access layer with the old connect-per-call pattern.
+
+Usage: python benchmarks/bench_db.py [--users 1000] [--ops 20000] [--threads 4]
+
+Both variants run the same mix of one update per four reads, the ratio of a
+typical interaction (check_user, then a handler, then generate_image), against
+separate temporary databases.
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('ADMIN_ID', '0')
+WORKDIR = tempfile.mkdtemp(prefix='bench_db_')
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'pooled.db')
+
+import db  # noqa: E402
+from config import DEFAULT_NEGATIVE_PROMPT  # noqa: E402
+
+LEGACY_PATH = os.path.join(WORKDIR, 'legacy.db')
+
+
+def legacy_get_user(user_id):
+    conn = sqlite3.connect(LEGACY_PATH)
+    try:
+        return conn.execute("SELECT * FROM users WHERE id=?", (user_id,)).fetchone()
+    finally:
+        conn.close()
+
+
+def legacy_update_user_data(user_id, field, value):
+    conn = sqlite3.connect(LEGACY_PATH)
+    try:
+        conn.execute(f"UPDATE users SET {field} = ? WHERE id = ?", (value, user_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def seed_database(path, users):
+    conn = sqlite3.connect(path)
+    conn.executescript(db.MIGRATIONS[0])
+    conn.executemany(
+        "INSERT INTO users (id, username, negative_prompt, style, width, height, guidance_scale, seed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        [(i, f"user{i}", DEFAULT_NEGATIVE_PROMPT, "3840 x 2160", 2048, 2048, 20.0, -1) for i in range(users)],
+    )
+    conn.commit()
+    conn.close()
+
+
+def run(get_user, update_user_data, users, ops, threads):
+    errors = []
+
+    def worker(count):
+        rng = random.Random()
+        try:
+            for i in range(count):
+                user_id = rng.randrange(users)
+                if i % 5 == 4:
+                    update_user_data(user_id, 'prompt', f"prompt {i}")
+                else:
+                    get_user(user_id)
+        except sqlite3.Error as e:
+            errors.append(e)
+
+    pool = [threading.Thread(target=worker, args=(ops // threads,)) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return (ops // threads) * threads / elapsed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--ops', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    seed_database(LEGACY_PATH, args.users)
+    seed_database(db.DB_PATH, args.users)
+    db.initialize_database()
+
+    for threads in sorted({1, args.threads}):
+        legacy, legacy_errors = run(legacy_get_user, legacy_update_user_data, args.users, args.ops, threads)
+        pooled, pooled_errors = run(db.get_user, db.update_user_data, args.users, args.ops, threads)
+        print(f"{threads} thread(s): connect-per-call {legacy:,.0f} ops/s, pooled {pooled:,.0f} ops/s ({pooled / legacy:.1f}x)")
+        for name, errors in (('connect-per-call', legacy_errors), ('pooled', pooled_errors)):
+            if errors:
+                print(f"  {name}: {len(errors)} thread(s) failed, first error: {errors[0]}")
+
+    db.close_connections()
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Measure /history page reads on a large generation log.
+
+Usage: python benchmarks/bench_history.py [--rows 2000000] [--users 20000] [--page 5] [--reads 2000]
+
+Fills a scratch database with `rows` generations spread over `users` users,
+one in ten of them failed (so not in the history). Then it times reading a
+page at growing depths in a heavy user's history: with the keyset query
+db.get_history runs, and with LIMIT/OFFSET for comparison, whose cost grows
+with the depth. The stats trigger is dropped while filling, since it is
+not what is measured.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('ADMIN_ID', '0')
+WORKDIR = tempfile.mkdtemp(prefix='bench_history_')
+os.environ['DB_PATH'] = os.path.join(WORKDIR, 'history.db')
+
+import db  # noqa: E402
+
+OFFSET_QUERY = db.HISTORY_SELECT + " WHERE user_id = ? AND file_ids IS NOT NULL ORDER BY id DESC LIMIT ? OFFSET ?"
+
+
+def fill(rows, users, heavy_user):
+    # A tenth of all rows belong to heavy_user, the rest are spread evenly
+    rng = random.Random(0)
+    now = time.time()
+    with db.get_db_connection() as conn:
+        conn.execute("DROP TRIGGER generations_stats_insert")
+        with conn:
+            batch = []
+            for i in range(rows):
+                user_id = heavy_user if i % 10 == 0 else rng.randrange(users)
+                failed = i % 10 == 9
+                batch.append((user_id, now - rows + i, f"prompt {i}", "", "Photo", 1024, 1024, 7.0, rng.randrange(2 ** 31),
+                              'failed' if failed else 'ok', None if failed else json.dumps([f"file{i}"])))
+                if len(batch) == 50000:
+                    conn.executemany("""
+                    INSERT INTO generations (user_id, created_at, prompt, negative_prompt, style, width, height, guidance_scale, seed, status, file_ids)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, batch)
+                    batch.clear()
+            if batch:
+                conn.executemany("""
+                INSERT INTO generations (user_id, created_at, prompt, negative_prompt, style, width, height, guidance_scale, seed, status, file_ids)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, batch)
+        conn.execute("ANALYZE")
+
+
+def per_read(function, reads):
+    started = time.perf_counter()
+    for _ in range(reads):
+        function()
+    return (time.perf_counter() - started) / reads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--page', type=int, default=5)
+    parser.add_argument('--reads', type=int, default=2000)
+    args = parser.parse_args()
+
+    heavy_user = args.users
+    db.initialize_database()
+    started = time.perf_counter()
+    fill(args.rows, args.users, heavy_user)
+    print(f"Filled {args.rows:,} generations in {time.perf_counter() - started:.1f}s")
+
+    with db.get_db_connection() as conn:
+        plan = conn.execute("EXPLAIN QUERY PLAN " + db.HISTORY_SELECT +
+                            " WHERE user_id = ? AND file_ids IS NOT NULL AND id < ? ORDER BY id DESC LIMIT ?", (heavy_user, db.LAST_ID, 5)).fetchall()
+        print("Plan: " + "; ".join(row[-1] for row in plan))
+        ids = [row[0] for row in conn.execute(
+            "SELECT id FROM generations WHERE user_id = ? AND file_ids IS NOT NULL ORDER BY id DESC", (heavy_user,))]
+    print(f"Heavy user: {len(ids):,} entries in history")
+
+    for depth in (0, 100, 10000, len(ids) - args.page):
+        before_id = ids[depth - 1] if depth else db.LAST_ID
+        keyset = per_read(lambda: db.get_history(heavy_user, before_id, args.page + 1), args.reads)
+        reads = max(1, args.reads // (1 + depth // 1000))
+
+        def offset_page():
+            with db.get_db_connection() as conn:
+                conn.execute(OFFSET_QUERY, (heavy_user, args.page + 1, depth)).fetchall()
+
+        offset = per_read(offset_page, reads)
+        print(f"Page at depth {depth:>7,}: keyset {keyset * 1e6:8.1f}us, offset {offset * 1e6:10.1f}us")
+    entry = per_read(lambda: db.get_history_entry(heavy_user, random.choice(ids)), args.reads)
+    print(f"One entry for resend or remix: {entry * 1e6:.1f}us")
+
+    db.close_connections()
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
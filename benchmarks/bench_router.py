@@ -0,0 +1,84 @@
+"""Measure generation throughput over one and several backends, and failover.
+
+Usage: python benchmarks/bench_router.py [--jobs 60] [--latency 1.0] [--capacity 2] [--backends 4] [--failure-rate 0.2]
+
+Each fake Space has `capacity` GPU slots, so one Space finishes at most
+capacity / latency generations per second however many are sent to it.
+The router runs the same batch against one Space, then against several,
+then again while one of them goes down halfway through, and finally with
+every Space aborting a share of its jobs, which retries should absorb.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('ADMIN_ID', '0')
+from fake_gradio import FakeGradio  # noqa: E402
+from backends import AsyncBackendRouter, Backend  # noqa: E402
+from resilience import RetryPolicy  # noqa: E402
+
+PARAMS = dict(prompt="a lighthouse at dusk", negative_prompt="", use_negative_prompt=True, style="Photo", seed=0,
+              width=1024, height=1024, guidance_scale=7.0, randomize_seed=True)
+
+
+async def run(spaces, jobs, capacity, fail_after=None):
+    # fail_after: seconds until the first Space starts refusing calls
+    router = AsyncBackendRouter([Backend(space.url, capacity) for space in spaces], probe_interval=0.5,
+                                retry=RetryPolicy(attempts=3, base_delay=0.2, max_delay=2.0, deadline=120))
+    router.start()
+    failed = 0
+    if fail_after is not None:
+        asyncio.get_running_loop().call_later(fail_after, setattr, spaces[0], 'down', True)
+
+    async def one():
+        nonlocal failed
+        try:
+            await router.generate(**PARAMS)
+        except Exception:
+            failed += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(one() for _ in range(jobs)))
+    elapsed = time.monotonic() - started
+    stats = router.stats()
+    await router.stop()
+    for space in spaces:
+        space.down = False
+    return elapsed, failed, stats
+
+
+def report(title, jobs, elapsed, failed, stats):
+    print(f"{title}: {jobs} generations in {elapsed:.2f}s ({jobs / elapsed:.1f}/s), {failed} failed")
+    print(f"  {stats['retries']} retries, {stats['fast_failed']} fast-failed, {stats['deadline_exceeded']} past deadline")
+    for backend in stats['backends']:
+        print(f"  {backend['src']}: {backend['requests']} requests, {backend['errors']} errors, circuit {backend['state']}")
+
+
+async def main(args):
+    spaces = [FakeGradio(latency=args.latency, capacity=args.capacity) for _ in range(args.backends)]
+    for space in spaces:
+        await space.start()
+    try:
+        report("1 backend", args.jobs, *await run(spaces[:1], args.jobs, args.capacity))
+        report(f"{args.backends} backends", args.jobs, *await run(spaces, args.jobs, args.capacity))
+        report(f"{args.backends} backends, first one down mid-run", args.jobs,
+               *await run(spaces, args.jobs, args.capacity, fail_after=args.jobs * args.latency / args.capacity / args.backends / 2))
+        for space in spaces:
+            space.failure_rate = args.failure_rate
+        report(f"{args.backends} backends, {args.failure_rate:.0%} of jobs aborted", args.jobs, *await run(spaces, args.jobs, args.capacity))
+    finally:
+        for space in spaces:
+            await space.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=60)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--capacity", type=int, default=2)
+    parser.add_argument("--backends", type=int, default=4)
+    parser.add_argument("--failure-rate", type=float, default=0.2)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,101 @@
+"""Measure cold start and the fixed cost of handling one update.
+
+Usage: python benchmarks/bench_startup.py [--runs 5] [--lookups 200000]
+
+Cold start is the time a fresh interpreter takes to import each runtime,
+the median of `runs` processes, along with whether gradio_client was
+loaded on the way. Per update, it times finding the handler for every
+command and button the bot knows, and sending a keyboard: built and
+serialized on each reply as it used to be, against the precomputed
+markup ui.py now holds.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix="dalle_bench_")
+os.environ.setdefault('ADMIN_ID', '0')
+os.environ.setdefault('BOT_TOKEN', '123:TEST')
+os.environ.setdefault('DB_PATH', os.path.join(WORKDIR, "users.db"))
+os.environ.setdefault('LOG_FILE', os.path.join(WORKDIR, "bot.log"))
+
+IMPORT_SCRIPT = """
+import sys, time
+sys.path.insert(0, {root!r})
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started, 'gradio_client' in sys.modules)
+"""
+
+
+def cold_start(module, runs):
+    timings, loaded = [], False
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT.format(root=ROOT, module=module)], cwd=WORKDIR,
+                                capture_output=True, text=True, check=True).stdout.split()
+        timings.append(float(output[0]))
+        loaded |= output[1] == "True"
+    return statistics.median(timings), loaded
+
+
+def per_call(function, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        function()
+    return (time.perf_counter() - started) / count
+
+
+def built_keyboard():
+    # How every reply used to get its main menu
+    from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup
+    from ui import BATCH_SIZE
+
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("Create image", callback_data="create_image"))
+    keyboard.row(InlineKeyboardButton(f"Create {BATCH_SIZE} variants", callback_data="create_batch"))
+    keyboard.row(InlineKeyboardButton("Settings", callback_data="settings"))
+    keyboard.row(InlineKeyboardButton("Help", callback_data="help"))
+    keyboard.row(InlineKeyboardButton("Random prompt", callback_data="random_prompt"))
+    return keyboard.to_json()
+
+
+def main(args):
+    for module in ("main", "async_main"):
+        median, loaded = cold_start(module, args.runs)
+        print(f"import {module}: {median * 1000:.0f}ms median of {args.runs}, "
+              f"gradio_client {'loaded' if loaded else 'not loaded'}")
+
+    import main as runtime
+    import ui
+
+    data = list(runtime.CALLBACK_HANDLERS.handlers) + ["set_size", "set_guidance", "style_Photo", "style_Anime", "unknown"]
+    commands = list(runtime.COMMAND_HANDLERS.handlers) + ["unknown"]
+
+    def dispatch():
+        for key in data:
+            runtime.CALLBACK_HANDLERS.get(key)
+        for command in commands:
+            runtime.COMMAND_HANDLERS.get(command)
+
+    lookup = per_call(dispatch, args.lookups // len(data + commands)) / len(data + commands)
+    print(f"Handler lookup: {lookup * 1e9:.0f}ns over {len(data)} callbacks and {len(commands)} commands")
+    built = per_call(built_keyboard, args.lookups // 100)
+    precomputed = per_call(lambda: ui.MAIN_MENU_KEYBOARD, args.lookups)
+    print(f"Main menu keyboard: built {built * 1e6:.1f}us, precomputed {precomputed * 1e6:.3f}us per reply")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--lookups", type=int, default=200000)
+    try:
+        main(parser.parse_args())
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
@@ -0,0 +1,110 @@
+"""Scale-out test: the load test's user flows against the sharded multi-process mode.
+
+Usage: python benchmarks/cluster_test.py [--processes 1,2,4] [--users 100] [--rounds 1] [--latency 0.2]
+                                         [--backends 2] [--capacity 16]
+
+For each worker count, starts `main.py` with WORKER_PROCESSES set, as its
+own process tree (the webhook ingress plus the workers; 1 is the plain
+single-process webhook bot, for comparison), points it at
+fake_telegram and fake_gradio in this process, runs the users through it
+and reports throughput. Every process shares one SQLite database. The
+fakes and the simulated users share this process, so on a machine with few
+cores they, not the bot, can end up the bottleneck.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from harness import configure
+from fake_gradio import FakeGradio
+from fake_telegram import FakeTelegram
+from load_test import ADMIN_ID, FIRST_USER_ID, LoadTest, percentile
+from aiohttp import ClientSession, TCPConnector
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def run(args, processes):
+    telegram = FakeTelegram()
+    gradio = [FakeGradio(latency=args.latency, failure_rate=0, capacity=args.capacity) for _ in range(args.backends)]
+    await telegram.start()
+    for space in gradio:
+        await space.start()
+    ingress_port = free_port()
+    workdir = configure(telegram, ",".join(f"{space.url}={args.capacity}" for space in gradio), args.backends * args.capacity,
+                        ADMIN_ID=ADMIN_ID, MAX_QUEUE_SIZE=args.users * 2, BOT_MODE="webhook", WORKER_PROCESSES=processes,
+                        WEBHOOK_URL="", WEBHOOK_HOST="127.0.0.1", WEBHOOK_PORT=ingress_port,
+                        WORKER_PORT=random.randrange(20000, 40000, 100), METRICS_PORT=0, RETRY_BASE_DELAY=0.2)
+    import ui
+
+    # Run from the scratch directory, so the processes' log files land there
+    bot = subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")], cwd=workdir,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        await wait_for_port(ingress_port)
+        webhook_url = f"http://127.0.0.1:{ingress_port}/telegram/webhook"
+        async with ClientSession(connector=TCPConnector(limit=0)) as session:
+            test = LoadTest(telegram, session, webhook_url, ui, timeout=args.latency * args.users + 60)
+            # Wait until every worker answers, so start-up is not measured
+            await asyncio.gather(*(test.interact("warm-up", telegram.message_update(user_id, "/help"), user_id, ("sendMessage", None))
+                                   for user_id in range(FIRST_USER_ID - processes, FIRST_USER_ID)))
+            started = time.monotonic()
+            await asyncio.gather(*(test.user(FIRST_USER_ID + i, args.rounds) for i in range(args.users)))
+            elapsed = time.monotonic() - started
+    finally:
+        bot.terminate()
+        bot.wait(30)
+        await telegram.stop()
+        for space in gradio:
+            await space.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    test.latencies.pop("warm-up", None)
+    interactions = sum(len(values) for values in test.latencies.values())
+    p95 = percentile(sorted(test.latencies["generation"]), 95)
+    label = f"{processes} worker processes" if processes > 1 else "Single process"
+    print(f"{label}: {interactions} interactions in {elapsed:.2f}s, {interactions / elapsed:.1f}/s; "
+          f"{test.generated} generations delivered, p95 {p95:.2f}s; {sum(test.timeouts.values())} without a reply")
+    return test.timeouts
+
+
+async def main(args):
+    failed = False
+    for processes in (int(count) for count in args.processes.split(",")):
+        failed |= bool(await run(args, processes))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", default="1,2,4")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--backends", type=int, default=2)
+    parser.add_argument("--capacity", type=int, default=16)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,172 @@
+"""A local stand-in for the DALLE-4K gradio Space, for offline runs of the bot.
+
+Implements the parts of gradio's API the bot uses: /info, /config, the
+queue (POST /queue/join, then the server-sent events of /queue/data with
+the job's place in line, progress and result), POST /cancel, and the file
+route the images are fetched from. Point the bot at it with
+DALLE_BACKENDS=http://127.0.0.1:<port>. `latency`, `failure_rate`,
+`capacity` (GPU slots; extra jobs wait in line, like a Space's queue) and
+`steps` (progress events per job) shape how the fake backend behaves, and
+setting `down` makes it answer 503 like a Space that is restarting. Every
+job that started is counted in `calls`, every cancelled one in `cancelled`.
+"""
+import asyncio
+import itertools
+import json
+import random
+import struct
+import zlib
+from aiohttp import web
+
+PARAMETERS = ["prompt", "negative_prompt", "use_negative_prompt", "seed", "width", "height", "guidance_scale", "randomize_seed", "style"]
+
+
+def tiny_png(seed):
+    # A valid 1x1 PNG whose pixel depends on the seed, so results differ
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    pixel = bytes([0, seed % 256, (seed >> 8) % 256, (seed >> 16) % 256])
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(pixel)) + chunk(b"IEND", b""))
+
+
+class FakeGradio:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.5, failure_rate=0.0, images=1, capacity=None, steps=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.images = images
+        self.capacity = capacity
+        self.steps = steps
+        self._slots = None
+        self.down = False
+        self.calls = 0
+        self.cancelled = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._event_ids = itertools.count(1)
+        self._events = {}  # session_hash -> (event_id, request data)
+        self._waiting = []  # event ids in line for a slot
+        self._cancels = {}  # event_id -> asyncio.Event, set by /cancel
+        self._files = {}  # path -> bytes
+        self._runner = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/info", self._info)
+        app.router.add_get("/config", self._config)
+        app.router.add_post("/queue/join", self._join)
+        app.router.add_get("/queue/data", self._data)
+        app.router.add_post("/cancel", self._cancel)
+        app.router.add_get("/file={path:.*}", self._file)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _info(self, request):
+        if self.down:
+            raise web.HTTPServiceUnavailable()
+        parameters = [{"label": name, "parameter_name": name, "parameter_has_default": False} for name in PARAMETERS]
+        return web.json_response({"named_endpoints": {"/run": {"parameters": parameters, "returns": []}}, "unnamed_endpoints": {}})
+
+    async def _config(self, request):
+        if self.down:
+            raise web.HTTPServiceUnavailable()
+        return web.json_response({"dependencies": [{"id": 0, "api_name": "run"}]})
+
+    async def _join(self, request):
+        if self.down:
+            raise web.HTTPServiceUnavailable()
+        body = await request.json()
+        event_id = str(next(self._event_ids))
+        self._events[body["session_hash"]] = event_id, dict(zip(PARAMETERS, body["data"]))
+        self._cancels[event_id] = asyncio.Event()
+        return web.json_response({"event_id": event_id})
+
+    async def _cancel(self, request):
+        cancel = self._cancels.get((await request.json())["event_id"])
+        if cancel:
+            cancel.set()
+        return web.json_response({"success": True})
+
+    async def _data(self, request):
+        event_id, inputs = self._events.pop(request.query["session_hash"])
+        cancel = self._cancels[event_id]
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(msg, **fields):
+            await response.write(f"data: {json.dumps(dict(fields, msg=msg, event_id=event_id))}\n\n".encode())
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        acquired = False
+        try:
+            if self.capacity:
+                if self._slots is None:
+                    self._slots = asyncio.Semaphore(self.capacity)
+                self._waiting.append(event_id)
+                try:
+                    while not acquired and not cancel.is_set():
+                        rank = self._waiting.index(event_id)
+                        await send("estimation", rank=rank, queue_size=len(self._waiting), rank_eta=(rank + 1) * self.latency)
+                        try:
+                            await asyncio.wait_for(self._slots.acquire(), 0.5)
+                            acquired = True
+                        except asyncio.TimeoutError:
+                            pass
+                finally:
+                    self._waiting.remove(event_id)
+            if not cancel.is_set():
+                self.calls += 1
+                await send("process_starts", eta=self.latency)
+                for step in range(self.steps):
+                    await self._pause(cancel, self.latency / self.steps)
+                    if cancel.is_set():
+                        break
+                    await send("progress", progress_data=[{"index": step + 1, "length": self.steps, "unit": "steps", "progress": None, "desc": None}])
+                if not self.steps:
+                    await self._pause(cancel, self.latency)
+            if cancel.is_set():
+                self.cancelled += 1
+                return response
+            if random.random() < self.failure_rate:
+                await send("process_completed", success=False, output={"error": "GPU task aborted"})
+                return response
+            seed = random.randint(0, 2147483647) if inputs.get("randomize_seed") else int(inputs.get("seed") or 0)
+            gallery = []
+            for i in range(self.images):
+                path = f"/tmp/gradio/{seed}_{i}.png"
+                self._files[path] = tiny_png(seed + i)
+                gallery.append({"image": {"path": path, "url": f"{self.url}/file={path}"}, "caption": None})
+            await send("process_completed", success=True, output={"data": [gallery, seed]})
+            return response
+        finally:
+            if acquired:
+                self._slots.release()
+            self._cancels.pop(event_id, None)
+            self.in_flight -= 1
+
+    async def _pause(self, cancel, seconds):
+        # Like a GPU step: runs its time unless the job is cancelled
+        try:
+            await asyncio.wait_for(cancel.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _file(self, request):
+        data = self._files.get(request.match_info["path"])
+        if data is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=data, content_type="image/png")
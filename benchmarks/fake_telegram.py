@@ -0,0 +1,193 @@
+"""A local stand-in for the Telegram Bot API, for offline runs of the bot.
+
+Point the bot at it with TELEGRAM_API_URL=http://127.0.0.1:<port>. Every
+call but getUpdates is recorded in `calls` as (method, params) and answered
+with a canned result shaped like the real one, after `latency` seconds;
+`message_ids` reads back the ids of the messages it answered with.
+`post_update` plays Telegram's side of a webhook by POSTing an update to
+the bot, and `queue_update` keeps one for a polling bot's getUpdates.
+"""
+import asyncio
+import itertools
+import json
+import time
+from urllib.parse import parse_qsl
+from aiohttp import ClientSession, web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "DALLE-4K", "username": "dalle4k_test_bot"}
+
+
+class FakeTelegram:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.calls = []
+        self.results = []  # what each of `calls` was answered with
+        self.webhook = None
+        self._message_ids = itertools.count(1000)
+        self._file_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._runner = None
+        self._waiters = []
+        self._updates = []  # queued for getUpdates, oldest first
+        self._updates_queued = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        app.router.add_get("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def calls_to(self, method, chat_id=None):
+        return [params for name, params in self.calls if self._matches(name, params, method, chat_id)]
+
+    def message_ids(self, method, chat_id=None, match=None):
+        return [result["message_id"] for (name, params), result in zip(self.calls, self.results)
+                if self._matches(name, params, method, chat_id, match) and isinstance(result, dict) and "message_id" in result]
+
+    async def wait_for(self, method, chat_id=None, count=1, match=None, timeout=30, since=0):
+        # Resolves once `count` calls of `method` (to `chat_id`, passing `match`)
+        # were made, counting from the call with index `since`
+        seen = sum(1 for name, params in self.calls[since:] if self._matches(name, params, method, chat_id, match))
+        if seen >= count:
+            return
+        future = asyncio.get_running_loop().create_future()
+        waiter = [method, chat_id, match, count - seen, future]
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    @staticmethod
+    def _matches(name, params, method, chat_id=None, match=None):
+        return (name == method and (chat_id is None or str(params.get("chat_id")) == str(chat_id))
+                and (match is None or match(params)))
+
+    def _message(self, chat_id, **fields):
+        return dict({
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+        }, **fields)
+
+    def _document(self):
+        file_id = next(self._file_ids)
+        return {"file_id": f"doc{file_id}", "file_unique_id": f"udoc{file_id}", "file_name": f"{file_id}.png"}
+
+    def _result(self, method, params):
+        chat_id = params.get("chat_id", 0)
+        if method == "getMe":
+            return BOT_USER
+        if method in ("setWebhook", "deleteWebhook", "answerCallbackQuery"):
+            if method == "setWebhook":
+                self.webhook = params.get("url")
+            return True
+        if method == "sendMessage":
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "editMessageText":
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "sendDocument":
+            return self._message(chat_id, document=self._document())
+        if method == "sendPhoto":
+            return self._message(chat_id, photo=[{"file_id": "photo", "file_unique_id": "uphoto", "width": 1, "height": 1}])
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            return [self._message(chat_id, document=self._document()) for _ in media]
+        return True
+
+    async def _get_updates(self, params):
+        # Long polling: waits up to `timeout` seconds for an update at or after `offset`
+        offset = int(params.get("offset", 0))
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates and float(params.get("timeout", 0)) > 0:
+            self._updates_queued = self._updates_queued or asyncio.Event()
+            self._updates_queued.clear()
+            try:
+                await asyncio.wait_for(self._updates_queued.wait(), float(params["timeout"]))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get("limit", 100))]
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        params = dict(request.query)
+        if request.method == "POST":
+            # Uploaded files come back as FileField objects; keep only their names
+            for key, value in (await request.post()).items():
+                params[key] = getattr(value, "filename", None) or value
+        elif request.can_read_body:
+            # The async client sends plain calls as GET with a form body
+            params.update(parse_qsl(await request.text()))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+        result = self._result(method, params)
+        self.calls.append((method, params))
+        self.results.append(result)
+        for waiter in list(self._waiters):
+            if self._matches(method, params, *waiter[:3]):
+                waiter[3] -= 1
+                if waiter[3] <= 0:
+                    self._waiters.remove(waiter)
+                    if not waiter[4].done():
+                        waiter[4].set_result(None)
+        return web.json_response({"ok": True, "result": result})
+
+    # Updates
+
+    def message_update(self, user_id, text, first_name="Tester"):
+        user = {"id": user_id, "is_bot": False, "first_name": first_name, "username": f"user{user_id}"}
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def callback_update(self, user_id, data, message_id=None):
+        # A button pressed on the message `message_id`, or on a new one
+        user = {"id": user_id, "is_bot": False, "first_name": "Tester", "username": f"user{user_id}"}
+        message = self._message(user_id, text="menu")
+        if message_id is not None:
+            message["message_id"] = int(message_id)
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": user,
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": message,
+            },
+        }
+
+    def queue_update(self, update):
+        self._updates.append(update)
+        if self._updates_queued:
+            self._updates_queued.set()
+
+    async def post_update(self, session: ClientSession, webhook_url, update, secret=None):
+        headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+        async with session.post(webhook_url, json=update, headers=headers) as response:
+            return response.status
@@ -0,0 +1,147 @@
+"""Runs the bot in-process against the local fakes.
+
+config.py reads the environment at import time, so `configure` has to run
+before anything imports the bot's modules; `running_bot` then imports
+async_main, starts it like serve() does and serves the webhook on a free
+local port, and `running_polling_bot` imports main and polls the fake Bot
+API from a thread the way main.py's __main__ does. `batch_cancel_check`
+and `stale_buttons_check` work with either.
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from contextlib import asynccontextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aiohttp import web  # noqa: E402
+
+SECRET = "benchmark-secret"
+
+
+def configure(telegram, backends, workers, **overrides):
+    # backends: "url=N,..." as DALLE_BACKENDS takes it. Returns the scratch directory.
+    workdir = tempfile.mkdtemp(prefix="dalle_bench_")
+    os.environ.update({
+        "BOT_TOKEN": "123:TEST",
+        "ADMIN_ID": "0",
+        "DB_PATH": os.path.join(workdir, "users.db"),
+        "CACHE_DIR": os.path.join(workdir, "cache"),
+        "TELEGRAM_API_URL": telegram.url,
+        "DALLE_BACKENDS": backends,
+        "WEBHOOK_SECRET": SECRET,
+        "ASYNC_GENERATION_WORKERS": str(workers),
+    })
+    os.environ.update({name: str(value) for name, value in overrides.items()})
+    return workdir
+
+
+@asynccontextmanager
+async def running_bot(workdir):
+    # Yields (async_main, webhook_url)
+    import async_main
+
+    async_main.postprocessor.start()
+    await asyncio.to_thread(async_main.initialize_database)
+    async_main.cost_model.load(await asyncio.to_thread(async_main.get_recent_latencies, async_main.COST_HISTORY))
+    async_main.user_store.start()
+    async_main.conversations.start()
+    async_main.job_queue.start()
+    async_main.backend_router.start()
+    runner = web.AppRunner(async_main.create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    webhook_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{async_main.WEBHOOK_PATH}"
+    try:
+        yield async_main, webhook_url
+    finally:
+        await runner.cleanup()
+        await async_main.job_queue.stop()
+        if async_main.background_tasks:
+            await asyncio.gather(*async_main.background_tasks, return_exceptions=True)
+        await async_main.backend_router.stop()
+        await async_main.bot.close_session()
+        await asyncio.to_thread(async_main.user_store.stop)
+        await asyncio.to_thread(async_main.conversations.stop)
+        async_main.postprocessor.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+@asynccontextmanager
+async def running_polling_bot(workdir):
+    # Yields main. Its backend is whatever the caller puts in place of
+    # main.backend_router.generate: gradio_client can't talk to fake_gradio,
+    # so the probe thread is not started either. The bot's threads call the
+    # fakes served on this loop, so everything that waits for them runs in
+    # to_thread.
+    import main
+
+    main.postprocessor.start()
+    await asyncio.to_thread(main.initialize_database)
+    main.cost_model.load(await asyncio.to_thread(main.get_recent_latencies, main.COST_HISTORY))
+    main.user_store.start()
+    main.conversations.start()
+    main.job_queue.start()
+    polling = threading.Thread(target=main.bot.polling, name="polling", daemon=True,
+                               kwargs={"non_stop": True, "timeout": 5, "long_polling_timeout": 1})
+    polling.start()
+    try:
+        yield main
+    finally:
+        main.bot.stop_polling()
+        await asyncio.to_thread(polling.join)
+        await asyncio.to_thread(main.job_queue.stop)
+        await asyncio.to_thread(main.user_store.stop)
+        await asyncio.to_thread(main.conversations.stop)
+        main.postprocessor.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+async def batch_cancel_check(telegram, send, bot, user_id, backend_calls, size=6, after=0.35):
+    # One user asks for `size` variants and presses Cancel on the status
+    # message `after` seconds later. `send` hands the bot an update and
+    # `backend_calls` counts the generations the backend started. Returns
+    # how many started once the cancel was acknowledged: none should.
+    ui = bot.ui
+    await send(telegram.message_update(user_id, "/start"))
+    await telegram.wait_for("sendMessage", user_id)
+    await send(telegram.message_update(user_id, "a lighthouse in a storm"))
+    await telegram.wait_for("sendMessage", user_id, match=lambda params: params.get("text") == ui.NEGATIVE_PROMPT_CHOICE_TEXT)
+
+    def cancellable(params):
+        return "cancel_generation" in params.get("reply_markup", "")
+
+    since = len(telegram.calls)
+    await send(telegram.message_update(user_id, f"/generate {size}"))
+    await telegram.wait_for("sendMessage", user_id, match=cancellable, since=since)
+    status_id = str(telegram.message_ids("sendMessage", user_id, match=cancellable)[-1])
+    await asyncio.sleep(after)
+    await send(telegram.callback_update(user_id, "cancel_generation", status_id))
+    await telegram.wait_for("answerCallbackQuery", match=lambda params: params.get("text") == ui.CANCELLING_TEXT)
+    started = backend_calls()
+    # The batch is over once its status message offers to try again
+    await telegram.wait_for("editMessageText", user_id, since=since,
+                            match=lambda params: params.get("message_id") == status_id and "retry_generation" in params.get("reply_markup", ""))
+    return backend_calls() - started
+
+
+async def stale_buttons_check(telegram, send, user_id):
+    # Presses history buttons with payloads no current keyboard has (an
+    # older version's, or forged ones). Returns how many got no answer with
+    # a text: each should be answered, not left spinning.
+    stale = ["history_abc", "history_-1", "resend_", "resend_x", "remix_1_2", "remix_99999999999999999999999"]
+    answered = 0
+    for data in stale:
+        update = telegram.callback_update(user_id, data)
+        query_id = update["callback_query"]["id"]
+        await send(update)
+        try:
+            await telegram.wait_for("answerCallbackQuery", timeout=5,
+                                    match=lambda params: params.get("callback_query_id") == query_id and params.get("text"))
+            answered += 1
+        except asyncio.TimeoutError:
+            pass
+    return len(stale) - answered
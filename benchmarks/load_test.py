@@ -0,0 +1,239 @@
+"""Load test: N simulated users walking through the bot's real flows, offline.
+
+Usage: python benchmarks/load_test.py [--users 200] [--rounds 2] [--latency 2.0] [--failure-rate 0.05]
+                                      [--telegram-latency 0.02] [--backends 2] [--capacity 16]
+                                      [--broadcast-rate 200] [--tracemalloc] [--max-p95 SECONDS]
+
+Every user sends /start, then per round: a prompt, a negative prompt (the
+default for even user ids, a custom one typed in for odd ones) and waits
+for the image; then opens the settings, types a new size and picks a
+style. Meanwhile the admin broadcasts a message to everybody. The bot is
+the webhook runtime (async_main) talking to fake_telegram and fake_gradio,
+which add `--telegram-latency` to every Bot API call and `--latency` to
+every generation, aborting `--failure-rate` of them.
+
+An interaction is one update sent to the bot until the reply it causes
+arrives; its latency is reported per kind with p50/p95/p99. SQL
+statements are counted through sqlite3's trace callback. With --max-p95
+the exit status is 1 when any kind's p95 is over the limit, or when an
+interaction got no reply, so the run can gate a deploy.
+"""
+import argparse
+import asyncio
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from harness import SECRET, configure, running_bot
+from fake_gradio import FakeGradio
+from fake_telegram import FakeTelegram
+from aiohttp import ClientSession, TCPConnector
+
+ADMIN_ID = 1
+FIRST_USER_ID = 10_000
+BROADCAST_TEXT = "Load test broadcast: new styles are live!"
+STYLES = ["Photo", "Cinematic", "Anime", "3D Model"]
+
+
+def percentile(values, p):
+    # Nearest rank on a sorted list
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+class SqlCounter:
+    """Counts the statements every db connection runs, by leading keyword."""
+
+    def __init__(self):
+        self.statements = Counter()
+        self._lock = threading.Lock()
+
+    def install(self, db):
+        connect = db._connect
+
+        def traced_connect():
+            holder = connect()
+            holder.conn.set_trace_callback(self._trace)
+            return holder
+        db._connect = traced_connect
+
+    def _trace(self, sql):
+        sql = sql.lstrip()
+        if sql.startswith('--'):
+            return  # statements inside triggers are reported as comments
+        with self._lock:
+            self.statements[sql.split(None, 1)[0].rstrip(';').upper()] += 1
+
+    def reset(self):
+        with self._lock:
+            self.statements.clear()
+
+    def total(self):
+        with self._lock:
+            return sum(self.statements.values())
+
+
+class LoadTest:
+    def __init__(self, telegram, session, webhook_url, ui, timeout):
+        self.telegram = telegram
+        self.session = session
+        self.webhook_url = webhook_url
+        self.ui = ui
+        self.timeout = timeout
+        self.latencies = defaultdict(list)  # kind -> seconds
+        self.timeouts = Counter()
+        self.generated = 0
+        self.failed = 0
+
+    async def interact(self, kind, update, chat_id, *expected):
+        # expected: (method, match) pairs; the first reply matching one of them ends the interaction
+        since = len(self.telegram.calls)
+        started = time.monotonic()
+        await self.telegram.post_update(self.session, self.webhook_url, update, SECRET)
+        waits = [asyncio.create_task(self.telegram.wait_for(method, chat_id, match=match, timeout=self.timeout, since=since))
+                 for method, match in expected]
+        done, pending = await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for index, task in enumerate(waits):
+            if task in done and task.exception() is None:
+                self.latencies[kind].append(time.monotonic() - started)
+                return index
+        self.timeouts[kind] += 1
+        return None
+
+    def text_is(self, *texts):
+        return lambda params: params.get("text") in texts
+
+    async def user(self, user_id, rounds):
+        telegram, ui = self.telegram, self.ui
+        await self.interact("start", telegram.message_update(user_id, "/start"), user_id,
+                            ("sendMessage", self.text_is(ui.WELCOME_TEXT, ui.welcome_back_text("Tester"))))
+        for round_number in range(rounds):
+            prompt = f"a lighthouse at dusk, user {user_id}, take {round_number}"
+            await self.interact("prompt", telegram.message_update(user_id, prompt), user_id,
+                                ("sendMessage", self.text_is(ui.NEGATIVE_PROMPT_CHOICE_TEXT)))
+            finished = (("sendMessage", self.text_is(ui.AFTER_GENERATION_TEXT)),
+                        ("editMessageText", lambda params: "retry_generation" in params.get("reply_markup", "")))
+            if user_id % 2:
+                await self.interact("negative prompt", telegram.callback_update(user_id, "add_custom_negative"), user_id,
+                                    ("editMessageText", self.text_is(ui.CUSTOM_NEGATIVE_TEXT)))
+                outcome = await self.interact("generation", telegram.message_update(user_id, "blurry, watermark"), user_id, *finished)
+            else:
+                outcome = await self.interact("generation", telegram.callback_update(user_id, "use_default_negative"), user_id, *finished)
+            if outcome == 0:
+                self.generated += 1
+            elif outcome == 1:
+                self.failed += 1
+
+            await self.interact("settings", telegram.callback_update(user_id, "settings"), user_id,
+                                ("sendMessage", lambda params: params.get("text", "").startswith("🎨 Your Creative Palette")))
+            await self.interact("settings", telegram.callback_update(user_id, "set_size"), user_id,
+                                ("editMessageText", self.text_is(ui.SIZE_TEXT)))
+            await self.interact("settings", telegram.message_update(user_id, "1024 1024"), user_id,
+                                ("sendMessage", lambda params: params.get("text", "").startswith("Perfect!")))
+            await self.interact("settings", telegram.callback_update(user_id, "set_style"), user_id,
+                                ("editMessageText", self.text_is(ui.STYLE_TEXT)))
+            await self.interact("settings", telegram.callback_update(user_id, f"style_{STYLES[(user_id + round_number) % len(STYLES)]}"),
+                                user_id, ("editMessageText", self.text_is(ui.STYLE_SET_TEXT)))
+
+    async def broadcast(self, delay):
+        # Starts once some users exist; ends when the admin is told it is complete
+        await asyncio.sleep(delay)
+        telegram = self.telegram
+        await self.interact("broadcast", telegram.message_update(ADMIN_ID, "/broadcast"), ADMIN_ID,
+                            ("sendMessage", self.text_is(self.ui.BROADCAST_PROMPT_TEXT)))
+        await self.interact("broadcast delivery", telegram.message_update(ADMIN_ID, BROADCAST_TEXT), ADMIN_ID,
+                            ("editMessageText", lambda params: params.get("text", "").startswith("Broadcast complete")))
+        return sum(1 for params in telegram.calls_to("sendMessage") if params.get("text") == BROADCAST_TEXT)
+
+
+def report(args, test, elapsed, sql, interactions, gradio, bot, delivered):
+    from metrics import STAGE_SECONDS  # config is only importable once configure() ran
+    print(f"{args.users} users x {args.rounds} rounds, backend latency {args.latency}s, {args.failure_rate:.0%} aborted, "
+          f"Bot API latency {args.telegram_latency}s, {args.backends} backends x {args.capacity} slots")
+    print(f"Finished in {elapsed:.2f}s: {interactions / elapsed:.1f} interactions/s, {test.generated / elapsed:.2f} generations/s")
+    print(f"Generations: {test.generated} delivered, {test.failed} failed; backend calls: {sum(space.calls for space in gradio)}, "
+          f"retries: {bot.backend_router.stats()['retries']}")
+    print(f"Broadcast reached {delivered} chats")
+    print(f"{'interaction':<20}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'no reply':>10}")
+    for kind, values in test.latencies.items():
+        values.sort()
+        print(f"{kind:<20}{len(values):>7}{percentile(values, 50):>9.3f}{percentile(values, 95):>9.3f}"
+              f"{percentile(values, 99):>9.3f}{values[-1]:>9.3f}{test.timeouts[kind]:>10}")
+    print("Mean seconds per stage: " + ", ".join(f"{stage} {total / count:.3f} ({count}x)"
+                                                 for (stage,), (count, total) in sorted(STAGE_SECONDS.totals().items())))
+    statements = sql.total()
+    print(f"SQL statements: {statements} ({statements / max(interactions, 1):.2f} per interaction): "
+          + ", ".join(f"{verb} {count}" for verb, count in sql.statements.most_common()))
+    user_stats = bot.user_store.stats()
+    print(f"User store: {user_stats['hits']} hits, {user_stats['misses']} misses, "
+          f"{user_stats['rows_written']} rows written in {user_stats['flushes']} flushes")
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB", end="")
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"; Python heap {current / 2**20:.1f} MB now, {peak / 2**20:.1f} MB at peak", end="")
+    print()
+
+
+async def main(args):
+    if args.tracemalloc:
+        tracemalloc.start()
+    telegram = FakeTelegram(latency=args.telegram_latency)
+    gradio = [FakeGradio(latency=args.latency, failure_rate=args.failure_rate, capacity=args.capacity) for _ in range(args.backends)]
+    await telegram.start()
+    for space in gradio:
+        await space.start()
+    workdir = configure(telegram, ",".join(f"{space.url}={args.capacity}" for space in gradio), args.backends * args.capacity,
+                        ADMIN_ID=ADMIN_ID, MAX_QUEUE_SIZE=args.users * 2, BROADCAST_RATE=args.broadcast_rate,
+                        RETRY_BASE_DELAY=0.2, BACKEND_PROBE_INTERVAL=5)
+    import db
+    sql = SqlCounter()
+    sql.install(db)
+
+    # Generous enough for the whole queue to drain through the backends
+    timeout = args.latency * args.users * args.rounds / (args.backends * args.capacity) * 2 + 60
+    try:
+        async with running_bot(workdir) as (bot, webhook_url), ClientSession(connector=TCPConnector(limit=0)) as session:
+            test = LoadTest(telegram, session, webhook_url, bot.ui, timeout)
+            sql.reset()  # leave out the schema setup
+            started = time.monotonic()
+            results = await asyncio.gather(test.broadcast(args.latency), *(test.user(FIRST_USER_ID + i, args.rounds) for i in range(args.users)))
+            elapsed = time.monotonic() - started
+            await asyncio.to_thread(bot.user_store.flush)
+            interactions = sum(len(values) for values in test.latencies.values()) + sum(test.timeouts.values())
+            report(args, test, elapsed, sql, interactions, gradio, bot, results[0])
+    finally:
+        await telegram.stop()
+        for space in gradio:
+            await space.stop()
+
+    if test.timeouts:
+        print(f"FAIL: {sum(test.timeouts.values())} interactions got no reply within {timeout:.0f}s")
+        return 1
+    if args.max_p95 is not None:
+        slow = {kind: percentile(values, 95) for kind, values in test.latencies.items()
+                if kind != "broadcast delivery" and percentile(values, 95) > args.max_p95}
+        if slow:
+            print("FAIL: p95 over " + f"{args.max_p95}s: " + ", ".join(f"{kind} {p95:.2f}s" for kind, p95 in slow.items()))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=2.0)
+    parser.add_argument("--failure-rate", type=float, default=0.05)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--backends", type=int, default=2)
+    parser.add_argument("--capacity", type=int, default=16)
+    parser.add_argument("--broadcast-rate", type=int, default=200)
+    parser.add_argument("--tracemalloc", action="store_true")
+    parser.add_argument("--max-p95", type=float, default=None, help="seconds; excludes the broadcast delivery")
+    sys.exit(asyncio.run(main(parser.parse_args())))
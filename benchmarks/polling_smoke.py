@@ -0,0 +1,105 @@
+"""Drive the polling bot end to end against the fake Bot API, with no network.
+
+Usage: python benchmarks/polling_smoke.py [--users 20] [--latency 1.0] [--workers 4]
+
+Runs main.py's runtime, the default BOT_MODE: telebot's polling loop
+fetches the updates from fake_telegram, handlers run on its worker threads
+and generations on the job queue's. gradio_client can't talk to
+fake_gradio, so backend_router.generate is replaced by a stub that takes
+`latency` seconds, or less if it is cancelled. Every user sends /start, a
+prompt and "Use default", all at once, and the run waits until each one
+has received a document. Last, one more user asks for a batch and cancels
+it, then presses history buttons with malformed payloads; the run fails
+if the backend starts a generation after the cancel or a button goes
+unanswered.
+"""
+import argparse
+import asyncio
+import sys
+import threading
+import time
+from harness import batch_cancel_check, configure, running_polling_bot, stale_buttons_check
+from fake_gradio import tiny_png
+from fake_telegram import FakeTelegram
+
+NO_BACKEND = "http://127.0.0.1:9"  # never contacted: the stub stands in for it
+CANCEL_USER_ID = 5
+
+
+class StubBackend:
+    """Stands in for BackendRouter.generate, counting the generations it starts."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.cancelled = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def generate(self, progress=None, cancel=None, **params):
+        from jobs import JobCancelled
+
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if cancel is not None and cancel.wait(self.latency):
+                with self._lock:
+                    self.cancelled += 1
+                raise JobCancelled()
+            if cancel is None:
+                time.sleep(self.latency)
+            return [tiny_png(params["seed"])], params["seed"]
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+async def user_session(telegram, user_id, prompt_reply):
+    telegram.queue_update(telegram.message_update(user_id, "/start"))
+    await telegram.wait_for("sendMessage", user_id)
+    prompt = f"a lighthouse at dusk #{user_id}"
+    telegram.queue_update(telegram.message_update(user_id, prompt))
+    await telegram.wait_for("sendMessage", user_id, match=lambda params: params.get("text") == prompt_reply)
+    telegram.queue_update(telegram.callback_update(user_id, "use_default_negative"))
+
+
+async def main(args):
+    telegram = FakeTelegram()
+    await telegram.start()
+    workdir = configure(telegram, f"{NO_BACKEND}={args.workers}", args.workers, GENERATION_WORKERS=args.workers,
+                        MAX_QUEUE_SIZE=max(args.users * 2, 100))
+    backend = StubBackend(args.latency)
+
+    try:
+        async with running_polling_bot(workdir) as main:
+            main.backend_router.generate = backend.generate
+            started = time.monotonic()
+            await asyncio.gather(*(user_session(telegram, 10_000 + i, main.ui.NEGATIVE_PROMPT_CHOICE_TEXT) for i in range(args.users)))
+            await telegram.wait_for("sendDocument", count=args.users, timeout=args.latency * args.users + 60)
+            elapsed = time.monotonic() - started
+            print(f"{args.users} users, backend latency {args.latency}s, {args.workers} generation workers")
+            print(f"All documents delivered in {elapsed:.2f}s; peak concurrent backend calls: {backend.max_in_flight}")
+            print(f"Bot API calls: {len(telegram.calls)}, backend calls: {backend.calls}")
+
+            async def send(update):
+                telegram.queue_update(update)
+
+            late = await batch_cancel_check(telegram, send, main, CANCEL_USER_ID, lambda: backend.calls)
+            print(f"Batch cancelled: {late} backend generations started after the Cancel")
+            unanswered = await stale_buttons_check(telegram, send, CANCEL_USER_ID)
+            print(f"Stale history buttons left unanswered: {unanswered}")
+    finally:
+        await telegram.stop()
+    if late or unanswered:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--workers", type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,83 @@
+"""Drive the webhook bot end to end against local fakes, with no network.
+
+Usage: python benchmarks/webhook_smoke.py [--users 200] [--latency 2.0] [--workers 256] [--same-request]
+
+Starts the fake Bot API and fake gradio Space, points async_main at them,
+then has every user send /start, a prompt and "Use default", all at once,
+and waits until each one has received a document. Since generations are
+coroutines, all of them can wait on the backend together. With
+--same-request every user first picks seed 42 and then sends one shared
+prompt, so identical jobs should share a single backend call. Last, one
+more user asks for a batch and cancels it, then presses history buttons
+with malformed payloads; the run fails if the backend starts a generation
+after the cancel or a button goes unanswered.
+"""
+import argparse
+import asyncio
+import sys
+import time
+from harness import SECRET, batch_cancel_check, configure, running_bot, stale_buttons_check
+from fake_gradio import FakeGradio
+from fake_telegram import FakeTelegram
+from aiohttp import ClientSession
+
+CANCEL_USER_ID = 5
+
+
+async def user_session(telegram, session, webhook_url, user_id, prompt_reply, same_request):
+    await telegram.post_update(session, webhook_url, telegram.message_update(user_id, "/start"), SECRET)
+    prompt = f"a lighthouse at dusk #{user_id}"
+    if same_request:
+        prompt = "a lighthouse at dusk"
+        await telegram.wait_for("sendMessage", user_id)
+        await telegram.post_update(session, webhook_url, telegram.callback_update(user_id, "set_seed"), SECRET)
+        await telegram.wait_for("editMessageText", user_id)
+        await telegram.post_update(session, webhook_url, telegram.message_update(user_id, "42"), SECRET)
+        await telegram.wait_for("sendMessage", user_id, count=2)
+    await telegram.post_update(session, webhook_url, telegram.message_update(user_id, prompt), SECRET)
+    # The prompt is stored before the bot asks about the negative prompt
+    await telegram.wait_for("sendMessage", user_id, match=lambda params: params.get("text") == prompt_reply)
+    await telegram.post_update(session, webhook_url, telegram.callback_update(user_id, "use_default_negative"), SECRET)
+
+
+async def main(args):
+    telegram = FakeTelegram()
+    gradio = FakeGradio(latency=args.latency)
+    await telegram.start()
+    await gradio.start()
+    workdir = configure(telegram, f"{gradio.url}={args.workers}", args.workers, MAX_QUEUE_SIZE=max(args.users * 2, 100))
+
+    try:
+        async with running_bot(workdir) as (async_main, webhook_url), ClientSession() as session:
+            assert await telegram.post_update(session, webhook_url, telegram.message_update(1, "/start"), "wrong") == 403
+            started = time.monotonic()
+            await asyncio.gather(*(user_session(telegram, session, webhook_url, 10_000 + i, async_main.ui.NEGATIVE_PROMPT_CHOICE_TEXT,
+                                                 args.same_request) for i in range(args.users)))
+            await telegram.wait_for("sendDocument", count=args.users, timeout=args.latency * args.users + 60)
+            elapsed = time.monotonic() - started
+            print(f"{args.users} users, backend latency {args.latency}s, {args.workers} async workers")
+            print(f"All documents delivered in {elapsed:.2f}s; peak concurrent backend calls: {gradio.max_in_flight}")
+            print(f"Bot API calls: {len(telegram.calls)}, backend calls: {gradio.calls}, "
+                  f"shared generations: {async_main.generation_flight.stats()['followers']}")
+
+            async def send(update):
+                await telegram.post_update(session, webhook_url, update, SECRET)
+
+            late = await batch_cancel_check(telegram, send, async_main, CANCEL_USER_ID, lambda: gradio.calls)
+            print(f"Batch cancelled: {late} backend generations started after the Cancel")
+            unanswered = await stale_buttons_check(telegram, send, CANCEL_USER_ID)
+            print(f"Stale history buttons left unanswered: {unanswered}")
+    finally:
+        await telegram.stop()
+        await gradio.stop()
+    if late or unanswered:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=2.0)
+    parser.add_argument("--workers", type=int, default=256)
+    parser.add_argument("--same-request", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,107 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from telebot.apihelper import ApiTelegramException
+from db import (get_user_ids_after, get_counter, create_broadcast, get_broadcast, get_running_broadcast_ids,
+                checkpoint_broadcast, finish_broadcast)
+from ratelimit import TokenBucket
+from logger import logger
+
+BATCH_SIZE = 200
+MAX_RETRIES = 5
+PROGRESS_INTERVAL = 5
+
+
+class BroadcastEngine:
+    """Sends admin broadcasts in the background.
+
+    Recipients are read page by page with a keyset cursor and sent through a
+    small thread pool that shares one token bucket, so all broadcasts
+    together stay under Telegram's global limit. After every page the cursor
+    and counters are checkpointed in SQLite; an interrupted broadcast resumes
+    from its last checkpoint, and at most one page can be delivered twice.
+    """
+
+    def __init__(self, bot, rate=25, workers=8):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+
+    def start(self, admin_chat_id, content_type, text=None, file_id=None, caption=None):
+        status_msg = self.bot.send_message(admin_chat_id, "📣 Broadcast queued, starting now...")
+        broadcast_id = create_broadcast(admin_chat_id, status_msg.message_id, content_type, text, file_id, caption)
+        self._spawn(broadcast_id)
+        return broadcast_id
+
+    def resume_unfinished(self):
+        for broadcast_id in get_running_broadcast_ids():
+            logger.info("Resuming broadcast %s", broadcast_id)
+            self._spawn(broadcast_id)
+
+    def _spawn(self, broadcast_id):
+        threading.Thread(target=self._run, args=(broadcast_id,), name=f"broadcast-{broadcast_id}", daemon=True).start()
+
+    def _send(self, broadcast, user_id):
+        for attempt in range(MAX_RETRIES):
+            self.bucket.acquire()
+            try:
+                if broadcast['content_type'] == 'photo':
+                    self.bot.send_photo(user_id, broadcast['file_id'], caption=broadcast['caption'])
+                else:
+                    self.bot.send_message(user_id, broadcast['text'])
+                return True
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                    logger.warning("Broadcast %s hit the rate limit, pausing for %ss", broadcast['id'], retry_after)
+                    self.bucket.pause(retry_after)
+                    continue
+                logger.error("Failed to send broadcast to user %s: %s", user_id, e)
+                return False
+            except Exception as e:
+                logger.error("Failed to send broadcast to user %s: %s", user_id, e)
+                return False
+        logger.error("Failed to send broadcast to user %s: still rate limited after %s attempts", user_id, MAX_RETRIES)
+        return False
+
+    def _report(self, broadcast, sent, failed, total, started, done=False):
+        elapsed = max(time.monotonic() - started, 0.001)
+        processed = sent + failed - broadcast['sent'] - broadcast['failed']
+        if done:
+            text = f"Broadcast complete!\n✅ Successfully delivered: {sent}\n❌ Undelivered: {failed}"
+        else:
+            text = (f"📣 Broadcasting... {sent + failed}/{total}\n"
+                    f"✅ Delivered: {sent}\n❌ Undelivered: {failed}\n"
+                    f"⚡ {processed / elapsed:.1f} messages/s")
+        try:
+            self.bot.edit_message_text(text, broadcast['admin_chat_id'], broadcast['status_message_id'])
+        except Exception as e:
+            logger.warning("Could not update progress of broadcast %s: %s", broadcast['id'], e)
+
+    def _run(self, broadcast_id):
+        broadcast = get_broadcast(broadcast_id)
+        cursor, sent, failed = broadcast['last_user_id'], broadcast['sent'], broadcast['failed']
+        total = get_counter('users')
+        started = last_report = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"broadcast-{broadcast_id}") as pool:
+                while True:
+                    user_ids = get_user_ids_after(cursor, BATCH_SIZE)
+                    if not user_ids:
+                        break
+                    for delivered in pool.map(lambda user_id: self._send(broadcast, user_id), user_ids):
+                        if delivered:
+                            sent += 1
+                        else:
+                            failed += 1
+                    cursor = user_ids[-1]
+                    checkpoint_broadcast(broadcast_id, cursor, sent, failed)
+                    if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                        self._report(broadcast, sent, failed, total, started)
+                        last_report = time.monotonic()
+            finish_broadcast(broadcast_id)
+            self._report(broadcast, sent, failed, total, started, done=True)
+            logger.info("Broadcast %s finished: %s delivered, %s undelivered", broadcast_id, sent, failed)
+        except Exception as e:
+            # Left as 'running' so the next start picks it up from the checkpoint
+            logger.error("Broadcast %s stopped at user %s: %s", broadcast_id, cursor, e)
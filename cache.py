@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from logger import logger
+
+
+class CachedResult:
+    __slots__ = ('key', 'seed', 'paths', 'file_ids')
+
+    def __init__(self, key, seed, paths, file_ids):
+        self.key = key
+        self.seed = seed
+        self.paths = paths
+        self.file_ids = file_ids
+
+
+class ResultCache:
+    """Disk-backed LRU cache of finished generations, keyed by their parameters.
+
+    Only deterministic (fixed-seed) generations belong here. Each entry keeps
+    the image files plus the Telegram file_ids of the first delivery, so a hit
+    can be re-sent without uploading anything. `output` describes how the
+    delivered files are encoded and goes into every key, so a hit never
+    re-sends files made with other output settings.
+    """
+
+    def __init__(self, directory, max_bytes, output=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.output = output
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (bytes on disk, image count), least recently used first
+        self._bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def key_for(self, user, seed):
+        # The key of `user`'s settings (a UserProfile, or anything with its
+        # generation fields) generated with `seed`
+        params = [user.prompt.strip(), (user.negative_prompt or '').strip(), user.style, int(user.width), int(user.height),
+                  float(user.guidance_scale), int(seed), self.output]
+        return hashlib.sha256(json.dumps(params, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            try:
+                meta = self._read_meta(key)
+            except (OSError, ValueError) as e:
+                logger.warning("Dropping unreadable cache entry %s: %s", key, e)
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        # Keep the LRU order across restarts
+        try:
+            os.utime(self._meta_path(key))
+        except OSError:
+            pass
+        return CachedResult(key, meta['seed'], [self._image_path(key, i) for i in range(meta['images'])], meta.get('file_ids'))
+
+    def put(self, key, images, seed):
+        size = sum(len(image) for image in images)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            for i, image in enumerate(images):
+                with open(self._image_path(key, i), 'wb') as f:
+                    f.write(image)
+            self._write_meta(key, {'seed': seed, 'images': len(images), 'file_ids': None})
+            self._entries[key] = (size, len(images))
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def set_file_ids(self, key, file_ids):
+        with self._lock:
+            if key not in self._entries:
+                return
+            meta = self._read_meta(key)
+            meta['file_ids'] = file_ids
+            self._write_meta(key, meta)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    def _meta_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _image_path(self, key, index):
+        return os.path.join(self.directory, f"{key}_{index}.png")
+
+    def _read_meta(self, key):
+        with open(self._meta_path(key), encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_meta(self, key, meta):
+        tmp_path = self._meta_path(key) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path(key))
+
+    def _remove(self, key, images=None):
+        if key in self._entries:
+            size, images = self._entries.pop(key)
+            self._bytes -= size
+        paths = [self._meta_path(key)] + [self._image_path(key, i) for i in range(images or 0)]
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            try:
+                meta = self._read_meta(key)
+                size = sum(os.path.getsize(self._image_path(key, i)) for i in range(meta['images']))
+                entries.append((os.path.getmtime(self._meta_path(key)), key, size, meta['images']))
+            except (OSError, ValueError, KeyError):
+                self._remove(key, images=1)
+        for _, key, size, images in sorted(entries):
+            self._entries[key] = (size, images)
+            self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        if self._entries:
+            logger.info("Loaded %d cached generations (%s bytes)", len(self._entries), self._bytes)
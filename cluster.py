@@ -0,0 +1,272 @@
+import asyncio
+import json
+import os
+import signal
+import sys
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+from config import (TOKEN, BOT_MODE, TELEGRAM_API_URL, WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, WORKER_PROCESSES,
+                    WORKER_PORT, DALLE_BACKENDS, BACKEND_MAX_CONCURRENCY, MAX_QUEUE_SIZE, CACHE_DIR, CACHE_MAX_BYTES, LOG_FILE,
+                    METRICS_HOST, METRICS_PORT)
+from db import initialize_database
+from backends import parse_backends
+from metrics import Gauge, start_metrics_server
+from logger import logger
+
+# Scale-out mode: this process takes updates from Telegram (webhook or
+# polling) and hands each one to a worker process chosen by user id. A
+# worker is async_main in webhook mode on a local port. Every update of a
+# user goes to the same worker, in order, so per-user state (the user
+# cache, conversation state, queue limits) stays in one process. Whatever
+# is shared lives in the database.
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'async_main.py')
+WEBHOOK_PATH = "/telegram/webhook"
+FORWARD_QUEUE_SIZE = 10000  # updates waiting per worker; past that the webhook answers 503 so Telegram redelivers
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 30.0
+
+# Fields of an update that carry the user who sent it
+UPDATE_USER_FIELDS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                      'my_chat_member', 'chat_member', 'chat_join_request', 'pre_checkout_query', 'shipping_query')
+
+
+def shard_for(user_id, shards):
+    # Telegram user ids are spread evenly enough for a plain modulo
+    return user_id % shards
+
+
+def update_user_id(update):
+    for field in UPDATE_USER_FIELDS:
+        sender = (update.get(field) or {}).get('from')
+        if sender:
+            return sender['id']
+    return 0
+
+
+def split_slots(backends, shards):
+    # backends: [(src, limit)]. Deals the slots of every backend out to the
+    # shards in turn, so their totals never exceed the limits. A shard left
+    # without any slot gets one anyway, and the backend it lands on is
+    # oversubscribed by that one.
+    shares = [dict() for _ in range(shards)]
+    turn = 0
+    for src, limit in backends:
+        for _ in range(limit):
+            shares[turn % shards][src] = shares[turn % shards].get(src, 0) + 1
+            turn += 1
+    for index, share in enumerate(shares):
+        if not share:
+            src = backends[index % len(backends)][0]
+            share[src] = 1
+            logger.warning("More worker processes than backend slots: worker %s shares a slot of %s", index, src)
+    return shares
+
+
+def worker_environment(index, shards, slots):
+    # Each worker's share of the limits that are global, and files of its own
+    root, ext = os.path.splitext(LOG_FILE)
+    env = dict(os.environ,
+               BOT_MODE='webhook',
+               WORKER_PROCESSES='1',
+               SHARD_INDEX=str(index),
+               SHARD_COUNT=str(shards),
+               WEBHOOK_URL='',
+               WEBHOOK_HOST='127.0.0.1',
+               WEBHOOK_PORT=str(WORKER_PORT + index),
+               DALLE_BACKENDS=','.join(f"{src}={limit}" for src, limit in slots.items()),
+               MAX_QUEUE_SIZE=str(max(1, -(-MAX_QUEUE_SIZE // shards))),
+               CACHE_DIR=os.path.join(CACHE_DIR, f"shard-{index}"),
+               CACHE_MAX_BYTES=str(CACHE_MAX_BYTES // shards),
+               LOG_FILE=f"{root}.worker-{index}{ext}",
+               METRICS_PORT=str(METRICS_PORT + 1 + index if METRICS_PORT else 0))
+    return env
+
+
+class Worker:
+    """One worker process, restarted with a growing delay whenever it exits."""
+
+    def __init__(self, index, env):
+        self.index = index
+        self.env = env
+        self.url = f"http://127.0.0.1:{env['WEBHOOK_PORT']}{WEBHOOK_PATH}"
+        self.process = None
+        self.restarts = 0
+        self._stopping = False
+
+    async def run(self):
+        delay = RESTART_DELAY
+        while not self._stopping:
+            self.process = await asyncio.create_subprocess_exec(sys.executable, WORKER_SCRIPT, env=self.env)
+            logger.info("Started worker %s (pid %s) on %s", self.index, self.process.pid, self.url)
+            started = asyncio.get_running_loop().time()
+            code = await self.process.wait()
+            if self._stopping:
+                return
+            if asyncio.get_running_loop().time() - started > MAX_RESTART_DELAY:
+                delay = RESTART_DELAY
+            logger.error("Worker %s exited with %s, restarting in %.0fs", self.index, code, delay)
+            self.restarts += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RESTART_DELAY)
+
+    async def stop(self):
+        self._stopping = True
+        if self.process and self.process.returncode is None:
+            self.process.send_signal(signal.SIGTERM)
+            await self.process.wait()
+
+
+class Ingress:
+    """Hands updates to the workers: one FIFO queue and one sender per worker.
+
+    The sender posts one update at a time. A worker answers as soon as it
+    has the update, so this costs little, and a user's updates reach their
+    worker in the order Telegram sent them. While a worker is down, its
+    updates wait in the queue and are retried.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.queues = [asyncio.Queue(FORWARD_QUEUE_SIZE) for _ in workers]
+        self.forwarded = [0] * len(workers)
+        self._session = None
+        self._tasks = []
+
+    def start(self):
+        self._session = ClientSession(timeout=ClientTimeout(total=30))
+        self._tasks = [asyncio.create_task(self._forward(index)) for index in range(len(self.workers))]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._session.close()
+
+    def dispatch(self, body):
+        # body: the update as JSON bytes. Returns False when its worker's queue is full.
+        index = shard_for(update_user_id(json.loads(body)), len(self.workers))
+        try:
+            self.queues[index].put_nowait(body)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def dispatch_wait(self, body):
+        # Polling can slow down instead of dropping
+        index = shard_for(update_user_id(json.loads(body)), len(self.workers))
+        await self.queues[index].put(body)
+
+    async def _forward(self, index):
+        queue, worker = self.queues[index], self.workers[index]
+        headers = {'Content-Type': 'application/json'}
+        if WEBHOOK_SECRET:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = WEBHOOK_SECRET
+        while True:
+            body = await queue.get()
+            delay = 0.1
+            while True:
+                try:
+                    async with self._session.post(worker.url, data=body, headers=headers) as response:
+                        if response.status < 500:
+                            break
+                except (ClientError, asyncio.TimeoutError):
+                    pass
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+            self.forwarded[index] += 1
+            queue.task_done()
+
+
+def api_url(method):
+    base = (TELEGRAM_API_URL or "https://api.telegram.org").rstrip('/')
+    return f"{base}/bot{TOKEN}/{method}"
+
+
+async def serve_webhook(ingress, stop):
+    async def handle_update(request):
+        if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        if not ingress.dispatch(await request.read()):
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    if WEBHOOK_URL:
+        async with ClientSession() as session:
+            await session.post(api_url('setWebhook'), json={'url': WEBHOOK_URL, 'secret_token': WEBHOOK_SECRET})
+    logger.info("Ingress listening for webhook updates on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+async def poll(ingress, stop):
+    offset = 0
+    logger.info("Ingress polling for updates")
+    async with ClientSession(timeout=ClientTimeout(total=90)) as session:
+        while not stop.is_set():
+            try:
+                async with session.post(api_url('getUpdates'), json={'offset': offset, 'timeout': 60}) as response:
+                    updates = (await response.json()).get('result') or []
+            except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.warning("getUpdates failed: %s", e)
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                await ingress.dispatch_wait(json.dumps(update).encode('utf-8'))
+                offset = update['update_id'] + 1
+
+
+async def supervise(processes):
+    await asyncio.to_thread(initialize_database)  # once, before any worker touches the schema
+    shares = split_slots([(backend.src, backend.limit) for backend in parse_backends(DALLE_BACKENDS, BACKEND_MAX_CONCURRENCY)],
+                         processes)
+    workers = [Worker(index, worker_environment(index, processes, shares[index])) for index in range(processes)]
+    ingress = Ingress(workers)
+    ingress.start()
+    runs = [asyncio.create_task(worker.run()) for worker in workers]
+
+    metrics_server = None
+    if METRICS_PORT:
+        Gauge('dalle_ingress_queued_updates', "Updates waiting to be handed to each worker", lambda: {
+            (str(index),): queue.qsize() for index, queue in enumerate(ingress.queues)}, ['worker'])
+        Gauge('dalle_worker_restarts', "Times each worker process was restarted", lambda: {
+            (str(worker.index),): worker.restarts for worker in workers}, ['worker'])
+        metrics_server = start_metrics_server(METRICS_HOST, METRICS_PORT)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        if BOT_MODE == 'webhook':
+            await serve_webhook(ingress, stop)
+        else:
+            polling = asyncio.create_task(poll(ingress, stop))
+            await stop.wait()
+            polling.cancel()
+            await asyncio.gather(polling, return_exceptions=True)
+    finally:
+        # Give the workers what was already accepted before stopping them
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in ingress.queues)), 5)
+        except asyncio.TimeoutError:
+            logger.warning("Stopping with updates still queued for the workers")
+        await ingress.stop()
+        await asyncio.gather(*(worker.stop() for worker in workers))
+        await asyncio.gather(*runs, return_exceptions=True)
+        if metrics_server:
+            metrics_server.shutdown()
+
+
+def run_cluster(processes=WORKER_PROCESSES):
+    asyncio.run(supervise(processes))
+
+
+if __name__ == "__main__":
+    run_cluster()
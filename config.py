@@ -10,4 +10,105 @@ DEFAULT_NEGATIVE_PROMPT = "(deformed, distorted, disfigured:1.3), poorly drawn,
 
 MAX_SEED = 2147483647
 MAX_WIDTH = 2048
-MAX_HEIGHT = 2048
\ No newline at end of file
+MAX_HEIGHT = 2048
+
+DB_PATH = os.getenv('DB_PATH', 'users.db')
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_FLUSH_INTERVAL = float(os.getenv('USER_FLUSH_INTERVAL', 2.0))
+# Pending answers (a size after "Size" was pressed, ...) expire after CONVERSATION_TTL
+# seconds; the states of up to CONVERSATION_CACHE_SIZE chats are kept in memory
+CONVERSATION_TTL = float(os.getenv('CONVERSATION_TTL', 3600))
+CONVERSATION_CACHE_SIZE = int(os.getenv('CONVERSATION_CACHE_SIZE', 10000))
+
+# Generation queue
+GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', 2))
+MAX_QUEUE_SIZE = int(os.getenv('MAX_QUEUE_SIZE', 100))
+MAX_JOBS_PER_USER = int(os.getenv('MAX_JOBS_PER_USER', 2))
+
+# Result cache for fixed-seed generations
+CACHE_DIR = os.getenv('CACHE_DIR', 'cache')
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# Broadcasts: Telegram allows about 30 messages per second in total
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 8))
+
+# Runtime: 'polling' (threads) or 'webhook' (asyncio, see async_main.py)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')  # e.g. a local Bot API server or a fake for offline tests
+DALLE_SPACE = os.getenv('DALLE_SPACE', 'mukaist/DALLE-4K')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+ASYNC_GENERATION_WORKERS = int(os.getenv('ASYNC_GENERATION_WORKERS', 32))
+
+# Scale-out: with WORKER_PROCESSES > 1 one process takes the updates (BOT_MODE picks
+# polling or webhook) and hands every user's updates to one of that many worker
+# processes, which listen on 127.0.0.1 from WORKER_PORT up. See cluster.py.
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', 1))
+WORKER_PORT = int(os.getenv('WORKER_PORT', 8600))
+# Set by cluster.py for each worker
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', 0))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 1))
+
+# Generation backends: comma-separated Spaces or gradio URLs, "=N" sets one's concurrency
+DALLE_BACKENDS = os.getenv('DALLE_BACKENDS', DALLE_SPACE)
+BACKEND_MAX_CONCURRENCY = int(os.getenv('BACKEND_MAX_CONCURRENCY', 2))
+BACKEND_PROBE_INTERVAL = float(os.getenv('BACKEND_PROBE_INTERVAL', 30))
+
+# Generation retries and circuit breaking
+GENERATION_RETRIES = int(os.getenv('GENERATION_RETRIES', 3))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 1.0))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 20.0))
+GENERATION_DEADLINE = float(os.getenv('GENERATION_DEADLINE', 300))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 3))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', 60))
+
+# Previews and output files, made in a pool of worker processes. Each image is
+# first sent as a JPEG preview (PREVIEW_MAX_SIZE px on its longest side), then as
+# a document in OUTPUT_FORMAT: png, webp or jpeg. OUTPUT_QUALITY applies to webp
+# (100 is lossless) and jpeg. POSTPROCESS_WORKERS=0 sends the backend's files as they are.
+POSTPROCESS_WORKERS = int(os.getenv('POSTPROCESS_WORKERS', 2))
+PREVIEW_MAX_SIZE = int(os.getenv('PREVIEW_MAX_SIZE', 1280))
+PREVIEW_QUALITY = int(os.getenv('PREVIEW_QUALITY', 80))
+OUTPUT_FORMAT = os.getenv('OUTPUT_FORMAT', 'png').lower()
+OUTPUT_QUALITY = int(os.getenv('OUTPUT_QUALITY', 90))
+EMBED_METADATA = os.getenv('EMBED_METADATA', '1').lower() in ('1', 'true', 'yes')
+
+# Generation time estimates, learned from finished generations and seeded from
+# the last COST_HISTORY of them at startup. COST_DEFAULT_SECONDS is assumed for
+# a 2048x2048 image until the first one has been timed.
+COST_DEFAULT_SECONDS = float(os.getenv('COST_DEFAULT_SECONDS', 30))
+COST_HISTORY = int(os.getenv('COST_HISTORY', 1000))
+# Under load: while a new job would wait more than DEGRADE_QUEUE_WAIT seconds
+# (0 = never), it is generated at most DEGRADE_MAX_SIDE px on its longest side
+DEGRADE_QUEUE_WAIT = float(os.getenv('DEGRADE_QUEUE_WAIT', 0))
+DEGRADE_MAX_SIDE = int(os.getenv('DEGRADE_MAX_SIDE', 1024))
+
+# Seed sweeps: /generate N (up to MAX_BATCH_SIZE) or the menu button (BATCH_SIZE)
+# makes variants with different seeds, BATCH_CONCURRENCY of them at a time
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', 4))
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', 8))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 2))
+
+# While a job runs, its status message follows the backend's queue position and
+# progress, edited at most once per PROGRESS_EDIT_INTERVAL seconds, with a Cancel button
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', 3))
+
+# /history lists a user's delivered generations, HISTORY_PAGE_SIZE per page,
+# and sends them again by Telegram file_id
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 5))
+
+# Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics; off unless a port is set
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+# Logging: LOG_FORMAT is text or json. With LOG_QUEUE_SIZE > 0 a background
+# thread writes the log; 0 writes on the calling thread. LOG_EVENT_RATE caps
+# bursty events (button clicks, deliveries) per second, 0 logs them all.
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_EVENT_RATE = float(os.getenv('LOG_EVENT_RATE', 20))
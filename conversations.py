@@ -0,0 +1,126 @@
+import atexit
+import threading
+import time
+from collections import OrderedDict
+from config import CONVERSATION_TTL, CONVERSATION_CACHE_SIZE
+from db import get_conversation, set_conversation, delete_conversation, purge_conversations
+from logger import logger
+
+# What a chat can be asked to type next
+STATES = ('negative_prompt', 'size', 'guidance', 'seed', 'broadcast')
+# States that take a photo or other media as the answer; the rest take text only
+MEDIA_STATES = ('broadcast',)
+
+
+class ConversationStore:
+    """Which answer each chat is expected to send next.
+
+    States are kept in the conversations table, so they survive a restart and
+    any worker process can pick a conversation up. Each state expires `ttl`
+    seconds after it was set. Expired rows are purged in the background.
+
+    An LRU index in front of the table holds the state, or the lack of one,
+    for the last `max_chats` chats. Most messages then need only one dict
+    lookup to route. Evicting an entry loses nothing, since the row is still
+    in the table.
+    """
+
+    def __init__(self, ttl=3600, max_chats=10000, purge_interval=300):
+        self.ttl = ttl
+        self.max_chats = max_chats
+        self.purge_interval = purge_interval
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # chat_id -> (state, expires_at), or None for no state
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._purge_loop, name="conversation-purge", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def cached(self, chat_id):
+        # True when get() can answer without SQLite
+        with self._lock:
+            return chat_id in self._index
+
+    def get(self, chat_id):
+        with self._lock:
+            cached = chat_id in self._index
+            if cached:
+                self.hits += 1
+                entry = self._index[chat_id]
+                self._index.move_to_end(chat_id)
+            else:
+                self.misses += 1
+        if not cached:
+            row = get_conversation(chat_id)
+            entry = tuple(row) if row else None
+            self._remember(chat_id, entry)
+        if entry is None:
+            return None
+        state, expires_at = entry
+        if expires_at <= time.time():
+            self._remember(chat_id, None)  # the row goes with the next purge
+            return None
+        return state
+
+    def set(self, chat_id, state):
+        if state not in STATES:
+            raise ValueError(f"Unknown conversation state: {state}")
+        expires_at = time.time() + self.ttl
+        set_conversation(chat_id, state, expires_at)
+        self._remember(chat_id, (state, expires_at))
+
+    def pop(self, chat_id):
+        # The pending state, cleared: every state takes a single answer
+        state = self.get(chat_id)
+        if state is not None:
+            delete_conversation(chat_id)
+            self._remember(chat_id, None)
+        return state
+
+    def purge(self):
+        removed = purge_conversations(time.time())
+        if removed:
+            with self._lock:
+                self.expired += removed
+            logger.info("Dropped %s expired conversation states", removed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cached': len(self._index),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+            }
+
+    def _remember(self, chat_id, entry):
+        with self._lock:
+            self._index[chat_id] = entry
+            self._index.move_to_end(chat_id)
+            while len(self._index) > self.max_chats:
+                self._index.popitem(last=False)
+
+    def _purge_loop(self):
+        while not self._stop.wait(self.purge_interval):
+            try:
+                self.purge()
+            except Exception as e:
+                logger.error("Failed to purge conversation states: %s", e)
+
+
+conversations = ConversationStore(CONVERSATION_TTL, CONVERSATION_CACHE_SIZE)
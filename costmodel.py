@@ -0,0 +1,70 @@
+import threading
+
+# The guidance ranges the settings menu describes: creative, balanced, strict
+GUIDANCE_BUCKETS = (5, 10)
+
+
+class CostModel:
+    """Learns how long a generation takes from the ones that finished.
+
+    Generations are grouped by size (in half-megapixel steps) and guidance
+    range, and each group keeps a moving average of its latency. A group
+    nothing has been learned for yet is priced from the average seconds per
+    megapixel over all generations, and before the first generation from
+    `default` seconds for a 2048x2048 image.
+    """
+
+    def __init__(self, default=30.0, alpha=0.2):
+        self.default = default
+        self.alpha = alpha
+        self._buckets = {}  # (half megapixels, guidance range) -> smoothed seconds
+        self._rate = None  # smoothed seconds per megapixel
+        self._observed = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def bucket(width, height, guidance_scale):
+        guidance = sum(guidance_scale > bound for bound in GUIDANCE_BUCKETS)
+        return max(1, round(width * height / 500_000)), guidance
+
+    def observe(self, width, height, guidance_scale, seconds):
+        key = self.bucket(width, height, guidance_scale)
+        rate = seconds / (width * height / 1_000_000)
+        with self._lock:
+            previous = self._buckets.get(key)
+            self._buckets[key] = seconds if previous is None else previous + self.alpha * (seconds - previous)
+            self._rate = rate if self._rate is None else self._rate + self.alpha * (rate - self._rate)
+            self._observed += 1
+
+    def load(self, rows):
+        # rows: (width, height, guidance_scale, latency_ms), oldest first
+        for width, height, guidance_scale, latency_ms in rows:
+            self.observe(width, height, guidance_scale, latency_ms / 1000)
+
+    def estimate(self, width, height, guidance_scale):
+        # Expected seconds for one generation with these settings
+        megapixels = width * height / 1_000_000
+        with self._lock:
+            seconds = self._buckets.get(self.bucket(width, height, guidance_scale))
+            rate = self._rate
+        if seconds is not None:
+            return seconds
+        if rate is not None:
+            return rate * megapixels
+        return self.default * megapixels / (2048 * 2048 / 1_000_000)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'observed': self._observed,
+                'buckets': len(self._buckets),
+                'seconds_per_megapixel': self._rate,
+            }
+
+
+def degraded_size(width, height, max_side):
+    # The same aspect ratio with the longest side at most max_side, in multiples of 8
+    scale = max_side / max(width, height)
+    if scale >= 1:
+        return width, height
+    return max(8, int(width * scale) // 8 * 8), max(8, int(height * scale) // 8 * 8)
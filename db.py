@@ -1,51 +1,431 @@
+import json
+import math
 import sqlite3
+import threading
+import time
+import weakref
+from collections import namedtuple
 from contextlib import contextmanager
-from config import DEFAULT_NEGATIVE_PROMPT
+from config import DEFAULT_NEGATIVE_PROMPT, DB_PATH
+from metrics import timed
+
+USER_FIELDS = ('username', 'prompt', 'negative_prompt', 'style', 'width', 'height', 'guidance_scale', 'seed')
+
+# Schema changes are appended here, never edited in place. PRAGMA user_version
+# records how many of them a database file has already applied.
+MIGRATIONS = [
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        prompt TEXT,
+        negative_prompt TEXT,
+        style TEXT,
+        width INTEGER,
+        height INTEGER,
+        guidance_scale REAL,
+        seed INTEGER
+    );
+    ''',
+    # Generation log plus aggregates kept current by triggers, so /stats
+    # never scans users or generations
+    '''
+    CREATE TABLE generations (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        prompt TEXT,
+        negative_prompt TEXT,
+        style TEXT,
+        width INTEGER,
+        height INTEGER,
+        guidance_scale REAL,
+        seed INTEGER,
+        status TEXT NOT NULL,
+        latency_ms INTEGER,
+        latency_bucket INTEGER,
+        error TEXT
+    );
+    CREATE INDEX idx_generations_user ON generations (user_id, created_at);
+    CREATE INDEX idx_generations_created ON generations (created_at);
+
+    CREATE TABLE stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    INSERT INTO stats_counters (name, value)
+    SELECT 'users', COUNT(*) FROM users
+    UNION ALL SELECT 'users_with_prompt', COUNT(*) FROM users WHERE prompt IS NOT NULL
+    UNION ALL SELECT 'users_with_style', COUNT(*) FROM users WHERE style IS NOT NULL
+    UNION ALL SELECT 'users_with_size', COUNT(*) FROM users WHERE width IS NOT NULL AND height IS NOT NULL
+    UNION ALL SELECT 'users_with_guidance', COUNT(*) FROM users WHERE guidance_scale IS NOT NULL
+    UNION ALL SELECT 'users_with_seed', COUNT(*) FROM users WHERE seed != -1
+    UNION ALL SELECT 'generations', 0
+    UNION ALL SELECT 'generations_cached', 0
+    UNION ALL SELECT 'generations_failed', 0;
+
+    CREATE TABLE generation_daily (
+        day TEXT PRIMARY KEY,
+        total INTEGER NOT NULL,
+        cached INTEGER NOT NULL,
+        failed INTEGER NOT NULL,
+        latency_ms_total INTEGER NOT NULL
+    ) WITHOUT ROWID;
+
+    CREATE TABLE generation_latency (
+        bucket INTEGER PRIMARY KEY,
+        count INTEGER NOT NULL
+    );
+
+    CREATE TRIGGER users_stats_insert AFTER INSERT ON users BEGIN
+        UPDATE stats_counters SET value = value + CASE name
+            WHEN 'users' THEN 1
+            WHEN 'users_with_prompt' THEN NEW.prompt IS NOT NULL
+            WHEN 'users_with_style' THEN NEW.style IS NOT NULL
+            WHEN 'users_with_size' THEN NEW.width IS NOT NULL AND NEW.height IS NOT NULL
+            WHEN 'users_with_guidance' THEN NEW.guidance_scale IS NOT NULL
+            WHEN 'users_with_seed' THEN IFNULL(NEW.seed != -1, 0)
+        END
+        WHERE name LIKE 'users%';
+    END;
+
+    CREATE TRIGGER users_stats_delete AFTER DELETE ON users BEGIN
+        UPDATE stats_counters SET value = value - CASE name
+            WHEN 'users' THEN 1
+            WHEN 'users_with_prompt' THEN OLD.prompt IS NOT NULL
+            WHEN 'users_with_style' THEN OLD.style IS NOT NULL
+            WHEN 'users_with_size' THEN OLD.width IS NOT NULL AND OLD.height IS NOT NULL
+            WHEN 'users_with_guidance' THEN OLD.guidance_scale IS NOT NULL
+            WHEN 'users_with_seed' THEN IFNULL(OLD.seed != -1, 0)
+        END
+        WHERE name LIKE 'users%';
+    END;
+
+    CREATE TRIGGER users_stats_update AFTER UPDATE ON users BEGIN
+        UPDATE stats_counters SET value = value + CASE name
+            WHEN 'users_with_prompt' THEN (NEW.prompt IS NOT NULL) - (OLD.prompt IS NOT NULL)
+            WHEN 'users_with_style' THEN (NEW.style IS NOT NULL) - (OLD.style IS NOT NULL)
+            WHEN 'users_with_size' THEN (NEW.width IS NOT NULL AND NEW.height IS NOT NULL) - (OLD.width IS NOT NULL AND OLD.height IS NOT NULL)
+            WHEN 'users_with_guidance' THEN (NEW.guidance_scale IS NOT NULL) - (OLD.guidance_scale IS NOT NULL)
+            WHEN 'users_with_seed' THEN IFNULL(NEW.seed != -1, 0) - IFNULL(OLD.seed != -1, 0)
+        END
+        WHERE name LIKE 'users_with_%';
+    END;
+
+    CREATE TRIGGER generations_stats_insert AFTER INSERT ON generations BEGIN
+        UPDATE stats_counters SET value = value + CASE name
+            WHEN 'generations' THEN 1
+            WHEN 'generations_cached' THEN NEW.status = 'cached'
+            WHEN 'generations_failed' THEN NEW.status = 'failed'
+        END
+        WHERE name LIKE 'generations%';
+        INSERT INTO generation_daily (day, total, cached, failed, latency_ms_total)
+        VALUES (date(NEW.created_at, 'unixepoch'), 1, NEW.status = 'cached', NEW.status = 'failed', IIF(NEW.status = 'ok', IFNULL(NEW.latency_ms, 0), 0))
+        ON CONFLICT (day) DO UPDATE SET
+            total = total + 1,
+            cached = cached + excluded.cached,
+            failed = failed + excluded.failed,
+            latency_ms_total = latency_ms_total + excluded.latency_ms_total;
+        INSERT INTO generation_latency (bucket, count)
+        SELECT NEW.latency_bucket, 1 WHERE NEW.status = 'ok' AND NEW.latency_bucket IS NOT NULL
+        ON CONFLICT (bucket) DO UPDATE SET count = count + 1;
+    END;
+    ''',
+    # Broadcast progress, checkpointed per batch so a restart can resume
+    '''
+    CREATE TABLE broadcasts (
+        id INTEGER PRIMARY KEY,
+        admin_chat_id INTEGER NOT NULL,
+        status_message_id INTEGER,
+        content_type TEXT NOT NULL,
+        text TEXT,
+        file_id TEXT,
+        caption TEXT,
+        status TEXT NOT NULL,
+        last_user_id INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        started_at REAL NOT NULL,
+        finished_at REAL
+    );
+    CREATE INDEX idx_broadcasts_status ON broadcasts (status);
+    ''',
+    # What each chat is expected to send next, see conversations.py
+    '''
+    CREATE TABLE conversations (
+        chat_id INTEGER PRIMARY KEY,
+        state TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    CREATE INDEX idx_conversations_expires ON conversations (expires_at);
+    ''',
+    # Telegram file_ids of each delivered generation, for /history. The
+    # partial index holds only delivered rows, newest last per user, so a
+    # page is one range scan however long the log grows.
+    '''
+    ALTER TABLE generations ADD COLUMN file_ids TEXT;
+    CREATE INDEX idx_generations_history ON generations (user_id, id) WHERE file_ids IS NOT NULL;
+    ''',
+]
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",  # readers no longer block on the writer
+    "PRAGMA synchronous=NORMAL",  # safe with WAL, fsync only at checkpoints
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",  # 16 MB page cache per connection
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA recursive_triggers=ON",  # INSERT OR REPLACE fires the delete triggers too
+)
+
+HistoryEntry = namedtuple('HistoryEntry', 'id created_at prompt negative_prompt style width height guidance_scale seed file_ids')
+HISTORY_SELECT = f"SELECT {', '.join(HistoryEntry._fields)} FROM generations"
+LAST_ID = 2 ** 63 - 1  # larger than any rowid, for the first page
+
+# Latency histogram buckets grow geometrically, so percentiles come out
+# within 10% from a few dozen rows no matter how many generations exist
+LATENCY_BUCKET_BASE = 1.1
+
+_local = threading.local()
+_holders = weakref.WeakSet()
+_holders_lock = threading.Lock()
+
+
+class _Holder:
+    """A thread's connection. The thread-local drops the holder when its
+    thread exits, and the finalizer then closes the connection."""
+
+    __slots__ = ('conn', 'close', '__weakref__')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.close = weakref.finalize(self, conn.close)
+
+
+def _connect():
+    # Each thread keeps one connection for its lifetime; the sqlite3 module
+    # caches prepared statements per connection, keyed by SQL text
+    conn = sqlite3.connect(DB_PATH, timeout=5, cached_statements=256, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    holder = _Holder(conn)
+    with _holders_lock:
+        _holders.add(holder)
+    return holder
 
 @contextmanager
 def get_db_connection():
-    conn = sqlite3.connect('users.db')
+    holder = getattr(_local, 'holder', None)
+    if holder is None or not holder.close.alive:
+        holder = _local.holder = _connect()
+    conn = holder.conn
     try:
         yield conn
-    finally:
-        conn.close()
+    except Exception:
+        conn.rollback()
+        raise
+
+def close_connections():
+    # The connections of threads still running; those of finished threads are closed already
+    with _holders_lock:
+        holders = list(_holders)
+    for holder in holders:
+        try:
+            holder.close()
+        except sqlite3.Error:
+            pass
+    _local.__dict__.clear()
 
 def initialize_database():
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            username TEXT,
-            prompt TEXT,
-            negative_prompt TEXT,
-            style TEXT,
-            width INTEGER,
-            height INTEGER,
-            guidance_scale REAL,
-            seed INTEGER
-        )
-        ''')
-        conn.commit()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            # executescript commits any pending transaction first, so the
+            # version bump is part of the same script
+            conn.executescript(f"BEGIN;\n{migration}\nPRAGMA user_version = {number};\nCOMMIT;")
 
+@timed('db_get_user')
 def get_user(user_id):
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE id=?", (user_id,))
-        return cursor.fetchone()
+        return conn.execute("SELECT * FROM users WHERE id=?", (user_id,)).fetchone()
 
+@timed('db_create_user')
 def create_user(user_id, username):
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-        INSERT OR REPLACE INTO users 
-        (id, username, negative_prompt, style, width, height, guidance_scale, seed) 
+        conn.execute("""
+        INSERT OR REPLACE INTO users
+        (id, username, negative_prompt, style, width, height, guidance_scale, seed)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """, (user_id, username, DEFAULT_NEGATIVE_PROMPT, "3840 x 2160", 2048, 2048, 20.0, -1))
         conn.commit()
 
+@timed('db_update_user_data')
 def update_user_data(user_id, field, value):
+    if field not in USER_FIELDS:
+        raise ValueError(f"Unknown user field: {field}")
+    with get_db_connection() as conn:
+        conn.execute(f"UPDATE users SET {field} = ? WHERE id = ?", (value, user_id))
+        conn.commit()
+
+@timed('db_apply_user_updates')
+def apply_user_updates(updates):
+    # updates: {user_id: {field: value}}. Users changing the same set of fields
+    # share one executemany, and the whole batch is a single transaction.
+    batches = {}
+    for user_id, fields in updates.items():
+        names = tuple(sorted(fields))
+        for name in names:
+            if name not in USER_FIELDS:
+                raise ValueError(f"Unknown user field: {name}")
+        batches.setdefault(names, []).append(tuple(fields[name] for name in names) + (user_id,))
+    with get_db_connection() as conn:
+        with conn:
+            for names, rows in batches.items():
+                assignments = ", ".join(f"{name} = ?" for name in names)
+                conn.executemany(f"UPDATE users SET {assignments} WHERE id = ?", rows)
+
+@timed('db_record_generation')
+def record_generation(user_id, prompt, negative_prompt, style, width, height, guidance_scale, seed, status, latency_ms=None, error=None,
+                      file_ids=None):
+    # status is 'ok', 'cached' or 'failed'; the triggers keep the aggregates in step.
+    # file_ids: what the delivered images were sent as, which puts the row in /history
+    bucket = int(math.log(max(latency_ms, 1), LATENCY_BUCKET_BASE)) if latency_ms is not None else None
+    with get_db_connection() as conn:
+        with conn:
+            conn.execute("""
+            INSERT INTO generations
+            (user_id, created_at, prompt, negative_prompt, style, width, height, guidance_scale, seed, status, latency_ms, latency_bucket, error,
+             file_ids)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, time.time(), prompt, negative_prompt, style, width, height, guidance_scale, seed, status, latency_ms, bucket, error,
+                  json.dumps(file_ids) if file_ids else None))
+
+def _history_entry(row):
+    return HistoryEntry(*row[:-1], json.loads(row[-1]))
+
+@timed('db_get_history')
+def get_history(user_id, before_id=LAST_ID, limit=5):
+    # A user's delivered generations with ids below before_id, newest first.
+    # Keyset pagination: the next page starts below the last id of this one,
+    # so deep pages cost the same as the first.
+    with get_db_connection() as conn:
+        rows = conn.execute(HISTORY_SELECT + """
+        WHERE user_id = ? AND file_ids IS NOT NULL AND id < ? ORDER BY id DESC LIMIT ?
+        """, (user_id, before_id, limit)).fetchall()
+    return [_history_entry(row) for row in rows]
+
+@timed('db_get_history_entry')
+def get_history_entry(user_id, generation_id):
+    # None unless the generation was delivered to this user
+    with get_db_connection() as conn:
+        row = conn.execute(HISTORY_SELECT + """
+        WHERE id = ? AND user_id = ? AND file_ids IS NOT NULL
+        """, (generation_id, user_id)).fetchone()
+    return _history_entry(row) if row else None
+
+def get_recent_latencies(limit):
+    # (width, height, guidance_scale, latency_ms) of the last `limit` backend
+    # generations, oldest first; walks the primary key backwards
+    with get_db_connection() as conn:
+        rows = conn.execute("""
+        SELECT width, height, guidance_scale, latency_ms FROM generations
+        WHERE status = 'ok' AND latency_ms IS NOT NULL ORDER BY id DESC LIMIT ?
+        """, (limit,)).fetchall()
+    rows.reverse()
+    return rows
+
+def _latency_percentiles(conn, percentiles):
+    buckets = conn.execute("SELECT bucket, count FROM generation_latency ORDER BY bucket").fetchall()
+    total = sum(count for _, count in buckets)
+    result = {}
+    for p in percentiles:
+        if not total:
+            result[p] = None
+            continue
+        rank = p / 100 * total
+        seen = 0
+        for bucket, count in buckets:
+            seen += count
+            if seen >= rank:
+                # Geometric midpoint of the bucket's range
+                result[p] = LATENCY_BUCKET_BASE ** (bucket + 0.5)
+                break
+    return result
+
+@timed('db_get_stats')
+def get_stats(days=7):
+    with get_db_connection() as conn:
+        stats = dict(conn.execute("SELECT name, value FROM stats_counters").fetchall())
+        stats['daily'] = conn.execute(
+            "SELECT day, total, cached, failed, latency_ms_total FROM generation_daily ORDER BY day DESC LIMIT ?", (days,)
+        ).fetchall()
+        percentiles = _latency_percentiles(conn, (50, 95))
+        stats['latency_p50_ms'] = percentiles[50]
+        stats['latency_p95_ms'] = percentiles[95]
+        return stats
+
+@timed('db_get_conversation')
+def get_conversation(chat_id):
+    # (state, expires_at) or None
+    with get_db_connection() as conn:
+        return conn.execute("SELECT state, expires_at FROM conversations WHERE chat_id = ?", (chat_id,)).fetchone()
+
+@timed('db_set_conversation')
+def set_conversation(chat_id, state, expires_at):
+    with get_db_connection() as conn:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO conversations (chat_id, state, expires_at) VALUES (?, ?, ?)",
+                         (chat_id, state, expires_at))
+
+@timed('db_delete_conversation')
+def delete_conversation(chat_id):
+    with get_db_connection() as conn:
+        with conn:
+            conn.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
+
+def purge_conversations(now):
+    # Drops expired states; returns how many
+    with get_db_connection() as conn:
+        with conn:
+            return conn.execute("DELETE FROM conversations WHERE expires_at <= ?", (now,)).rowcount
+
+def get_counter(name):
+    with get_db_connection() as conn:
+        row = conn.execute("SELECT value FROM stats_counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+def get_user_ids_after(last_user_id, limit):
+    # Keyset pagination over the primary key: each page is an index range scan
+    with get_db_connection() as conn:
+        rows = conn.execute("SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?", (last_user_id, limit)).fetchall()
+        return [row[0] for row in rows]
+
+def create_broadcast(admin_chat_id, status_message_id, content_type, text=None, file_id=None, caption=None):
+    with get_db_connection() as conn:
+        with conn:
+            cursor = conn.execute("""
+            INSERT INTO broadcasts (admin_chat_id, status_message_id, content_type, text, file_id, caption, status, started_at)
+            VALUES (?, ?, ?, ?, ?, ?, 'running', ?)
+            """, (admin_chat_id, status_message_id, content_type, text, file_id, caption, time.time()))
+            return cursor.lastrowid
+
+def get_broadcast(broadcast_id):
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute(f"UPDATE users SET {field} = ? WHERE id = ?", (value, user_id))
-        conn.commit()
\ No newline at end of file
+        cursor.row_factory = sqlite3.Row
+        return cursor.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+
+def get_running_broadcast_ids():
+    with get_db_connection() as conn:
+        return [row[0] for row in conn.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")]
+
+def checkpoint_broadcast(broadcast_id, last_user_id, sent, failed):
+    with get_db_connection() as conn:
+        with conn:
+            conn.execute("UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ? WHERE id = ?",
+                         (last_user_id, sent, failed, broadcast_id))
+
+def finish_broadcast(broadcast_id):
+    with get_db_connection() as conn:
+        with conn:
+            conn.execute("UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ?", (time.time(), broadcast_id))
@@ -0,0 +1,146 @@
+import asyncio
+import io
+from telebot.types import InputMediaDocument, InputMediaPhoto
+from metrics import STAGE_SECONDS, POSTPROCESS_FALLBACKS
+from logger import logger
+
+CAPTION_LIMIT = 1024  # Telegram's limit for media captions
+MEDIA_GROUP_LIMIT = 10
+
+
+def read_images(paths):
+    images = []
+    for path in paths:
+        with open(path, 'rb') as image_file:
+            images.append(image_file.read())
+    return images
+
+
+def _file_name(seed, index, extension='png'):
+    return f"dalle4k_{seed}_{index + 1}.{extension}"
+
+
+def _media(image, seed, index, extension='png'):
+    # A str is a file_id from an earlier upload, bytes are uploaded as a new file
+    if isinstance(image, str):
+        return image
+    media = io.BytesIO(image)
+    media.name = _file_name(seed, index, extension)
+    return media
+
+
+def _preview_groups(previews):
+    for start in range(0, len(previews), MEDIA_GROUP_LIMIT):
+        yield [InputMediaPhoto(preview) for preview in previews[start:start + MEDIA_GROUP_LIMIT]]
+
+
+def deliver_images(bot, chat_id, images, caption, seed, extension='png'):
+    """Send generated images as lossless documents, uploading each one once.
+
+    `images` holds raw bytes or file_ids of earlier uploads. Several images go
+    out as one media group carrying the caption. Returns the document
+    file_ids, which later sends can pass back in instead of bytes.
+    """
+    if len(caption) > CAPTION_LIMIT:
+        bot.send_message(chat_id, caption)
+        caption = None
+
+    if len(images) == 1:
+        image = images[0]
+        if isinstance(image, str):
+            sent = bot.send_document(chat_id, image, caption=caption)
+        else:
+            sent = bot.send_document(chat_id, image, caption=caption, visible_file_name=_file_name(seed, 0, extension))
+        return [sent.document.file_id]
+
+    file_ids = []
+    for start in range(0, len(images), MEDIA_GROUP_LIMIT):
+        media = [
+            InputMediaDocument(_media(image, seed, index, extension), caption=caption if index == 0 else None)
+            for index, image in enumerate(images[start:start + MEDIA_GROUP_LIMIT], start)
+        ]
+        sent = bot.send_media_group(chat_id, media)
+        file_ids.extend(message.document.file_id for message in sent)
+    return file_ids
+
+
+def deliver_generation(bot, chat_id, images, caption, seed, postprocessor=None, parameters=None):
+    """deliver_images, preceded by compressed previews when a postprocessor is given.
+
+    The previews go out as photos as soon as they are encoded; the full
+    files follow as documents, in the postprocessor's output format. If
+    post-processing fails the backend's files are delivered unchanged.
+    """
+    if postprocessor is None or not postprocessor.enabled or not images or isinstance(images[0], str):
+        with STAGE_SECONDS.time('upload'):
+            return deliver_images(bot, chat_id, images, caption, seed)
+    try:
+        with STAGE_SECONDS.time('preview'):
+            outputs = postprocessor.submit(images, parameters)
+            previews = [preview.result() for preview, _ in outputs]
+        with STAGE_SECONDS.time('preview_upload'):
+            if len(previews) == 1:
+                bot.send_photo(chat_id, previews[0])
+            else:
+                for media in _preview_groups(previews):
+                    bot.send_media_group(chat_id, media)
+        with STAGE_SECONDS.time('encode'):
+            images = [output.result() for _, output in outputs]
+        extension = postprocessor.extension
+    except Exception as e:
+        logger.warning("Post-processing for chat %s failed, sending the original files: %s", chat_id, e)
+        POSTPROCESS_FALLBACKS.inc()
+        extension = 'png'
+    with STAGE_SECONDS.time('upload'):
+        return deliver_images(bot, chat_id, images, caption, seed, extension)
+
+
+async def deliver_images_async(bot, chat_id, images, caption, seed, extension='png'):
+    # deliver_images for AsyncTeleBot
+    if len(caption) > CAPTION_LIMIT:
+        await bot.send_message(chat_id, caption)
+        caption = None
+
+    if len(images) == 1:
+        image = images[0]
+        if isinstance(image, str):
+            sent = await bot.send_document(chat_id, image, caption=caption)
+        else:
+            sent = await bot.send_document(chat_id, image, caption=caption, visible_file_name=_file_name(seed, 0, extension))
+        return [sent.document.file_id]
+
+    file_ids = []
+    for start in range(0, len(images), MEDIA_GROUP_LIMIT):
+        media = [
+            InputMediaDocument(_media(image, seed, index, extension), caption=caption if index == 0 else None)
+            for index, image in enumerate(images[start:start + MEDIA_GROUP_LIMIT], start)
+        ]
+        sent = await bot.send_media_group(chat_id, media)
+        file_ids.extend(message.document.file_id for message in sent)
+    return file_ids
+
+
+async def deliver_generation_async(bot, chat_id, images, caption, seed, postprocessor=None, parameters=None):
+    # deliver_generation for AsyncTeleBot; the pool's futures are awaited, not waited on
+    if postprocessor is None or not postprocessor.enabled or not images or isinstance(images[0], str):
+        with STAGE_SECONDS.time('upload'):
+            return await deliver_images_async(bot, chat_id, images, caption, seed)
+    try:
+        with STAGE_SECONDS.time('preview'):
+            outputs = [(asyncio.wrap_future(preview), asyncio.wrap_future(output)) for preview, output in postprocessor.submit(images, parameters)]
+            previews = await asyncio.gather(*(preview for preview, _ in outputs))
+        with STAGE_SECONDS.time('preview_upload'):
+            if len(previews) == 1:
+                await bot.send_photo(chat_id, previews[0])
+            else:
+                for media in _preview_groups(previews):
+                    await bot.send_media_group(chat_id, media)
+        with STAGE_SECONDS.time('encode'):
+            images = await asyncio.gather(*(output for _, output in outputs))
+        extension = postprocessor.extension
+    except Exception as e:
+        logger.warning("Post-processing for chat %s failed, sending the original files: %s", chat_id, e)
+        POSTPROCESS_FALLBACKS.inc()
+        extension = 'png'
+    with STAGE_SECONDS.time('upload'):
+        return await deliver_images_async(bot, chat_id, images, caption, seed, extension)
@@ -0,0 +1,392 @@
+import dataclasses
+import itertools
+import math
+import random
+import time
+from collections import namedtuple
+from config import (DEFAULT_NEGATIVE_PROMPT, MAX_SEED, MAX_JOBS_PER_USER, CACHE_DIR, CACHE_MAX_BYTES, POSTPROCESS_WORKERS, OUTPUT_FORMAT,
+                    OUTPUT_QUALITY, PREVIEW_MAX_SIZE, PREVIEW_QUALITY, EMBED_METADATA, BATCH_CONCURRENCY, COST_DEFAULT_SECONDS,
+                    DEGRADE_QUEUE_WAIT, DEGRADE_MAX_SIDE, PROGRESS_EDIT_INTERVAL, HISTORY_PAGE_SIZE)
+from db import record_generation, get_history, get_history_entry, LAST_ID
+from users import user_store
+from conversations import MEDIA_STATES
+from logger import logger
+from jobs import UserQueueFull, JobCancelled
+from cache import ResultCache
+from delivery import read_images
+from imaging import Postprocessor, generation_parameters
+from costmodel import CostModel, degraded_size
+from routing import HandlerRegistry
+from metrics import STAGE_SECONDS, GENERATIONS, DEGRADED_JOBS
+from ui import MAIN_MENU_KEYBOARD, STYLE_KEYBOARD, RETRY_KEYBOARD, CANCEL_KEYBOARD
+import ui
+
+# What the bot does, written once for both runtimes: main.py (threads,
+# polling) and async_main.py (asyncio, webhook) keep only the I/O, that is
+# the Bot API calls, the job queue and backend they run on, and in
+# async_main the hop to a thread for whatever here blocks (SQLite, the
+# result cache on disk). Nothing here talks to Telegram.
+
+MESSAGE_CONTENT_TYPES = ['text', 'photo', 'document', 'audio', 'video', 'voice', 'sticker', 'animation', 'video_note']
+
+cost_model = CostModel(COST_DEFAULT_SECONDS)
+postprocessor = Postprocessor(POSTPROCESS_WORKERS, OUTPUT_FORMAT, OUTPUT_QUALITY, PREVIEW_MAX_SIZE, PREVIEW_QUALITY, EMBED_METADATA)
+result_cache = ResultCache(CACHE_DIR, CACHE_MAX_BYTES, postprocessor.output)
+
+# What each command, button and pending answer leads to, by the name of the
+# runtime's handler. bind() looks every name up, so a runtime that lacks a
+# handler fails on import instead of on the first user to press the button.
+COMMANDS = {
+    'start': 'send_welcome',
+    'help': 'send_help',
+    'random': 'send_random_prompt',
+    'generate': 'generate_command',
+    'stats': 'send_stats',
+    'broadcast': 'start_broadcast',
+    'settings': 'show_user_settings',
+    'history': 'send_history',
+}
+CALLBACKS = {
+    'cancel_generation': 'cancel_generation',
+    'create_image': 'generate_button',
+    'retry_generation': 'generate_button',
+    'create_batch': 'generate_batch_button',
+    'settings': 'settings_button',
+    'my_settings': 'settings_button',
+    'help': 'help_button',
+    'main_menu': 'show_main_menu',
+    'use_default_negative': 'use_default_negative',
+    'use_default_negative_random': 'use_default_negative',
+    'add_custom_negative': 'add_custom_negative',
+    'add_custom_negative_random': 'add_custom_negative',
+    'random_prompt': 'show_random_prompt',
+    'another_random': 'show_random_prompt',
+    'generate_random': 'generate_random',
+    'history': 'show_history_page',
+}
+CALLBACK_PREFIXES = {
+    'set_': 'handle_setting',
+    'style_': 'set_style',
+    'history_': 'show_history_page',
+    'resend_': 'resend_generation',
+    'remix_': 'remix_generation',
+}
+INPUTS = {
+    'negative_prompt': 'process_custom_negative',
+    'size': 'process_size_input',
+    'guidance': 'process_guidance_input',
+    'seed': 'process_seed_input',
+    'broadcast': 'do_broadcast',
+}
+
+# The settings menu's buttons: (conversation state that takes the answer, text, keyboard)
+SETTING_PROMPTS = {
+    'style': (None, ui.STYLE_TEXT, STYLE_KEYBOARD),
+    'size': ('size', ui.SIZE_TEXT, None),
+    'guidance': ('guidance', ui.GUIDANCE_TEXT, None),
+    'seed': ('seed', ui.SEED_TEXT, None),
+}
+
+JobPlan = namedtuple('JobPlan', 'user status_text cost duration wait')
+
+
+def bind(handlers):
+    # handlers: a runtime's globals(). Returns its (command, callback, input) handlers.
+    def lookup(table):
+        return {key: handlers[name] for key, name in table.items()}
+    return (HandlerRegistry(lookup(COMMANDS)), HandlerRegistry(lookup(CALLBACKS), prefixes=lookup(CALLBACK_PREFIXES)),
+            lookup(INPUTS))
+
+
+def command_name(text):
+    # "/generate@dalle_bot 4" -> "generate"
+    return text.split()[0][1:].split('@', 1)[0]
+
+
+def needs_text(message, state):
+    # True if `state` waits for a typed answer and `message` is something else
+    return message.content_type != 'text' and state not in MEDIA_STATES
+
+
+def custom_negative_prompt(text):
+    return f"{DEFAULT_NEGATIVE_PROMPT}, {text}"
+
+
+def broadcast_content(message):
+    # (kind, fields) for BroadcastEngine.start, or None for a message it can't send
+    if message.content_type == 'text':
+        return 'text', {'text': message.text}
+    if message.content_type == 'photo':
+        return 'photo', {'file_id': message.photo[-1].file_id, 'caption': message.caption}  # the largest photo
+    return None
+
+
+def missing_settings(user):
+    return not all([user.prompt, user.style, user.width, user.height, user.guidance_scale])
+
+
+def cached_generation(user, count=1):
+    # Fixed-seed generations are deterministic, so a cached result is
+    # delivered straight away without touching the queue or the backend
+    if user.seed != -1 and count == 1:
+        return result_cache.get(result_cache.key_for(user, user.seed))
+    return None
+
+
+def job_cost(user, count=1):
+    # (backend seconds the job takes up, seconds until it is delivered once started)
+    seconds = cost_model.estimate(user.width, user.height, user.guidance_scale)
+    if count == 1:
+        return seconds, seconds
+    return seconds * count, seconds * math.ceil(count / BATCH_CONCURRENCY)
+
+
+def plan_job(job_queue, user, count=1):
+    # How a new job of `count` variants runs, given the wait in `job_queue`:
+    # past DEGRADE_QUEUE_WAIT it is made smaller, for this job only, while the
+    # user's settings stay as they are
+    status_text = ui.batch_processing_text(count) if count > 1 else ui.PROCESSING_TEXT
+    wait = job_queue.estimated_wait(user_id=user.id)
+    if DEGRADE_QUEUE_WAIT and wait > DEGRADE_QUEUE_WAIT:
+        width, height = degraded_size(user.width, user.height, DEGRADE_MAX_SIDE)
+        if (width, height) != (user.width, user.height):
+            user = dataclasses.replace(user, width=width, height=height)
+            status_text = ui.degraded_text(status_text, width, height)
+            DEGRADED_JOBS.inc()
+    cost, duration = job_cost(user, count)
+    return JobPlan(user, status_text, cost, duration, wait)
+
+
+def rejection(error, user_id):
+    # (text, keyboard) for a job the queue turned away with `error`
+    if isinstance(error, UserQueueFull):
+        return ui.user_queue_full_text(MAX_JOBS_PER_USER), None
+    logger.warning("Generation queue full, rejected job for user %s", user_id)
+    return ui.QUEUE_FULL_TEXT, RETRY_KEYBOARD
+
+
+def cancel_job(cancellations, job_queue, key):
+    # The Cancel button on the status message `key` (chat id, message id).
+    # None: nothing to cancel. True: the job was still queued and is dropped,
+    # so nothing else will edit its message. False: the running job was told to stop.
+    cancel = cancellations.pop(key, None)
+    if cancel is None:
+        return None
+    if job_queue.cancel(cancel):
+        GENERATIONS.inc('cancelled')
+        return True
+    return False
+
+
+def outcome(error=None):
+    # How a single generation job ends: (text, keyboard, whether it replaces the status message)
+    if error is None:
+        return ui.AFTER_GENERATION_TEXT, MAIN_MENU_KEYBOARD, False
+    if isinstance(error, JobCancelled):
+        return ui.CANCELLED_TEXT, RETRY_KEYBOARD, True
+    return ui.generation_error_text(error), RETRY_KEYBOARD, True
+
+
+class ProgressThrottle:
+    """Turns a job's backend status reports into status message texts.
+
+    A new stage shows at once, anything else once per PROGRESS_EDIT_INTERVAL;
+    text() returns None for a report not worth an edit.
+    """
+
+    def __init__(self, user):
+        self.started = time.monotonic()
+        self.estimate = cost_model.estimate(user.width, user.height, user.guidance_scale)
+        self._shown = (None, None, 0.0)  # text, stage, when
+
+    def text(self, status):
+        now = time.monotonic()
+        text = ui.backend_status_text(status, max(0.0, self.estimate - (now - self.started)))
+        shown, stage, at = self._shown
+        if text == shown or (status.stage == stage and now - at < PROGRESS_EDIT_INTERVAL):
+            return None
+        self._shown = (text, status.stage, now)
+        return text
+
+
+class Batch:
+    """The bookkeeping of one seed-sweep batch, for either runtime's scheduler.
+
+    The scheduler starts the variants of first_seeds(), and each time one
+    finishes reports it to finished() and starts the one for next_seed(),
+    so BATCH_CONCURRENCY run at a time. Once `cancel` is set no seed is
+    handed out any more, and variant() raises JobCancelled for one that
+    was handed out but has not started.
+    """
+
+    def __init__(self, user, seeds, cancel=None):
+        self.user = user
+        self.total = len(seeds)
+        self.cancel = cancel
+        self.done = 0
+        self.failed = 0
+        self.error = None
+        self._seeds = iter(seeds)
+
+    @property
+    def cancelled(self):
+        return self.cancel is not None and self.cancel.is_set()
+
+    def first_seeds(self):
+        return list(itertools.islice(iter(self.next_seed, None), BATCH_CONCURRENCY))
+
+    def next_seed(self):
+        return None if self.cancelled else next(self._seeds, None)
+
+    def variant(self, seed):
+        # (the user to generate for, its cached result or None)
+        if self.cancelled:
+            raise JobCancelled()
+        user = dataclasses.replace(self.user, seed=seed)
+        return user, result_cache.get(result_cache.key_for(user, seed))
+
+    def finished(self, error=None):
+        # Counts a variant that ended with `error` (None if delivered). Returns
+        # the status message's (text, keyboard), or None for a cancelled one.
+        if isinstance(error, JobCancelled):
+            return None
+        if error is None:
+            self.done += 1
+        else:
+            self.failed += 1
+            self.error = error
+        remaining = self.done + self.failed < self.total
+        return ui.batch_progress_text(self.done, self.failed, self.total), CANCEL_KEYBOARD if remaining else None
+
+    def outcome(self):
+        # Like outcome(), for the whole batch
+        if self.cancelled:
+            return ui.batch_cancelled_text(self.done, self.total), RETRY_KEYBOARD, True
+        if self.done:
+            return ui.AFTER_GENERATION_TEXT, MAIN_MENU_KEYBOARD, False
+        return ui.generation_error_text(self.error), RETRY_KEYBOARD, True
+
+
+class Generation:
+    """One image set: generated (or taken from the cache), delivered, recorded.
+
+    A runtime's create_image does the waiting and the I/O and reports each
+    step here. read_cached, store, delivered and failed block.
+    """
+
+    def __init__(self, user, cached=None):
+        self.user = user
+        self.cached = cached
+        self.cache_key = result_cache.key_for(user, user.seed) if user.seed != -1 else None
+        self.seed = cached.seed if cached else user.seed
+        self.coalesced = False
+        self.latency_ms = None
+        self.started = time.monotonic()
+
+    def request(self):
+        # The backend's parameters
+        user = self.user
+        return {
+            'prompt': user.prompt,
+            'negative_prompt': user.negative_prompt,
+            'use_negative_prompt': True,
+            'style': user.style,
+            'seed': user.seed if user.seed != -1 else random.randint(0, MAX_SEED),
+            'width': user.width,
+            'height': user.height,
+            'guidance_scale': user.guidance_scale,
+            'randomize_seed': user.seed == -1,
+        }
+
+    def read_cached(self):
+        # Already uploaded once: re-sent by file_id, no bytes leave the bot
+        if self.cached.file_ids:
+            return self.cached.file_ids
+        with STAGE_SECONDS.time('cache_read'):
+            return read_images(self.cached.paths)
+
+    def store(self, images, seed):
+        # Called by the run that generated the images, shared or not
+        with STAGE_SECONDS.time('cache_write'):
+            result_cache.put(self.cache_key, images, seed)
+
+    def generated(self, seed, leader=True):
+        # A shared run (not the leader) cost no GPU time of its own, like a cache hit
+        self.seed = seed
+        self.coalesced = not leader
+        if leader:
+            self.latency_ms = int((time.monotonic() - self.started) * 1000)
+
+    @property
+    def caption(self):
+        return ui.generation_caption(self.user, self.seed)
+
+    @property
+    def parameters(self):
+        return generation_parameters(self.user, self.seed)
+
+    def delivered(self, file_ids):
+        user = self.user
+        if self.cache_key and not (self.cached and self.cached.file_ids):
+            result_cache.set_file_ids(self.cache_key, file_ids)
+        source = 'cache' if self.cached else 'shared' if self.coalesced else 'backend'
+        logger.info("Delivered image for user %s from %s. %s", user.id, source, self.caption,
+                    extra={'event': 'generation_delivered', 'user_id': user.id, 'seed': self.seed, 'source': source})
+        status = 'cached' if self.cached or self.coalesced else 'ok'
+        record_generation(user.id, user.prompt, user.negative_prompt, user.style, user.width, user.height, user.guidance_scale,
+                          self.seed, status, self.latency_ms, file_ids=file_ids)
+        GENERATIONS.inc(status)
+        STAGE_SECONDS.observe(time.monotonic() - self.started, 'generation')
+        if self.latency_ms is not None:
+            cost_model.observe(user.width, user.height, user.guidance_scale, self.latency_ms / 1000)
+
+    def cancelled(self):
+        logger.info("Generation for user %s cancelled", self.user.id)
+        GENERATIONS.inc('cancelled')
+
+    def failed(self, error):
+        user = self.user
+        logger.error("Error for user %s: %s", user.id, error)
+        record_generation(user.id, user.prompt, user.negative_prompt, user.style, user.width, user.height, user.guidance_scale,
+                          self.seed, 'failed', self.latency_ms or int((time.monotonic() - self.started) * 1000), str(error))
+        GENERATIONS.inc('failed')
+
+
+def history_page(user_id, before_id=LAST_ID):
+    # (text, keyboard) of the page of `user_id`'s history below before_id. One
+    # row more than a page tells whether there is an older one.
+    entries = get_history(user_id, before_id, HISTORY_PAGE_SIZE + 1)
+    if not entries:
+        return ui.HISTORY_EMPTY_TEXT, MAIN_MENU_KEYBOARD
+    older_than = entries[HISTORY_PAGE_SIZE - 1].id if len(entries) > HISTORY_PAGE_SIZE else None
+    entries = entries[:HISTORY_PAGE_SIZE]
+    return ui.history_text(entries), ui.history_keyboard(entries, older_than, before_id == LAST_ID)
+
+
+def history_id(data):
+    # The generation id in a "<prefix>_<id>" button, or None for a payload
+    # that is not one (a button from an older version, or a forged one)
+    payload = data.partition('_')[2]
+    if not (payload.isascii() and payload.isdigit()):
+        return None
+    generation_id = int(payload)
+    return generation_id if 0 < generation_id <= LAST_ID else None
+
+
+def history_before(data):
+    # The before_id of a "history" (newest page) or "history_<id>" button, or None
+    if data.partition('_')[2] == '':
+        return LAST_ID
+    return history_id(data)
+
+
+def history_entry(user_id, data):
+    # The generation a "resend_<id>" or "remix_<id>" button points at, or None
+    generation_id = history_id(data)
+    return get_history_entry(user_id, generation_id) if generation_id is not None else None
+
+
+def remix(user_id, entry):
+    # Loads the generation's parameters, its seed included, into the user's settings
+    user_store.update(user_id, prompt=entry.prompt, negative_prompt=entry.negative_prompt, style=entry.style,
+                      width=entry.width, height=entry.height, guidance_scale=entry.guidance_scale, seed=entry.seed)
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import uuid
+from collections import namedtuple
+import aiohttp
+from logger import logger
+
+# Where a submitted job is, as the app reports it: stage is 'queued' (position
+# is 1 for next up) or 'running'; eta is the app's estimate in seconds and
+# progress a fraction of the steps done, when it reports either
+JobStatus = namedtuple('JobStatus', 'stage position eta progress', defaults=(None, None, None))
+
+
+def space_url(src):
+    # "owner/Space-Name" -> "https://owner-space-name.hf.space/"; full URLs pass through
+    if src.startswith("http://") or src.startswith("https://"):
+        return src if src.endswith("/") else src + "/"
+    subdomain = src.lower().replace("/", "-").replace("_", "-").replace(".", "-")
+    return f"https://{subdomain}.hf.space/"
+
+
+class GradioError(Exception):
+    # The app failed the job; the message is the app's
+    pass
+
+
+class QueueFullError(GradioError):
+    pass
+
+
+class AsyncGradioClient:
+    """Minimal asyncio client for a gradio app's queue (/queue/join, /queue/data).
+
+    gradio_client is thread based, so the webhook runtime talks to the app
+    directly: join the queue with the inputs, then follow the job's
+    server-sent events for its place in line, its progress and the result.
+    Keyword arguments are mapped to positions using /info, and the api name
+    to a function index using /config.
+    """
+
+    def __init__(self, src, hf_token=None, timeout=600):
+        self.src = space_url(src)
+        self.headers = {"Authorization": f"Bearer {hf_token}"} if hf_token else {}
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=30)
+        self._session = None
+        self._endpoints = {}  # api_name -> (fn_index, [(name, default)]), loaded from /config and /info
+
+    async def _get_session(self):
+        if self._session is None or self._session.closed:
+            # No connection cap: each open event stream holds a connection, and
+            # the job queue's worker count already bounds concurrency
+            self._session = aiohttp.ClientSession(headers=self.headers, timeout=self.timeout,
+                                                  connector=aiohttp.TCPConnector(limit=0))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def ping(self, timeout=10):
+        # Health probe: raises unless the app answers /info
+        session = await self._get_session()
+        async with session.get(self.src + "info", timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            response.raise_for_status()
+
+    async def connect(self, api_name="/run"):
+        # Fetches what submit() needs to know about the endpoint ahead of time
+        await self._endpoint(api_name)
+
+    async def _endpoint(self, api_name):
+        if api_name not in self._endpoints:
+            session = await self._get_session()
+            async with session.get(self.src + "info") as response:
+                response.raise_for_status()
+                info = await response.json()
+            async with session.get(self.src + "config") as response:
+                response.raise_for_status()
+                config = await response.json()
+            parameters = [
+                (p.get("parameter_name") or p["label"], p.get("parameter_default"))
+                for p in info["named_endpoints"][api_name]["parameters"]
+            ]
+            fn_index = next(dependency.get("id", i) for i, dependency in enumerate(config["dependencies"])
+                            if dependency.get("api_name") == api_name.lstrip("/"))
+            self._endpoints[api_name] = fn_index, parameters
+        return self._endpoints[api_name]
+
+    async def submit(self, api_name="/run", progress=None, **kwargs):
+        # Runs the job and returns its outputs. `progress` is awaited with a
+        # JobStatus whenever the app reports one. Cancelling the call takes the
+        # job out of the app's queue, or stops it if it already runs.
+        session = await self._get_session()
+        fn_index, parameters = await self._endpoint(api_name)
+        data = [kwargs.get(name, default) for name, default in parameters]
+        # A session of its own, so the event stream carries only this job
+        session_hash = uuid.uuid4().hex
+        async with session.post(self.src + "queue/join", json={
+                "data": data, "fn_index": fn_index, "session_hash": session_hash, "event_data": None, "trigger_id": None}) as response:
+            response.raise_for_status()
+            event_id = (await response.json())["event_id"]
+        try:
+            return await self._follow(session, session_hash, progress)
+        except asyncio.CancelledError:
+            await asyncio.shield(self._cancel(fn_index, session_hash, event_id))
+            raise
+
+    async def _follow(self, session, session_hash, progress):
+        async with session.get(self.src + "queue/data", params={"session_hash": session_hash}) as response:
+            response.raise_for_status()
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                message = json.loads(line[len("data:"):])
+                kind = message.get("msg")
+                if kind == "process_completed":
+                    output = message.get("output") or {}
+                    if not message.get("success"):
+                        raise GradioError(output.get("error") or "The upstream app raised an exception")
+                    return output["data"]
+                if kind == "queue_full":
+                    raise QueueFullError("The upstream queue is full")
+                if progress is None:
+                    continue
+                if kind == "estimation":
+                    await progress(JobStatus('queued', (message.get("rank") or 0) + 1, message.get("rank_eta")))
+                elif kind == "process_starts":
+                    await progress(JobStatus('running', eta=message.get("eta")))
+                elif kind == "progress" and message.get("progress_data"):
+                    unit = message["progress_data"][0]
+                    if unit.get("progress") is not None:
+                        fraction = unit["progress"]
+                    elif unit.get("index") is not None and unit.get("length"):
+                        fraction = unit["index"] / unit["length"]
+                    else:
+                        continue
+                    await progress(JobStatus('running', progress=fraction))
+        raise ConnectionError("Connection closed before the result arrived")
+
+    async def _cancel(self, fn_index, session_hash, event_id):
+        # Best effort: the job is abandoned here either way
+        try:
+            session = await self._get_session()
+            async with session.post(self.src + "cancel", json={
+                    "fn_index": fn_index, "session_hash": session_hash, "event_id": event_id}) as response:
+                response.raise_for_status()
+        except Exception as e:
+            logger.warning("Could not cancel job %s on %s: %s", event_id, self.src, e)
+
+    async def download(self, file_data):
+        # Output files come back as FileData dicts with a URL to fetch them from
+        url = file_data.get("url") or f"{self.src}file={file_data['path']}"
+        session = await self._get_session()
+        async with session.get(url) as response:
+            response.raise_for_status()
+            return await response.read()
@@ -0,0 +1,189 @@
+import io
+import json
+import multiprocessing
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+from logger import listener_stopped, logger
+from metrics import POSTPROCESS_RESTARTS
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+EXTENSIONS = {'png': 'png', 'webp': 'webp', 'jpeg': 'jpg'}
+EXIF_IMAGE_DESCRIPTION = 0x010E
+
+
+def generation_parameters(user, seed):
+    # What gets embedded in the delivered file
+    return {
+        'prompt': user.prompt,
+        'negative_prompt': user.negative_prompt,
+        'style': user.style,
+        'width': user.width,
+        'height': user.height,
+        'guidance_scale': user.guidance_scale,
+        'seed': seed,
+    }
+
+
+def _png_text_chunk(keyword, text):
+    # iTXt, so prompts in any language survive
+    data = keyword.encode('latin-1') + b"\x00\x00\x00\x00\x00" + text.encode('utf-8')
+    return struct.pack(">I", len(data)) + b"iTXt" + data + struct.pack(">I", zlib.crc32(b"iTXt" + data) & 0xffffffff)
+
+
+def make_preview(data, max_size, quality):
+    # A JPEG no larger than max_size on either side, quick to upload and to show
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft('RGB', (max_size, max_size))
+        image = image.convert('RGB')
+        image.thumbnail((max_size, max_size), Image.Resampling.BILINEAR)
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=quality, optimize=False)
+        return output.getvalue()
+
+
+def encode_output(data, output_format, quality, parameters=None):
+    # The delivered file. A PNG that stays PNG is not decoded at all: the
+    # parameters go into a text chunk right after the header.
+    text = json.dumps(parameters, ensure_ascii=False) if parameters else None
+    if output_format == 'png' and data.startswith(PNG_SIGNATURE):
+        if not text:
+            return data
+        header_end = len(PNG_SIGNATURE) + 25  # the IHDR chunk always comes first
+        return data[:header_end] + _png_text_chunk('parameters', text) + data[header_end:]
+
+    with Image.open(io.BytesIO(data)) as image:
+        output = io.BytesIO()
+        if output_format == 'png':
+            image.save(output, 'PNG')
+            return encode_output(output.getvalue(), 'png', quality, parameters)
+        options = {}
+        if text:
+            exif = Image.Exif()
+            exif[EXIF_IMAGE_DESCRIPTION] = json.dumps(parameters)  # EXIF text is ASCII
+            options['exif'] = exif.tobytes()
+        if output_format == 'webp':
+            image.save(output, 'WEBP', quality=quality, lossless=quality >= 100, **options)
+        else:
+            image.convert('RGB').save(output, 'JPEG', quality=quality, **options)
+        return output.getvalue()
+
+
+class Postprocessor:
+    """Makes previews and delivered files in worker processes.
+
+    Decoding, resizing and encoding a 2048x2048 image is CPU bound, so it
+    runs outside the bot process and its GIL. submit() returns a pair of
+    futures per image, the preview first: callers can send the preview
+    while the full file is still being encoded.
+
+    If a worker dies (killed, out of memory) the pool breaks and every
+    submit() fails, so delivery falls back to the backend's files. The pool
+    is started again RESTART_DELAY seconds later, twice as long each time a
+    restarted pool dies within RESTART_MAX_DELAY.
+    """
+
+    RESTART_DELAY = 1.0
+    RESTART_MAX_DELAY = 60.0
+
+    def __init__(self, workers=2, output_format='png', quality=90, preview_size=1280, preview_quality=80, embed_metadata=True):
+        if output_format not in EXTENSIONS:
+            raise ValueError(f"Unknown output format: {output_format}")
+        self.workers = workers
+        self.output_format = output_format
+        self.quality = quality
+        self.preview_size = preview_size
+        self.preview_quality = preview_quality
+        self.embed_metadata = embed_metadata
+        self._pool = None
+        self._lock = threading.Lock()
+        self._started = 0.0
+        self._restart_at = None
+        self._restart_delay = self.RESTART_DELAY
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    @property
+    def extension(self):
+        return EXTENSIONS[self.output_format]
+
+    @property
+    def output(self):
+        # Everything the delivered files depend on; without workers they are the originals
+        return [self.output_format, self.quality, self.embed_metadata] if self.enabled else None
+
+    def start(self):
+        if self._pool or not self.enabled:
+            return
+        # fork, not spawn: spawned workers would re-run the bot's main module.
+        # A fork pool starts all its workers on the first submit. That has to
+        # happen before the bot's own threads start, and with the log listener
+        # thread (running since logger.py was imported) stopped, so that no
+        # worker inherits a lock some other thread was holding.
+        self._start_pool()
+        logger.info("Started %s image post-processing workers", self.workers)
+
+    def _start_pool(self):
+        self._started = time.monotonic()
+        self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'))
+        with listener_stopped():
+            self._pool.submit(int).result()
+
+    def stop(self):
+        if self._pool:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    def submit(self, images, parameters=None):
+        parameters = parameters if self.embed_metadata else None
+        pool = self._usable_pool()
+        try:
+            return [(pool.submit(make_preview, image, self.preview_size, self.preview_quality),
+                     pool.submit(encode_output, image, self.output_format, self.quality, parameters))
+                    for image in images]
+        except BrokenProcessPool:
+            self._broken(pool)
+            raise
+
+    def _usable_pool(self):
+        # The pool, started again first if it broke and its delay is over.
+        # By then the bot's threads run, unlike for start(); the workers only
+        # run the functions above, and CPython resets its own import and
+        # logging locks in a forked child.
+        with self._lock:
+            if self._restart_at is None:
+                return self._pool
+            if time.monotonic() < self._restart_at:
+                raise BrokenProcessPool("Post-processing workers are down, waiting to restart them")
+            self._restart_at = None
+            try:
+                self._start_pool()
+            except Exception as e:
+                self._schedule_restart()
+                raise BrokenProcessPool(f"Could not restart the post-processing workers: {e}") from e
+            POSTPROCESS_RESTARTS.inc()
+            logger.info("Restarted %s image post-processing workers", self.workers)
+            return self._pool
+
+    def _broken(self, pool):
+        with self._lock:
+            # Only the first caller to find this pool broken replaces it
+            if pool is not self._pool or self._restart_at is not None:
+                return
+            pool.shutdown(wait=False, cancel_futures=True)
+            delay = self._schedule_restart()
+        logger.error("Image post-processing workers died, restarting them in %.1fs", delay)
+
+    def _schedule_restart(self):
+        # Called with the lock held. A pool that ran for a while before it broke starts the backoff over.
+        now = time.monotonic()
+        delay = self.RESTART_DELAY if now - self._started > self.RESTART_MAX_DELAY else self._restart_delay
+        self._restart_delay = min(delay * 2, self.RESTART_MAX_DELAY)
+        self._restart_at = now + delay
+        return delay
@@ -0,0 +1,327 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from metrics import STAGE_SECONDS
+from logger import logger
+
+
+class QueueFull(Exception):
+    pass
+
+
+class UserQueueFull(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    # The user cancelled the job while it ran
+    pass
+
+
+class Job:
+    """A queued call. One submitted with a `cancel` event passes it on to its
+    function as `cancel`; the function should stop once it is set."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, user_id, func, args, kwargs, on_start=None, cost=1.0, cancel=None):
+        self.id = next(Job._ids)
+        self.user_id = user_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs if cancel is None else dict(kwargs, cancel=cancel)
+        self.on_start = on_start
+        self.cost = cost  # expected seconds of backend time
+        self.cancel = cancel
+        self.tag = None  # place in dispatch order while queued, see FairQueue
+        self.started = False
+        self.queued_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def when_queued(self, callback, position):
+        # Runs callback only if no worker has picked the job up yet, so a
+        # "you are #N in the queue" edit never overwrites a running job's status
+        with self.lock:
+            if not self.started and position:
+                callback(position)
+
+    def run(self):
+        with self.lock:
+            self.started = True
+            STAGE_SECONDS.observe(time.monotonic() - self.queued_at, 'queue_wait')
+            if self.on_start:
+                try:
+                    self.on_start()
+                except Exception as e:
+                    logger.warning("Start notification for job %s failed: %s", self.id, e)
+        return self.func(*self.args, **self.kwargs)
+
+
+class AsyncJob(Job):
+    # Same contract as Job, with coroutine callbacks and an asyncio lock
+
+    def __init__(self, user_id, func, args, kwargs, on_start=None, cost=1.0, cancel=None):
+        super().__init__(user_id, func, args, kwargs, on_start, cost, cancel)
+        self.lock = asyncio.Lock()
+
+    async def when_queued(self, callback, position):
+        async with self.lock:
+            if not self.started and position:
+                await callback(position)
+
+    async def run(self):
+        async with self.lock:
+            self.started = True
+            STAGE_SECONDS.observe(time.monotonic() - self.queued_at, 'queue_wait')
+            if self.on_start:
+                try:
+                    await self.on_start()
+                except Exception as e:
+                    logger.warning("Start notification for job %s failed: %s", self.id, e)
+        return await self.func(*self.args, **self.kwargs)
+
+
+class FairQueue:
+    """Per-user fair scheduling shared by the thread and asyncio queues.
+
+    Users share the workers by the backend time their jobs cost, not by job
+    count: start-time fair queueing. Each job is tagged with the point in
+    "virtual time" where it may start, which is where its user's previous
+    job ends; jobs are dispatched in tag order. A user with one 4K job
+    waits about as long as one with four small ones, and a run of huge
+    jobs cannot hold back everybody else's small ones. With equal costs
+    this is plain round robin. Not synchronized; callers hold their own lock.
+    """
+
+    def __init__(self, max_size, max_per_user):
+        self.max_size = max_size
+        self.max_per_user = max_per_user
+        self._heap = []  # (tag, job id, job)
+        self._finish = {}  # user_id -> virtual time their last job ends
+        self._vtime = 0.0
+        self._running = {}  # job -> monotonic time a worker took it
+        self._active = {}  # user_id -> queued + running jobs
+
+    def __len__(self):
+        return len(self._heap)
+
+    @property
+    def running(self):
+        return len(self._running)
+
+    def push(self, job):
+        if self._active.get(job.user_id, 0) >= self.max_per_user:
+            raise UserQueueFull(job.user_id)
+        if len(self._heap) >= self.max_size:
+            raise QueueFull()
+        job.tag = max(self._vtime, self._finish.get(job.user_id, 0.0))
+        self._finish[job.user_id] = job.tag + job.cost
+        heapq.heappush(self._heap, (job.tag, job.id, job))
+        self._active[job.user_id] = self._active.get(job.user_id, 0) + 1
+
+    def pop(self):
+        tag, _, job = heapq.heappop(self._heap)
+        self._vtime = tag
+        job.tag = None
+        self._running[job] = time.monotonic()
+        return job
+
+    def done(self, job):
+        del self._running[job]
+        self._leave(job)
+
+    def cancel(self, cancel):
+        # Sets a job's cancel event. Returns the job if no worker had taken it
+        # yet: it is dropped from the queue and will never run.
+        cancel.set()
+        for index, (_, _, job) in enumerate(self._heap):
+            if job.cancel is cancel:
+                self._heap[index] = self._heap[-1]
+                self._heap.pop()
+                heapq.heapify(self._heap)
+                job.tag = None
+                self._leave(job)
+                return job
+        return None
+
+    def _leave(self, job):
+        remaining = self._active[job.user_id] - 1
+        if remaining:
+            self._active[job.user_id] = remaining
+        else:
+            del self._active[job.user_id]
+            del self._finish[job.user_id]
+
+    def position(self, job):
+        # 1-based place in dispatch order, or None once a worker has the job
+        if job.tag is None:
+            return None
+        return sum(1 for entry in self._heap if entry[:2] < (job.tag, job.id)) + 1
+
+    def work_ahead(self, job=None, user_id=None):
+        # Seconds of backend time to get through before `job` starts, or before
+        # a job `user_id` submitted now would: the rest of the running jobs
+        # plus every queued job dispatched first
+        now = time.monotonic()
+        work = sum(max(0.0, running.cost - (now - started)) for running, started in self._running.items())
+        if job is not None:
+            if job.tag is None:
+                return 0.0
+            key = (job.tag, job.id)
+        else:
+            key = (max(self._vtime, self._finish.get(user_id, 0.0)), float('inf'))
+        return work + sum(entry[2].cost for entry in self._heap if entry[:2] < key)
+
+    def stats(self):
+        return {
+            'queued': len(self._heap),
+            'running': len(self._running),
+            'users': len(self._active),
+        }
+
+
+class JobQueue:
+    """Bounded generation queue drained by a pool of worker threads.
+
+    `parallelism` is how many jobs actually generate at once, for wait
+    estimates; it defaults to the number of workers.
+    """
+
+    def __init__(self, workers=2, max_size=100, max_per_user=2, parallelism=None):
+        self.workers = workers
+        self.parallelism = parallelism or workers
+        self._cond = threading.Condition()
+        self._queue = FairQueue(max_size, max_per_user)
+        self._threads = []
+        self._stopping = False
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"generation-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.info("Started %s generation workers", self.workers)
+
+    def stop(self, timeout=None):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout)
+
+    def submit(self, user_id, func, *args, on_start=None, cost=1.0, cancel=None, **kwargs):
+        job = Job(user_id, func, args, kwargs, on_start, cost, cancel)
+        with self._cond:
+            self._queue.push(job)
+            self._cond.notify()
+        return job
+
+    def cancel(self, cancel):
+        # True if the job was still queued and is now dropped; a running job
+        # only sees its event set and stops on its own
+        with self._cond:
+            return self._queue.cancel(cancel) is not None
+
+    def position(self, job):
+        with self._cond:
+            return self._queue.position(job)
+
+    def estimated_wait(self, job=None, user_id=None):
+        # Seconds until `job` (or a new job of `user_id`) should start
+        with self._cond:
+            return self._queue.work_ahead(job, user_id) / self.parallelism
+
+    def stats(self):
+        with self._cond:
+            return dict(self._queue.stats(), workers=len(self._threads))
+
+    def _take(self):
+        with self._cond:
+            while not len(self._queue) and not self._stopping:
+                self._cond.wait()
+            if self._stopping:
+                return None
+            return self._queue.pop()
+
+    def _done(self, job):
+        with self._cond:
+            self._queue.done(job)
+
+    def _worker(self):
+        while True:
+            job = self._take()
+            if job is None:
+                return
+            try:
+                job.run()
+            except Exception as e:
+                logger.error("Generation job %s for user %s failed: %s", job.id, job.user_id, e)
+            finally:
+                self._done(job)
+
+
+class AsyncJobQueue:
+    """JobQueue for the asyncio runtime: workers are tasks, jobs are coroutines.
+
+    A waiting generation costs a task rather than a thread, so `workers` can
+    be set far higher than in polling mode.
+    """
+
+    def __init__(self, workers=32, max_size=1000, max_per_user=2, parallelism=None):
+        self.workers = workers
+        self.parallelism = parallelism or workers
+        self._cond = None
+        self._queue = FairQueue(max_size, max_per_user)
+        self._tasks = []
+
+    def start(self):
+        if self._tasks:
+            return
+        self._cond = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker(), name=f"generation-worker-{i}") for i in range(self.workers)]
+        logger.info("Started %s async generation workers", self.workers)
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def submit(self, user_id, func, *args, on_start=None, cost=1.0, cancel=None, **kwargs):
+        job = AsyncJob(user_id, func, args, kwargs, on_start, cost, cancel)
+        async with self._cond:
+            self._queue.push(job)
+            self._cond.notify()
+        return job
+
+    def cancel(self, cancel):
+        return self._queue.cancel(cancel) is not None
+
+    def position(self, job):
+        # Single-threaded event loop: no lock needed for a read
+        return self._queue.position(job)
+
+    def estimated_wait(self, job=None, user_id=None):
+        return self._queue.work_ahead(job, user_id) / self.parallelism
+
+    def stats(self):
+        return dict(self._queue.stats(), workers=len(self._tasks))
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: len(self._queue))
+                job = self._queue.pop()
+            try:
+                await job.run()
+            except Exception as e:
+                logger.error("Generation job %s for user %s failed: %s", job.id, job.user_id, e)
+            finally:
+                self._queue.done(job)
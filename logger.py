@@ -1,8 +1,119 @@
+import atexit
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+import threading
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from config import LOG_FILE, LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_EVENT_RATE
+from ratelimit import TokenBucket
 
-def setup_logger(name, log_file, level=logging.INFO):
-    formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
+# Events that can come in bursts of thousands; each is capped at LOG_EVENT_RATE
+# records per second and the rest are counted instead of written
+RATE_LIMITED_EVENTS = {'button_click', 'user_started', 'generation_delivered'}
+
+# Attributes every LogRecord has; anything else came in through `extra`
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, message and any `extra` fields."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class EventRateFilter(logging.Filter):
+    """Drops records of rate limited events over `rate` per second, per event.
+
+    The next record of that event that gets through carries the number
+    dropped since in its `suppressed` field.
+    """
+
+    def __init__(self, rate, events=RATE_LIMITED_EVENTS):
+        super().__init__()
+        self.rate = rate
+        self.events = events
+        self._buckets = {}
+        self._suppressed = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if event not in self.events:
+            return True
+        with self._lock:
+            bucket = self._buckets.get(event)
+            if bucket is None:
+                bucket = self._buckets[event] = TokenBucket(self.rate)
+        if not bucket.try_acquire():
+            with self._lock:
+                self._suppressed[event] = self._suppressed.get(event, 0) + 1
+            return False
+        with self._lock:
+            suppressed = self._suppressed.pop(event, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # QueueHandler.prepare() formats the message on the calling thread; keep
+        # the record as it is so %-args and tracebacks are rendered by the writer.
+        # Pass immutable args: they are read later, on another thread.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listeners = []
+
+
+@contextmanager
+def listener_stopped():
+    """Stops the queue listener threads for the duration, e.g. around fork().
+
+    A forked child gets only the calling thread; a listener caught holding a
+    handler or queue lock would leave that lock held for good in the child.
+    Records logged meanwhile stay queued and are written once it restarts.
+    """
+    for listener in _listeners:
+        listener.stop()
+    try:
+        yield
+    finally:
+        for listener in _listeners:
+            listener.start()
+
+
+def setup_logger(name, log_file, level=logging.INFO, json_format=False, queue_size=0, event_rate=0):
+    """Logs to `log_file` (rotated at 10 MB) and stderr.
+
+    With `queue_size`, callers only put records on a bounded queue and a
+    background thread formats and writes them; when the queue is full new
+    records are dropped rather than blocking the caller. `event_rate` caps
+    the events in RATE_LIMITED_EVENTS per second.
+    """
+    formatter = JsonFormatter() if json_format else logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
 
     file_handler = RotatingFileHandler(log_file, maxBytes=10*1024*1024, backupCount=5)
     file_handler.setFormatter(formatter)
@@ -12,10 +123,22 @@ def setup_logger(name, log_file, level=logging.INFO):
 
     logger = logging.getLogger(name)
     logger.setLevel(level)
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
+    if event_rate:
+        logger.addFilter(EventRateFilter(event_rate))
+
+    if queue_size:
+        records = queue.Queue(queue_size)
+        listener = QueueListener(records, file_handler, stream_handler, respect_handler_level=True)
+        listener.start()
+        _listeners.append(listener)
+        # Drain what is still queued on exit
+        atexit.register(listener.stop)
+        logger.addHandler(LazyQueueHandler(records))
+    else:
+        logger.addHandler(file_handler)
+        logger.addHandler(stream_handler)
 
     return logger
 
 # Create a logger
-logger = setup_logger('bot_logger', 'bot.log')
\ No newline at end of file
+logger = setup_logger('bot_logger', LOG_FILE, LOG_LEVEL, LOG_FORMAT == 'json', LOG_QUEUE_SIZE, LOG_EVENT_RATE)
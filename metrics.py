@@ -0,0 +1,215 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logger import logger
+
+# Upper bounds in seconds; a Space takes anywhere from seconds to minutes, a
+# SQLite read well under a millisecond
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_labels(self.label_names, labels)} {value}" for labels, value in values]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [count per bucket, then +Inf], sum
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def totals(self):
+        # labels -> (count, sum of observed values)
+        with self._lock:
+            return {labels: (sum(counts), total) for labels, (counts, total) in self._series.items()}
+
+    def _samples(self):
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        samples = []
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket = _labels(self.label_names, labels, f'le="{bound}"')
+                samples.append(f"{self.name}_bucket{bucket} {cumulative}")
+            samples.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+            samples.append(f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}")
+        return samples
+
+
+class Gauge(Metric):
+    """A value read when scraped: `read` returns a number, or a dict from label tuples to numbers."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, read, labels=()):
+        super().__init__(name, description, labels)
+        self.read = read
+
+    def _samples(self):
+        try:
+            values = self.read()
+        except Exception as e:
+            logger.warning("Could not read gauge %s: %s", self.name, e)
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_labels(self.label_names, labels)} {value}" for labels, value in values.items()]
+
+
+STAGE_SECONDS = Histogram('dalle_stage_seconds', "Time spent in each stage of handling a generation", ['stage'])
+HANDLER_CALLS = Counter('dalle_handler_calls_total', "Updates handled, by kind and command or button", ['kind', 'name'])
+GENERATIONS = Counter('dalle_generations_total', "Finished generations by outcome", ['status'])
+DEGRADED_JOBS = Counter('dalle_degraded_jobs_total', "Jobs generated at a lower resolution because the queue was long")
+RESENDS = Counter('dalle_history_resends_total', "Generations sent again from /history by file_id, by outcome", ['status'])
+POSTPROCESS_FALLBACKS = Counter('dalle_postprocess_fallbacks_total', "Generations delivered as the backend's files because post-processing failed")
+POSTPROCESS_RESTARTS = Counter('dalle_postprocess_restarts_total', "Times the image post-processing workers were started again after dying")
+Gauge('dalle_log_records_dropped', "Log records dropped because the log writer fell behind",
+      lambda: sum(getattr(handler, 'dropped', 0) for handler in logger.handlers))
+
+# Commands and button data are sent by the client, so only these become labels as they are
+COMMAND_LABELS = {'start', 'help', 'random', 'generate', 'stats', 'broadcast', 'settings', 'history'}
+CALLBACK_LABELS = {'another_random', 'cancel_generation', 'create_batch', 'create_image', 'generate_random', 'help', 'history', 'main_menu',
+                   'my_settings', 'random_prompt', 'retry_generation', 'settings', 'set_guidance', 'set_seed', 'set_size', 'set_style',
+                   'add_custom_negative', 'add_custom_negative_random', 'use_default_negative', 'use_default_negative_random'}
+# Data that carries a value after the prefix, such as style_Anime or resend_42, counts under the prefix
+CALLBACK_PREFIX_LABELS = {'style', 'history', 'resend', 'remix'}
+
+
+def command_label(text):
+    command = text.split()[0][1:].split('@', 1)[0] if text else ''
+    return command if command in COMMAND_LABELS else 'other'
+
+
+def callback_label(data):
+    if data in CALLBACK_LABELS:
+        return data
+    prefix = data.partition('_')[0]
+    if prefix in CALLBACK_PREFIX_LABELS:
+        return prefix
+    return 'other'
+
+
+def timed(stage):
+    # Decorator: records every call of the function as `stage`
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def register_runtime_gauges(job_queue, backend_router, generation_flight):
+    # Read from the scraping thread; for the asyncio runtime these are plain
+    # reads of counters the event loop updates
+    Gauge('dalle_queue_jobs', "Generation jobs waiting for or held by a worker", lambda: {
+        ('queued',): job_queue.stats()['queued'], ('running',): job_queue.stats()['running']}, ['state'])
+    Gauge('dalle_queue_users', "Users with a queued or running generation", lambda: job_queue.stats()['users'])
+    Gauge('dalle_generations_in_flight', "Generations running on each backend", lambda: {
+        (backend.src,): backend.in_flight for backend in backend_router.backends}, ['backend'])
+    Gauge('dalle_backend_circuit_open', "1 while a backend's circuit breaker is open", lambda: {
+        (backend.src,): int(not backend.healthy) for backend in backend_router.backends}, ['backend'])
+    Gauge('dalle_shared_generations_in_flight', "Distinct fixed-seed generations other jobs may join",
+          lambda: generation_flight.stats()['in_flight'])
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would flood the bot log
+
+
+def start_metrics_server(host, port):
+    # Serves /metrics from a daemon thread; returns the server so it can be shut
+    # down, or None when the port can't be bound: the bot runs on without metrics
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error("Can't serve metrics on %s:%d: %s", host, port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%s/metrics", host, server.server_address[1])
+    return server
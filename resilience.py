@@ -0,0 +1,163 @@
+import asyncio
+import random
+import threading
+import time
+import aiohttp
+import httpx
+from gradio_async import GradioError, QueueFullError
+from logger import logger
+
+# Errors worth another attempt: the Space could not be reached, was overloaded
+# or dropped the job. Anything else (bad input, a bug in the app) fails the
+# same way every time, so it is neither retried nor held against the backend.
+TRANSIENT_ERRORS = (TimeoutError, asyncio.TimeoutError, ConnectionError, httpx.TransportError, aiohttp.ClientConnectionError,
+                    QueueFullError)
+TRANSIENT_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+# gradio_client's, by name: only the thread runtime imports that package
+TRANSIENT_ERROR_NAMES = frozenset({'QueueError', 'TooManyRequestsError'})
+APP_ERROR_NAMES = frozenset({'AppError'})
+# What a Space says about a job it dropped rather than rejected
+TRANSIENT_APP_MESSAGES = ('GPU task aborted',)
+
+
+class BackendUnavailable(Exception):
+    # Every backend's circuit is open and none will be retried before the deadline
+    pass
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def http_status(error):
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code
+    return None
+
+
+def is_transient(error):
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    status = http_status(error)
+    if status is not None:
+        return status in TRANSIENT_STATUSES
+    names = {cls.__name__ for cls in type(error).__mro__}
+    if names & TRANSIENT_ERROR_NAMES:
+        return True
+    if isinstance(error, GradioError) or names & APP_ERROR_NAMES:
+        return any(message in str(error) for message in TRANSIENT_APP_MESSAGES)
+    return False
+
+
+class RetryPolicy:
+    """How often and how patiently a generation is retried.
+
+    Delays grow exponentially from `base_delay` up to `max_delay` with full
+    jitter, so users who failed together do not all come back at once.
+    """
+
+    def __init__(self, attempts=3, base_delay=1.0, max_delay=20.0, deadline=300.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Closed -> open after `failure_threshold` consecutive failures.
+
+    While open, the backend gets no work. After `reset_timeout` seconds (or
+    earlier, once a health probe succeeds) it turns half-open and lets a
+    single trial request through: success closes the circuit, failure opens
+    it again for another `reset_timeout`.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.trips = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def available(self):
+        with self._lock:
+            state = self._state()
+            return state == self.CLOSED or (state == self.HALF_OPEN and not self._trial)
+
+    def retry_in(self):
+        # Seconds until an open circuit lets a trial through
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def dispatched(self):
+        with self._lock:
+            if self._state() == self.HALF_OPEN:
+                self._trial = True
+
+    def success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Circuit for %s closed", self.name)
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def abandon(self):
+        # A dispatched request was cancelled before it told us anything
+        with self._lock:
+            self._trial = False
+
+    def failure(self, error=None):
+        with self._lock:
+            self.failures += 1
+            state = self._state()
+            if state == self.HALF_OPEN or (state == self.CLOSED and self.failures >= self.failure_threshold):
+                self._open(error)
+
+    def probe(self, ok, error=None):
+        # Background health checks. A failed probe counts toward the threshold
+        # like a failed request, so one slow /info cannot open a healthy
+        # backend's circuit, and sends a half-open circuit back to open. A
+        # good one lets an open circuit try a request right away.
+        with self._lock:
+            state = self._state()
+            if not ok and state == self.CLOSED:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self._open(error)
+            elif not ok and state == self.HALF_OPEN:
+                self._open(error)
+            elif ok and state == self.OPEN:
+                self._opened_at = time.monotonic() - self.reset_timeout
+
+    def _open(self, error):
+        self._opened_at = time.monotonic()
+        self._trial = False
+        self.trips += 1
+        logger.warning("Circuit for %s opened for %.0fs: %s", self.name, self.reset_timeout, error)
@@ -0,0 +1,26 @@
+class HandlerRegistry:
+    """Finds the handler for a command or for a button's callback data.
+
+    Exact names take one dict lookup. Prefix entries such as "style_" cover
+    data with a variable part; they end in the separator and are looked up
+    by the data up to its first separator, so they take one more.
+    """
+
+    def __init__(self, handlers, prefixes=None, separator='_'):
+        self.handlers = dict(handlers)
+        self.prefixes = dict(prefixes or {})
+        self.separator = separator
+        for prefix in self.prefixes:
+            if not prefix.endswith(separator) or separator in prefix[:-1]:
+                raise ValueError(f"Prefix {prefix!r} must end with its only {separator!r}")
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key):
+        handler = self.handlers.get(key)
+        if handler is None and self.prefixes:
+            head, separator, _ = key.partition(self.separator)
+            if separator:
+                handler = self.prefixes.get(head + separator)
+        return handler
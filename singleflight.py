@@ -0,0 +1,163 @@
+import asyncio
+import threading
+import time
+from jobs import JobCancelled
+
+WAIT_SLICE = 0.5  # how often a waiter in the thread runtime looks at its own cancel event
+
+
+class _Call:
+    __slots__ = ('done', 'cancel', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.cancel = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one.
+
+    The first caller for a key starts the function in a thread of its own;
+    every caller, the first included, waits for it and gets the same result
+    or exception. do() returns (result, leader) so callers can tell whether
+    they started the work.
+
+    The function is passed the call's own cancel event. A caller whose
+    `cancel` is set, or who times out, detaches with JobCancelled or
+    TimeoutError and the others keep waiting; the call is cancelled once
+    nobody waits for it.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.followers = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, timeout=None, cancel=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+            call.waiters += 1
+        if leader:
+            threading.Thread(target=self._run, args=(key, call, func), name="singleflight", daemon=True).start()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = WAIT_SLICE if cancel is not None else None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._leave(key, call)
+                    raise TimeoutError(f"Gave up waiting for an identical request after {timeout:.0f}s")
+                wait = remaining if wait is None else min(wait, remaining)
+            if call.done.wait(wait):
+                break
+            if cancel is not None and cancel.is_set():
+                self._leave(key, call)
+                raise JobCancelled()
+        if call.error is not None:
+            raise call.error
+        return call.result, leader
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._calls), 'leaders': self.leaders, 'followers': self.followers}
+
+    def _run(self, key, call, func):
+        try:
+            call.result = func(call.cancel)
+        except BaseException as e:
+            call.error = e
+        finally:
+            with self._lock:
+                self._forget(key, call)
+            call.done.set()
+
+    def _leave(self, key, call):
+        with self._lock:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.done.is_set():
+                # Nobody wants the result any more; a new caller starts afresh
+                self._forget(key, call)
+                call.cancel.set()
+
+    def _forget(self, key, call):
+        # A newer call may already own the key once this one was abandoned
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+
+class _AsyncCall:
+    __slots__ = ('task', 'cancel', 'waiters')
+
+    def __init__(self):
+        self.task = None
+        self.cancel = asyncio.Event()
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines.
+
+    The work runs in its own task and is passed the call's own cancel
+    event. A waiter whose `cancel` is set, or whose task is cancelled,
+    detaches; the call is cancelled once nobody waits for it.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.followers = 0
+        self._calls = {}
+
+    async def do(self, key, func, cancel=None):
+        call = self._calls.get(key)
+        leader = call is None
+        if leader:
+            call = self._calls[key] = _AsyncCall()
+            call.task = asyncio.create_task(func(call.cancel))
+            call.task.add_done_callback(lambda task: self._done(key, call, task))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        call.waiters += 1
+        cancelled = asyncio.ensure_future(cancel.wait()) if cancel is not None else None
+        try:
+            await asyncio.wait([call.task] + ([cancelled] if cancelled else []), return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            if not call.task.done():
+                self._leave(key, call)
+            raise
+        finally:
+            if cancelled:
+                cancelled.cancel()
+        if not call.task.done():
+            self._leave(key, call)
+            raise JobCancelled()
+        return call.task.result(), leader
+
+    def stats(self):
+        return {'in_flight': len(self._calls), 'leaders': self.leaders, 'followers': self.followers}
+
+    def _done(self, key, call, task):
+        self._forget(key, call)
+        if not task.cancelled():
+            task.exception()  # retrieved, in case every waiter had left
+
+    def _leave(self, key, call):
+        call.waiters -= 1
+        if call.waiters == 0:
+            self._forget(key, call)
+            call.cancel.set()
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
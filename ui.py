@@ -0,0 +1,344 @@
+import random
+import time
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+from config import MAX_SEED, MAX_WIDTH, MAX_HEIGHT, BATCH_SIZE
+from resilience import BackendUnavailable, DeadlineExceeded
+
+# Texts and keyboards shared by the polling bot (main.py) and the webhook bot (async_main.py)
+
+WELCOME_TEXT = (
+    "Welcome to the DALLE-4K! 🎨\n"
+    "Here's how to get started:\n"
+    "1. First, set your generation settings using /settings\n"
+    "2. Send a text message with your prompt\n"
+    "3. Optionally, set a negative prompt\n"
+    "4. Wait for your amazing result!"
+)
+
+PROCESSING_TEXT = "🎨 Assembling your creative vision... This might take a moment, but great art is worth the wait!"
+READY_TEXT = "🌟 Your masterpiece is ready! Unveiling it now..."
+PAINTING_TEXT = "🖌 The brushes are moving! Your vision is being painted right now..."
+CANCELLED_TEXT = "🛑 Cancelled. Your settings are all still here whenever inspiration strikes again."
+CANCELLING_TEXT = "Stopping the brushes..."
+NOTHING_TO_CANCEL_TEXT = "This one is already finished or cancelled."
+AFTER_GENERATION_TEXT = "What do you think? Ready to create another masterpiece?"
+MISSING_SETTINGS_TEXT = "Looks like we're missing some key ingredients for your masterpiece. Let's check your settings and make sure everything's in place! Have you written a prompt? :D"
+NO_PROMPT_TEXT = "Oops! It seems you haven't set a prompt yet. Please set a prompt first or use /random to get a random prompt."
+NO_USER_TEXT = "Oops! It seems we haven't set up your creative space yet. Let's start with /start and make some art!"
+UNKNOWN_COMMAND_TEXT = "Unknown command. Press /help to see the available commands."
+QUEUE_FULL_TEXT = "Our studio is packed right now! Please try again in a minute."
+NEGATIVE_PROMPT_CHOICE_TEXT = "Great prompt! Now, would you like to use the default negative prompt or add your own creative twist?"
+NEGATIVE_PROMPT_CHOICE_RANDOM_TEXT = "Exciting! Now, for the negative prompt: stick with the default or add your personal touch?"
+CUSTOM_NEGATIVE_TEXT = "Alright, creative genius! What would you like to avoid in your image? (e.g., 'blurry, low quality, distorted')"
+STYLE_TEXT = "What style speaks to you today?"
+STYLE_SET_TEXT = "Your style is set! What else would you like to adjust?"
+SETTINGS_MENU_TEXT = "Let's customize your creation! What would you like to adjust?"
+MAIN_MENU_TEXT = "What would you like to do next?"
+ADMIN_ONLY_STATS_TEXT = "Sorry, this magical power is reserved for the administrators."
+ADMIN_ONLY_BROADCAST_TEXT = "Sorry, the power of mass communication is for administrators only."
+BROADCAST_PROMPT_TEXT = "What message would you like to share with all our creative minds? You can also send an image with a caption."
+BROADCAST_UNSUPPORTED_TEXT = "Broadcasts can be a text message or an image with a caption. Use /broadcast to try again."
+START_OVER_TEXT = "Oops! Let's start from the beginning. Use /start to kick things off!"
+HISTORY_EMPTY_TEXT = "Your gallery is empty for now. Every image you create lands here, ready to be sent again in an instant!"
+HISTORY_GONE_TEXT = "That creation isn't in your gallery."
+HISTORY_STALE_TEXT = "That button is out of date. Open /history for a fresh gallery."
+RESENDING_TEXT = "Here it comes again!"
+RESEND_FAILED_TEXT = "Telegram no longer has that file. Remix it to paint it anew!"
+REMIXED_TEXT = "Settings loaded! Tweak anything you like, then create."
+
+SIZE_TEXT = (
+    f"Let's set the canvas size! Enter two numbers for width and height, like this:\n\n"
+    f"1024 1024 (perfect square)\n"
+    f"1280 720 (widescreen)\n"
+    f"{MAX_WIDTH} {MAX_HEIGHT} (maximum size)\n\n"
+    f"Remember, bigger isn't always better - it affects generation time too! "
+    f"What dimensions inspire you?"
+)
+GUIDANCE_TEXT = (
+    "Time to set the Guidance Scale! This determines how closely the image follows your prompt.\n\n"
+    "1-5: More creative, but might stray from your prompt\n"
+    "6-10: A balanced approach\n"
+    "11-20: Strictly follows the prompt, but might be less creative\n\n"
+    "What's your preference? Enter a number between 1 and 20."
+)
+SEED_TEXT = (
+    f"Let's talk about seeds! A seed is like a magic number that ensures consistency:\n\n"
+    f"0-{MAX_SEED}: Choose any number in this range for reproducible results\n"
+    f"-1: Let fate decide (random seed each time)\n\n"
+    f"What's your lucky number? Or type -1 if you're feeling adventurous!"
+)
+SIZE_ERROR_TEXT = "Oops! That didn't quite work. Remember, just type two numbers like '1024 1024'. Let's try again!"
+GUIDANCE_ERROR_TEXT = "Hmm, that doesn't look like a number between 1 and 20. Want to give it another shot?"
+SEED_ERROR_TEXT = f"Oops! That doesn't look like a whole number. Remember, you can use any number from 0 to {MAX_SEED}, or -1 for a random seed each time. Want to try again?"
+# What each conversation state asked for, repeated when the answer was not text
+STATE_PROMPTS = {'negative_prompt': CUSTOM_NEGATIVE_TEXT, 'size': SIZE_TEXT, 'guidance': GUIDANCE_TEXT, 'seed': SEED_TEXT}
+
+HELP_TEXT = (
+    "🌟 Welcome to the DALLE-4K, AI Image Generator Bot! 🎨\n\n"
+    "Available commands:\n"
+    "/start - Begin your creative journey\n"
+    "/help - Show this helpful message\n"
+    "/random - Get inspired with a random prompt\n"
+    "/generate - Create an image with your current settings\n"
+    "/generate N - Create N variants at once, each with its own seed\n"
+    "/settings - Adjust your generation parameters\n"
+    "/history - Browse your past creations, get them again or remix them\n\n"
+
+    "🔧 Generation parameters:\n"
+    "• Style - Sets the overall look and feel of your image\n"
+    f"• Size - From 512x512 to {MAX_WIDTH}x{MAX_HEIGHT}, affects detail level\n"
+    "• Guidance Scale (1-20) - Controls how closely the image follows your prompt\n"
+    f"• Seed (0-{MAX_SEED}) - For consistent results across generations\n\n"
+
+    "✨ Tips for writing great prompts:\n"
+    "1. Be specific and descriptive - 'A majestic lion roaring at sunset' is better than just 'A lion'\n"
+    "2. Use style keywords - 'oil painting', 'photorealistic', 'cartoon style'\n"
+    "3. Mention colors, lighting, and mood - 'A cozy cabin in a snowy forest, warm golden light from the windows'\n"
+    "4. Experiment with different art styles - 'cyberpunk cityscape', 'art nouveau portrait'\n"
+    "5. Use commas to separate elements in your prompt\n\n"
+
+    "🎭 Key concepts:\n"
+    "• Prompt - Your description of the image you want to create\n"
+    "• Negative prompt - Things you don't want in your image\n"
+    "• Style - Predefined looks that affect the overall appearance\n"
+    "• Guidance Scale - How strictly the AI follows your prompt\n"
+    "• Seed - A number that determines the initial randomness\n\n"
+
+    "Simply send a text message to use it as a prompt for image generation.\n"
+    "\nIf you need help or have suggestions, feel free to contact @captriphead"
+)
+
+STYLES = ['3840 x 2160', '2560 x 1440', 'Photo', 'Cinematic', 'Anime', '3D Model', '(No style)']
+
+
+def welcome_back_text(first_name):
+    return f"Welcome back, {first_name}! Ready to create something amazing?"
+
+def random_prompt_text(prompt, refresh=False):
+    if refresh:
+        return f"Here's a fresh spark of inspiration:\n\n<code>{prompt}</code>\n\nFeel free to use it as is or add your own flair!"
+    return f"Here's a creative spark for you:\n\n<code>{prompt}</code>\n\nFeel free to use it as is or add your own twist!"
+
+def queue_position_text(position, eta=None):
+    text = f"⏳ Your creative vision is #{position} in the queue. We'll start painting as soon as an easel frees up!"
+    return with_eta(text, eta)
+
+def with_eta(text, eta):
+    # eta: expected seconds until delivery, or None
+    if eta is None:
+        return text
+    if eta < 60:
+        return text + f"\n\n⏱ Ready in about {max(5, round(eta / 5) * 5)} seconds"
+    minutes = round(eta / 60)
+    return text + f"\n\n⏱ Ready in about {minutes} minute{'s' if minutes > 1 else ''}"
+
+def backend_status_text(status, eta=None):
+    # status: a JobStatus from the backend; eta: our own estimate, used when the Space gives none
+    if status.stage == 'queued':
+        text = f"⏳ Waiting for a free easel at the studio: #{status.position} in line."
+    else:
+        text = PAINTING_TEXT
+        if status.progress is not None:
+            text += f" {int(status.progress * 100)}%"
+    return with_eta(text, status.eta if status.eta is not None else eta)
+
+def batch_cancelled_text(done, total):
+    if done:
+        return f"🛑 Cancelled after {done} of {total} variants."
+    return CANCELLED_TEXT
+
+def text_only_text(state):
+    text = "I can only read words for this one! Please type your answer as a text message."
+    if state in STATE_PROMPTS:
+        text += "\n\n" + STATE_PROMPTS[state]
+    return text
+
+def degraded_text(text, width, height):
+    return text + f"\n\n🚦 The studio is very busy, so this one will be painted at {width}x{height} to keep the wait short."
+
+def user_queue_full_text(max_jobs):
+    return f"Easy there, prolific artist! You already have {max_jobs} creations in progress. Let them finish before starting another one."
+
+def batch_processing_text(count):
+    return f"🎨 Painting {count} variants of your vision at once... Each one arrives as soon as it's done!"
+
+def batch_progress_text(done, failed, total):
+    text = f"🖌 {done + failed} of {total} variants finished"
+    if failed:
+        text += f" ({failed} didn't make it)"
+    return text + ("..." if done + failed < total else ".")
+
+def batch_size_error_text(max_size):
+    return f"You can create between 1 and {max_size} variants at once, like this: /generate 4"
+
+def style_set_text(style):
+    return f"Great choice! Style set to: {style}"
+
+def settings_text(user):
+    settings_text = "🎨 Your Creative Palette 🎨\n\n"
+    settings_text += f"🖼 Current Prompt: {user.prompt or 'Not set yet'}\n\n"
+    settings_text += f"🚫 Negative Prompt: {user.negative_prompt or 'Using default'}\n\n"
+    settings_text += f"✨ Style: {user.style or 'Not set'}\n"
+    settings_text += f"📐 Canvas Size: {user.width or '?'}x{user.height or '?'}\n"
+    settings_text += f"🧭 Guidance Scale: {user.guidance_scale or 'Not set'}\n"
+    settings_text += f"🌱 Seed: {user.seed if user.seed != -1 else 'Random'}\n\n"
+    settings_text += "Ready to tweak your masterpiece? Click a button below!"
+    return settings_text
+
+HISTORY_PROMPT_LENGTH = 60
+
+def history_text(entries):
+    # entries: db.HistoryEntry, newest first; numbered like their buttons
+    lines = ["🗂 Your gallery, newest first:"]
+    for number, entry in enumerate(entries, 1):
+        prompt = entry.prompt or ''
+        if len(prompt) > HISTORY_PROMPT_LENGTH:
+            prompt = prompt[:HISTORY_PROMPT_LENGTH - 1] + "…"
+        created = time.strftime('%Y-%m-%d', time.gmtime(entry.created_at))
+        lines.append(f"\n{number}. {prompt}\n✨ {entry.style} · 📐 {entry.width}x{entry.height} · 🌱 {entry.seed} · {created}")
+    return "\n".join(lines)
+
+def generation_caption(user, seed):
+    return (f"🖼 Prompt: {user.prompt}\n\n"
+            f"🚫 Negative prompt: {user.negative_prompt}\n\n"
+            f"✨ Style: {user.style}\n"
+            f"📐 Size: {user.width}x{user.height}\n"
+            f"🧭 Guidance scale: {user.guidance_scale}\n"
+            f"🌱 Seed: {seed}")
+
+def generation_error_text(error):
+    if isinstance(error, BackendUnavailable):
+        return "Our painting studio is taking a short break right now. Please try again in a few minutes!"
+    if isinstance(error, DeadlineExceeded):
+        return "Our easels are all busy and your masterpiece took too long to start. Let's try again in a moment!"
+    if 'GPU task aborted' in str(error):
+        return "Oops! It seems our digital paintbrush ran out of ink. Let's try again in a moment!"
+    return f"Uh-oh! We hit a creative block:\n\n🚫 {str(error)}\n\nShall we try again or tweak our artistic vision?"
+
+def stats_text(stats, cache_stats, backend_stats=None, flight_stats=None):
+    stats_text = f"📊 Bot statistics:\n\n"
+    stats_text += f"Total users: {stats['users']}\n"
+    stats_text += f"Active users (with prompt): {stats['users_with_prompt']}\n"
+    stats_text += f"Users with custom style: {stats['users_with_style']}\n"
+    stats_text += f"Users with custom size: {stats['users_with_size']}\n"
+    stats_text += f"Users with custom guidance scale: {stats['users_with_guidance']}\n"
+    stats_text += f"Users with custom seed: {stats['users_with_seed']}\n"
+
+    stats_text += f"\n🖼 Generations: {stats['generations']} (cached: {stats['generations_cached']}, failed: {stats['generations_failed']})\n"
+    if stats['latency_p50_ms'] is not None:
+        stats_text += f"Generation time: p50 {stats['latency_p50_ms'] / 1000:.1f}s, p95 {stats['latency_p95_ms'] / 1000:.1f}s\n"
+    for day, total, cached, failed, latency_ms_total in stats['daily']:
+        generated = total - cached - failed
+        average = f", avg {latency_ms_total / generated / 1000:.1f}s" if generated else ""
+        stats_text += f"{day}: {total} total, {failed} failed{average}\n"
+
+    stats_text += f"\n🗄 Result cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['evictions']} evictions\n"
+    stats_text += f"Cached generations: {cache_stats['entries']} ({cache_stats['bytes'] / 1024 / 1024:.1f} MB)\n"
+    if flight_stats:
+        stats_text += f"Shared in-flight generations: {flight_stats['followers']} joined {flight_stats['leaders']} runs\n"
+
+    if backend_stats:
+        stats_text += (f"\n🖥 Backends: {backend_stats['retries']} retries, {backend_stats['fast_failed']} fast-failed, "
+                       f"{backend_stats['deadline_exceeded']} past deadline\n")
+        for backend in backend_stats['backends']:
+            latency = f", {backend['latency_ms'] / 1000:.1f}s" if backend['latency_ms'] is not None else ""
+            stats_text += (f"{backend['src']}: circuit {backend['state']} (tripped {backend['trips']}x), "
+                           f"{backend['in_flight']}/{backend['limit']} busy, {backend['requests']} requests, "
+                           f"{backend['errors']} errors{latency}\n")
+    return stats_text
+
+# Settings input parsing: each returns (fields to store, reply text) and
+# raises ValueError on input it cannot understand
+
+def parse_size(text):
+    size = text.lower().replace('x', ' ').replace('*', ' ')
+    width, height = map(int, size.split())
+    width = min(width, MAX_WIDTH)
+    height = min(height, MAX_HEIGHT)
+    return {'width': width, 'height': height}, f"Perfect! Your canvas is set to {width}x{height}. Ready to create some art?"
+
+def parse_guidance(text):
+    guidance = float(text)
+    guidance = max(1, min(20, guidance))
+    if guidance <= 5:
+        response = f"Guidance Scale set to {guidance}. We're going for creative and unexpected results!"
+    elif guidance <= 10:
+        response = f"Guidance Scale set to {guidance}. A perfect balance between creativity and precision."
+    else:
+        response = f"Guidance Scale set to {guidance}. We're aiming for high precision and close adherence to your prompt."
+    return {'guidance_scale': guidance}, response
+
+def parse_seed(text):
+    seed = int(text)
+    if seed == -1:
+        return {'seed': seed}, "Excellent! We'll use a random seed each time. Every generation will be a surprise!"
+    seed = max(0, min(MAX_SEED, seed))
+    return {'seed': seed}, f"Great! We've locked in seed {seed}. You can use this same seed to recreate this image later if you like it."
+
+def parse_batch_size(text, max_size):
+    # "/generate" or "/generate N"; raises ValueError for anything else
+    parts = text.split()
+    if len(parts) < 2:
+        return 1
+    count = int(parts[1])
+    if not 1 <= count <= max_size:
+        raise ValueError(f"Batch size must be between 1 and {max_size}")
+    return count
+
+def batch_seeds(seed, count):
+    # A fixed seed gives the seeds that follow it, so the batch can be recreated;
+    # -1 gives random ones. Either way every variant has a fixed, cacheable seed.
+    if seed == -1:
+        return [random.randint(0, MAX_SEED) for _ in range(count)]
+    return [(seed + i) % (MAX_SEED + 1) for i in range(count)]
+
+# Keyboards: static, so each is built and serialized once; the Bot API
+# methods take the JSON string as it is
+def _keyboard(*buttons):
+    # buttons: (text, callback data), one row each
+    keyboard = InlineKeyboardMarkup()
+    for text, data in buttons:
+        keyboard.row(InlineKeyboardButton(text, callback_data=data))
+    return keyboard.to_json()
+
+MAIN_MENU_KEYBOARD = _keyboard(
+    ("Create image", "create_image"),
+    (f"Create {BATCH_SIZE} variants", "create_batch"),
+    ("Settings", "settings"),
+    ("Help", "help"),
+    ("Random prompt", "random_prompt"),
+    ("My creations", "history"),
+)
+SETTINGS_KEYBOARD = _keyboard(
+    ("Style", "set_style"),
+    ("Size", "set_size"),
+    ("Guidance Scale", "set_guidance"),
+    ("Seed", "set_seed"),
+    ("Back to Main Menu", "main_menu"),
+)
+STYLE_KEYBOARD = _keyboard(*((style, f"style_{style}") for style in STYLES), ("Back", "settings"))
+RANDOM_PROMPT_KEYBOARD = _keyboard(
+    ("Generate", "generate_random"),
+    ("Generation settings", "settings"),
+    ("Another prompt", "another_random"),
+)
+NEGATIVE_PROMPT_KEYBOARD = _keyboard(("Use default", "use_default_negative"), ("Add custom", "add_custom_negative"))
+NEGATIVE_PROMPT_RANDOM_KEYBOARD = _keyboard(("Use default", "use_default_negative_random"), ("Add custom", "add_custom_negative_random"))
+CANCEL_KEYBOARD = _keyboard(("Cancel", "cancel_generation"))
+RETRY_KEYBOARD = _keyboard(("Try again", "retry_generation"), ("Adjust settings", "my_settings"))
+
+def history_keyboard(entries, older_than=None, newest=True):
+    # Per entry: send again and remix. older_than: id the next page starts below, if there is one
+    keyboard = InlineKeyboardMarkup()
+    for number, entry in enumerate(entries, 1):
+        keyboard.row(InlineKeyboardButton(f"{number}. Send again", callback_data=f"resend_{entry.id}"),
+                     InlineKeyboardButton(f"{number}. Remix", callback_data=f"remix_{entry.id}"))
+    navigation = []
+    if not newest:
+        navigation.append(InlineKeyboardButton("« Newest", callback_data="history"))
+    if older_than is not None:
+        navigation.append(InlineKeyboardButton("Older »", callback_data=f"history_{older_than}"))
+    if navigation:
+        keyboard.row(*navigation)
+    keyboard.row(InlineKeyboardButton("Back to Main Menu", callback_data="main_menu"))
+    return keyboard.to_json()
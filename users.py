@@ -0,0 +1,147 @@
+import atexit
+import dataclasses
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+from config import USER_CACHE_SIZE, USER_FLUSH_INTERVAL
+from db import get_user, create_user, apply_user_updates, USER_FIELDS
+from logger import logger
+
+
+@dataclass(slots=True)
+class UserProfile:
+    id: int
+    username: Optional[str]
+    prompt: Optional[str]
+    negative_prompt: Optional[str]
+    style: Optional[str]
+    width: Optional[int]
+    height: Optional[int]
+    guidance_scale: Optional[float]
+    seed: Optional[int]
+
+
+class UserStore:
+    """LRU cache of user profiles in front of the users table.
+
+    Reads of cached users never touch SQLite. Updates are applied to the
+    cache at once and written back in batches: pending fields are coalesced
+    per user and flushed in a single transaction every `flush_interval`
+    seconds and on shutdown.
+    """
+
+    def __init__(self, max_users=10000, flush_interval=2.0):
+        self.max_users = max_users
+        self.flush_interval = flush_interval
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._profiles = OrderedDict()  # user_id -> UserProfile, least recently used first
+        self._dirty = {}  # user_id -> {field: value} not yet written to SQLite
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._flush_loop, name="user-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def get(self, user_id):
+        with self._lock:
+            profile = self._profiles.get(user_id)
+            if profile is not None:
+                self._profiles.move_to_end(user_id)
+                self.hits += 1
+                return dataclasses.replace(profile)
+            self.misses += 1
+        # Holding the flush lock keeps a flush from clearing _dirty between
+        # the read and the overlay below
+        with self._flush_lock:
+            row = get_user(user_id)
+            if row is None:
+                return None
+            with self._lock:
+                profile = UserProfile(*row)
+                # Updates not yet flushed are newer than the row
+                for field, value in self._dirty.get(user_id, {}).items():
+                    setattr(profile, field, value)
+                self._remember(profile)
+                return dataclasses.replace(profile)
+
+    def create(self, user_id, username):
+        # Write-through: a new user must exist before anything can update it
+        with self._flush_lock:
+            create_user(user_id, username)
+        with self._lock:
+            self._dirty.pop(user_id, None)
+            self._profiles.pop(user_id, None)
+        return self.get(user_id)
+
+    def update(self, user_id, **fields):
+        for field in fields:
+            if field not in USER_FIELDS:
+                raise ValueError(f"Unknown user field: {field}")
+        with self._lock:
+            profile = self._profiles.get(user_id)
+            if profile is not None:
+                for field, value in fields.items():
+                    setattr(profile, field, value)
+                self._profiles.move_to_end(user_id)
+            self._dirty.setdefault(user_id, {}).update(fields)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+            try:
+                apply_user_updates(dirty)
+            except Exception as e:
+                with self._lock:
+                    # Put the batch back without clobbering newer updates
+                    for user_id, fields in dirty.items():
+                        self._dirty[user_id] = {**fields, **self._dirty.get(user_id, {})}
+                logger.error("Failed to flush %d user updates: %s", len(dirty), e)
+                return
+            self.flushes += 1
+            self.rows_written += len(dirty)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cached': len(self._profiles),
+                'dirty': len(self._dirty),
+                'hits': self.hits,
+                'misses': self.misses,
+                'flushes': self.flushes,
+                'rows_written': self.rows_written,
+            }
+
+    def _remember(self, profile):
+        self._profiles[profile.id] = profile
+        self._profiles.move_to_end(profile.id)
+        while len(self._profiles) > self.max_users:
+            # Pending writes live in _dirty, so evicting a profile loses nothing
+            self._profiles.popitem(last=False)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+
+user_store = UserStore(USER_CACHE_SIZE, USER_FLUSH_INTERVAL)